@@ -3,6 +3,7 @@
 import argparse
 import json
 import random
+import shutil
 import time
 from dataclasses import dataclass
 from datetime import datetime
@@ -14,7 +15,7 @@ import pandas as pd
 import PIL.Image
 import torch
 import tqdm
-from segment_anything import SamPredictor, sam_model_registry
+from segment_anything import sam_model_registry
 
 # SAMのチェックポイントを配置しているディレクトリへのパス
 _SAM_CHECKPOINT_DIR = "./weights"
@@ -50,12 +51,27 @@ class CommandLineArguments:
     # SAM推論時の複数マスク出力フラグ
     multimask_output: bool = True
 
-    # SAM推論時のロジット出力フラグ
-    return_logits: bool = False
+    # 推論精度 ["fp32", "bf16", "int8"]
+    precision: str = "fp32"
+
+    # fp32との比較に使う画像ディレクトリ（空の場合は乱数で生成した画像を使う）
+    compare_image_dir: str = ""
+
+    # 画像エンコーダの実行方式（eager/torchscript）ごとの初回・定常時の処理時間測定フラグ
+    compare_encoder_backend: bool = False
+
+    # 前処理（画像読み込み・リサイズ・正規化）の従来方式とcv2方式の処理時間比較フラグ
+    compare_preprocess: bool = False
 
     # 乱数シード
     rand_seed: int = 12345
 
+    # 一括エンコードのバッチサイズ（0以下の場合、スループット測定を行わない）
+    batch_size: int = 0
+
+    # スループット測定に使う画像数
+    throughput_images: int = 16
+
     # 出力先ディレクトリ
     output_dir: str = ""
 
@@ -126,9 +142,27 @@ def _get_args() -> CommandLineArguments:
         # help=""
     )
     parser.add_argument(
-        "--return_logits",
+        "--precision",
+        default="fp32",
+        type=str,
+        choices=["fp32", "bf16", "int8"],
+        help="推論精度（bf16: 自動混合精度、int8: 画像エンコーダの動的量子化（CPUのみ））",
+    )
+    parser.add_argument(
+        "--compare_image_dir",
+        default="",
+        type=str,
+        help="fp32との比較に使う画像ディレクトリ（空の場合は乱数で生成した画像を使う）",
+    )
+    parser.add_argument(
+        "--compare_encoder_backend",
         action="store_true",
-        # help=""
+        help="画像エンコーダの実行方式（eager/torchscript）ごとに初回と定常時の処理時間を測定する",
+    )
+    parser.add_argument(
+        "--compare_preprocess",
+        action="store_true",
+        help="前処理（画像読み込み・リサイズ・正規化）の従来方式とcv2方式の処理時間を比較する",
     )
     parser.add_argument(
         "--rand_seed",
@@ -136,6 +170,18 @@ def _get_args() -> CommandLineArguments:
         type=int,
         # help=""
     )
+    parser.add_argument(
+        "--batch_size",
+        default=0,
+        type=int,
+        help="一括エンコードのバッチサイズ（0以下の場合、スループット測定を行わない）",
+    )
+    parser.add_argument(
+        "--throughput_images",
+        default=16,
+        type=int,
+        help="スループット測定に使う画像数",
+    )
     parser.add_argument(
         "--output_dir",
         default=".result",
@@ -221,6 +267,333 @@ def _generate_test_image_and_prompt(
     return img, prompt
 
 
+def _create_uncached_predictor(
+    args: CommandLineArguments,
+    **kwargs,
+):
+    """埋め込みキャッシュを使わないSAM推論ラッパーの生成
+
+    キャッシュに当たらないようにメモリキャッシュは無効にし、ディスクキャッシュも指定しない
+
+    Args:
+        args (CommandLineArguments): コマンドライン引数
+        **kwargs: SamPredictorWrapperに渡す追加の引数（precisionの指定はargsより優先する）
+    """
+    from sam_annotation.sam_predictor_wrapper import SamPredictorWrapper
+
+    kwargs.setdefault("precision", args.precision)
+    return SamPredictorWrapper(
+        model_type=args.model_type,
+        checkpoint=_SAM_CHECKPOINT_MAP[args.model_type],
+        device=args.device,
+        memory_cache_max_entries=0,
+        **kwargs,
+    )
+
+
+def _measure_encode_throughput(
+    args: CommandLineArguments,
+    img_w: int,
+    img_h: int,
+) -> pd.DataFrame:
+    """一括エンコードのスループット測定
+
+    1枚ずつのエンコードと、バッチサイズ指定の一括エンコードの画像数/秒を比較する
+    """
+    predictor = _create_uncached_predictor(args)
+
+    imgs = [
+        _generate_test_image_and_prompt(
+            img_w=img_w,
+            img_h=img_h,
+            num_point=0,
+            use_box=False,
+            seed=args.rand_seed + i,
+        )[0]
+        for i in range(args.throughput_images)
+    ]
+
+    # ウォームアップ
+    predictor.set_images(imgs[:args.batch_size], "RGB", batch_size=args.batch_size)
+
+    results = []
+    for batch_size in (1, args.batch_size):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+
+        predictor.set_images(imgs, "RGB", batch_size=batch_size)
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        sec = time.perf_counter() - t0
+
+        results.append({
+            "batch_size": batch_size,
+            "images": len(imgs),
+            "sec": sec,
+            "images_per_sec": len(imgs) / sec,
+        })
+
+    df = pd.DataFrame(results)
+    df["gain"] = df["images_per_sec"] / df["images_per_sec"].iloc[0]
+    return df
+
+
+def _generate_test_boxes(
+    img_w: int,
+    img_h: int,
+    num_box: int,
+    seed: int,
+) -> np.ndarray:
+    """テスト用ボックス（XYXY形式）の生成"""
+    rng = np.random.default_rng(seed)
+    x0 = rng.integers(0, img_w // 2, size=num_box)
+    y0 = rng.integers(0, img_h // 2, size=num_box)
+    x1 = x0 + rng.integers(img_w // 8, img_w // 2, size=num_box)
+    y1 = y0 + rng.integers(img_h // 8, img_h // 2, size=num_box)
+    return np.stack([x0, y0, x1, y1], axis=1)
+
+
+def _compare_precision_with_fp32(
+    args: CommandLineArguments,
+    img_w: int,
+    img_h: int,
+) -> pd.DataFrame:
+    """fp32との比較
+
+    固定の画像セットを、fp32と指定の推論精度でエンコードして処理時間を比較し、
+    同じボックスを推論したマスクのIoUをSamPredictorWrapper.check_precision_driftで算出する
+    """
+    # 固定の画像セット（画像ディレクトリ指定が無ければ乱数シード固定で生成する）
+    if args.compare_image_dir is not None and args.compare_image_dir != "":
+        img_paths = sorted(
+            p for p in Path(args.compare_image_dir).iterdir()
+            if p.suffix.lower() in (".jpg", ".jpeg", ".png", ".bmp"))
+        imgs = [_load_image_as_rgb_format(str(p)) for p in img_paths[:args.throughput_images]]
+    else:
+        imgs = [
+            _generate_test_image_and_prompt(
+                img_w=img_w,
+                img_h=img_h,
+                num_point=0,
+                use_box=False,
+                seed=args.rand_seed + i,
+            )[0]
+            for i in range(args.throughput_images)
+        ]
+
+    predictors = {
+        precision: _create_uncached_predictor(args, precision=precision)
+        for precision in ("fp32", args.precision)
+    }
+
+    # ウォームアップ
+    for predictor in predictors.values():
+        predictor.set_images(imgs[:1], "RGB", batch_size=1)
+
+    results = []
+    for idx, img in enumerate(imgs):
+        boxes = _generate_test_boxes(
+            img.shape[1], img.shape[0], num_box=8, seed=args.rand_seed + idx)
+
+        result = {"image": idx}
+        for precision, predictor in predictors.items():
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+
+            predictor.set_images([img], "RGB", batch_size=1)
+
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            result[f"{precision}_encode_msec"] = (time.perf_counter() - t0) * 1e3
+
+        drift = predictors[args.precision].check_precision_drift(img, "RGB", boxes)
+        result["mean_iou"] = drift["mean_iou"]
+        result["min_iou"] = drift["min_iou"]
+        results.append(result)
+
+    for predictor in predictors.values():
+        predictor.release()
+
+    df = pd.DataFrame(results)
+    df["speedup"] = df["fp32_encode_msec"] / df[f"{args.precision}_encode_msec"]
+    return df
+
+
+def _measure_quantized_model_load(
+    args: CommandLineArguments,
+    img: np.ndarray,
+    work_dir: Path,
+) -> pd.DataFrame:
+    """INT8モデルの読み込み時間測定
+
+    量子化した画像エンコーダのディスクキャッシュが無い状態（量子化して保存する）と
+    ある状態（保存済みのものを読み込む）で、SamPredictorWrapperの読み込み時間を比較する
+    保存済みの画像エンコーダが量子化直後と同じ結果になることも、特徴量の差とマスクのIoUで確認する
+    """
+    # 測定用の保存先を空にして、最初の読み込みで必ず量子化させる
+    model_cache_dir = work_dir / "model_cache"
+    shutil.rmtree(model_cache_dir, ignore_errors=True)
+
+    img_h, img_w = img.shape[:2]
+    boxes = _generate_test_boxes(img_w, img_h, num_box=8, seed=args.rand_seed)
+
+    results = []
+    outputs = []
+    for cache_state in ("cold", "warm"):
+        t0 = time.perf_counter()
+        predictor = _create_uncached_predictor(
+            args,
+            precision="int8",
+            model_cache_dir=str(model_cache_dir),
+        )
+        load_msec = (time.perf_counter() - t0) * 1e3
+
+        embedding = predictor.set_images([img], "RGB", batch_size=1)[0]
+        masks, _ = predictor.predict_boxes(boxes, embedding=embedding)
+        outputs.append((embedding.features.float().cpu(), masks[:, 0]))
+
+        result = {"cache": cache_state, "load_msec": load_msec}
+        result.update({
+            name.replace("_sec", "_msec"): sec * 1e3
+            for name, sec in predictor.load_stats.items()
+        })
+        results.append(result)
+        predictor.release()
+        del predictor
+
+    # 保存済みの画像エンコーダの結果が量子化直後と一致するか
+    (features_cold, masks_cold), (features_warm, masks_warm) = outputs
+    ious = []
+    for mask_cold, mask_warm in zip(masks_cold, masks_warm):
+        union = np.logical_or(mask_cold, mask_warm).sum()
+        inter = np.logical_and(mask_cold, mask_warm).sum()
+        ious.append(inter / union if union > 0 else 1.0)
+    results[-1]["max_abs_feature_diff"] = float((features_warm - features_cold).abs().max())
+    results[-1]["min_iou_vs_cold"] = float(np.min(ious))
+
+    return pd.DataFrame(results)
+
+
+def _measure_encoder_backends(
+    args: CommandLineArguments,
+    img: np.ndarray,
+) -> pd.DataFrame:
+    """画像エンコーダの実行方式ごとの処理時間測定
+
+    モデルの読み込み時間、初回呼び出しの処理時間、定常時の処理時間を分けて測定する
+    TorchScriptは初回起動時にトレースして保存するので、2回目以降の実行で読み込み時間が短くなる
+    """
+    def _encode_msec(predictor):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        predictor.set_images([img], "RGB", batch_size=1)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return (time.perf_counter() - t0) * 1e3
+
+    # TorchScriptはbf16に対応しない
+    encoder_backends = ["eager"] if args.precision == "bf16" else ["eager", "torchscript"]
+
+    results = []
+    for encoder_backend in encoder_backends:
+        t0 = time.perf_counter()
+        predictor = _create_uncached_predictor(args, encoder_backend=encoder_backend)
+        load_msec = (time.perf_counter() - t0) * 1e3
+
+        first_call_msec = _encode_msec(predictor)
+        steady_msecs = [_encode_msec(predictor) for _ in range(args.iterations)]
+
+        results.append({
+            "encoder_backend": encoder_backend,
+            "load_msec": load_msec,
+            "first_call_msec": first_call_msec,
+            "steady_msec_mean": float(np.mean(steady_msecs)),
+            "steady_msec_median": float(np.median(steady_msecs)),
+        })
+        del predictor
+
+    return pd.DataFrame(results)
+
+
+def _measure_preprocess(
+    args: CommandLineArguments,
+    img: np.ndarray,
+    work_dir: Path,
+) -> pd.DataFrame:
+    """前処理の段階ごとの処理時間測定
+
+    従来方式（PILで全画素を読み込み、複製してからResizeLongestSideで縮小・正規化）と
+    cv2方式（縮小デコードで読み込み、cv2で縮小して入力テンソルに直接正規化）を比較する
+    cv2方式はファイルパス指定のset_imageで実行し、段階ごとの処理時間はpreprocess_statsの差分から求める
+    """
+    from segment_anything.utils.transforms import ResizeLongestSide
+
+    # 画像ファイルからの読み込みも測定に含めるためJPEGで保存する
+    img_path = work_dir / "preprocess_input.jpg"
+    img_path.parent.mkdir(parents=True, exist_ok=True)
+    PIL.Image.fromarray(img).save(img_path, quality=95)
+
+    # 従来方式の正規化（Sam.preprocess）には重みパラメータは不要なのでチェックポイントは読み込まない
+    sam = sam_model_registry[args.model_type]().to(args.device)
+    image_size = sam.image_encoder.img_size
+    transform = ResizeLongestSide(image_size)
+
+    predictor = _create_uncached_predictor(args)
+    # 複製の時間を含めないように書き込み不可にしておく
+    shared_img = img.copy()
+    shared_img.setflags(write=False)
+
+    def _sync():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    results = []
+    for _ in tqdm.tqdm(range(args.iterations)):
+        # 従来方式
+        t0 = time.perf_counter()
+        legacy_img = PIL.Image.open(img_path).convert("RGB")
+        legacy_img = np.array(legacy_img)
+        t1 = time.perf_counter()
+        legacy_img = legacy_img.copy()
+        t2 = time.perf_counter()
+        resized = transform.apply_image(legacy_img)
+        t3 = time.perf_counter()
+        x = torch.as_tensor(resized, device=args.device)
+        x = x.permute(2, 0, 1).contiguous()[None, :, :, :]
+        x = sam.preprocess(x)
+        _sync()
+        t4 = time.perf_counter()
+
+        # cv2方式（画像エンコードを含むので、前処理の時間は統計情報から取り出す）
+        stats_before = predictor.preprocess_stats
+        predictor.set_image(shared_img, "RGB", img_path=str(img_path))
+        predictor.wait_embedding_ready()
+        stats_after = predictor.preprocess_stats
+        fast_sec = {
+            name: stats_after[name] - stats_before[name]
+            for name in ("decode_sec", "resize_sec", "normalize_sec")
+        }
+
+        results.append({
+            "legacy_decode_msec": (t1 - t0) * 1e3,
+            "legacy_copy_msec": (t2 - t1) * 1e3,
+            "legacy_resize_msec": (t3 - t2) * 1e3,
+            "legacy_normalize_msec": (t4 - t3) * 1e3,
+            "legacy_total_msec": (t4 - t0) * 1e3,
+            "fast_decode_msec": fast_sec["decode_sec"] * 1e3,
+            "fast_resize_msec": fast_sec["resize_sec"] * 1e3,
+            "fast_normalize_msec": fast_sec["normalize_sec"] * 1e3,
+            "fast_total_msec": sum(fast_sec.values()) * 1e3,
+        })
+
+    predictor.release()
+    return pd.DataFrame(results)
+
+
 def main():
     # 年月日時分秒の文字列　"YYYYMMDD_hhmmss"
     # dt_str = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -254,7 +627,7 @@ def main():
         # 入力画像とプロンプトを生成
         img_h = args.image_height
         img_w = args.image_width
-        img, prompt = _generate_test_image_and_prompt(
+        img, _ = _generate_test_image_and_prompt(
             img_w=args.image_width,
             img_h=args.image_height,
             num_point=0,
@@ -263,67 +636,58 @@ def main():
         )
 
     # SAMモデルのインスタンス生成と初期化
-    build_sam = sam_model_registry[args.model_type]
-    sam_model = build_sam(checkpoint=_SAM_CHECKPOINT_MAP[args.model_type])
-    sam_model.to(args.device)
-    sam_predictor = SamPredictor(sam_model)
+    # アプリと同じくSamPredictorWrapperで指定の推論精度のモデルを読み込む
+    if args.precision == "int8":
+        # 動的量子化の演算はCPUのみ対応
+        args.device = "cpu"
+    predictor = _create_uncached_predictor(args)
+
+    # 画像全体のボックスをプロンプトにする
+    img_h, img_w = img.shape[:2]
+    boxes = np.array([[0, 0, img_w, img_h]], dtype=np.float32)
+    multimask_output = args.multimask_output
 
     # ウォームアップ
     if True:
-        sam_predictor.set_image(img)
-        sam_predictor.predict()
-
-    # 推論パラメータ
-
-    point_coords = prompt.get("point_coords", None)
-    point_labels = prompt.get("point_labels", None)
-    box = prompt.get("box", None)
-    mask_input = prompt.get("mask_input", None)
-    multimask_output = args.multimask_output
-    return_logits = args.return_logits
+        embedding = predictor.set_images([img], "RGB", batch_size=1)[0]
+        predictor.predict_boxes(boxes, multimask_output=multimask_output, embedding=embedding)
 
     # debug
-    print(f"{point_coords=}")
-    print(f"{point_labels=}")
-    print(f"{box=}")
-    if mask_input is not None:
-        print(f"{mask_input.shape=}")
+    print(f"{boxes=}")
     print(f"{multimask_output=}")
-    print(f"{return_logits=}")
+
+    def _sync():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
 
     time_list = []
     for _ in tqdm.tqdm(range(args.iterations)):
         ts = []
 
-        torch.cuda.synchronize()
+        _sync()
         ts.append(["", time.perf_counter()])
 
-        # 画像エンコード
-        sam_predictor.set_image(img, image_format="RGB")
+        # 画像エンコード（メモリキャッシュは無効なので毎回エンコードする）
+        embedding = predictor.set_images([img], "RGB", batch_size=1)[0]
 
-        torch.cuda.synchronize()
+        _sync()
         ts.append(["set_image", time.perf_counter()])
 
         # 推論
-        masks, iou_preds, low_res_masks = sam_predictor.predict(
-            point_coords=point_coords,
-            point_labels=point_labels,
-            box=box,
-            mask_input=mask_input,
+        masks, scores = predictor.predict_boxes(
+            boxes,
             multimask_output=multimask_output,
-            return_logits=return_logits,
+            embedding=embedding,
         )
 
-        torch.cuda.synchronize()
+        _sync()
         ts.append(["predict", time.perf_counter()])
 
         # debug
         if False:
             print(f"{masks.shape=},"
                   f"{masks.dtype=},"
-                  f"{iou_preds=},"
-                  f"{low_res_masks.shape=},"
-                  f"{low_res_masks.dtype=}")
+                  f"{scores=}")
 
         # 処理時間
         time_map = {}
@@ -341,6 +705,7 @@ def main():
         f"{args.model_type}",
         f"{img_w}x{img_h}",
         f"{args.device}",
+        f"{args.precision}",
     ])
     output_dir = (Path(args.output_dir) / info_str)
 
@@ -356,6 +721,46 @@ def main():
     # df_summary.to_json(Path(output_dir) / "time_measure_summary.json")
 
     print(df_summary)
+    predictor.release()
+
+    # 一括エンコードのスループット測定
+    if args.batch_size > 0:
+        df_throughput = _measure_encode_throughput(args, img_w, img_h)
+        df_throughput.to_csv(Path(output_dir) / "encode_throughput.csv")
+        print(df_throughput)
+
+    # 画像エンコーダの実行方式ごとの初回・定常時の処理時間
+    if args.compare_encoder_backend:
+        df_backend = _measure_encoder_backends(args, img)
+        df_backend.to_csv(Path(output_dir) / "encoder_backend.csv")
+        print(df_backend)
+
+    # 前処理の従来方式とcv2方式の処理時間比較
+    if args.compare_preprocess:
+        df_preprocess = _measure_preprocess(args, img, output_dir)
+        df_preprocess.to_csv(Path(output_dir) / "preprocess.csv")
+        print(df_preprocess.describe())
+
+    # INT8では量子化した画像エンコーダのディスクキャッシュの有無による読み込み時間を記録する
+    if args.precision == "int8":
+        df_load = _measure_quantized_model_load(args, img, output_dir)
+        df_load.to_csv(Path(output_dir) / "quantized_load.csv")
+        print(df_load)
+
+    # fp32以外の推論精度ではfp32との速度比とマスクのずれを記録する
+    if args.precision != "fp32":
+        df_compare = _compare_precision_with_fp32(args, img_w, img_h)
+        df_compare.to_csv(Path(output_dir) / "precision_compare.csv")
+        drift = {
+            "precision": args.precision,
+            "num_images": len(df_compare),
+            "speedup": float(df_compare["speedup"].mean()),
+            "mean_iou": float(df_compare["mean_iou"].mean()),
+            "min_iou": float(df_compare["min_iou"].min()),
+        }
+        with open(Path(output_dir) / "precision_drift.json", "w", encoding="utf8") as fp:
+            json.dump(drift, fp, indent=4)
+        print(f"{drift=}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,199 @@
+import math
+from dataclasses import dataclass
+
+import numpy as np
+import torch
+from segment_anything.utils.amg import (
+    batched_mask_to_box,
+    build_point_grid,
+    calculate_stability_score,
+)
+from torchvision.ops import nms
+
+from ._embedding_cache import ImageEmbedding
+
+
+@dataclass
+class MaskProposal:
+    """マスク候補情報クラス"""
+
+    # マスク (H, W)（bool型）
+    mask: np.ndarray = None
+
+    # マスクデコーダが予測したIoU（並び順の基準）
+    predicted_iou: float = 0.0
+
+    # 安定度スコア（しきい値を上下させたときのマスクのIoU）
+    stability_score: float = 0.0
+
+    # バウンディングボックス（XYWH形式）
+    bbox: tuple = None
+
+    # 面積（ピクセル数）
+    area: int = 0
+
+    # 候補を生成したプロンプトのポイント座標 (x, y)
+    point: tuple = None
+
+
+class AutoMaskProposer:
+    """画像全体のマスク候補の自動生成クラス
+
+    画像埋め込みに格子状のポイントプロンプトを与えてまとめてデコードし、
+    予測IoUと安定度で選別してNMSで重複を除いたマスク候補を予測IoUの高い順に返す
+    選別とNMSは低解像度のロジットのまま行い、残った候補だけを元画像サイズにアップサンプリングする
+    （SamAutomaticMaskGeneratorは全候補をアップサンプリングしてから選別する）
+    """
+
+    def __init__(
+        self,
+        predictor,
+        points_per_side: int = 32,
+        points_per_batch: int = 64,
+        pred_iou_thresh: float = 0.88,
+        stability_score_thresh: float = 0.95,
+        stability_score_offset: float = 1.0,
+        box_nms_thresh: float = 0.7,
+        min_mask_area: int = 0,
+        max_proposals: int = 0,
+        upsample_batch_size: int = 16,
+    ):
+        """コンストラクタ
+
+        Args:
+            predictor (SamPredictorWrapper): SAM推論インスタンス
+            points_per_side (int): 格子の一辺あたりのポイント数（画像全体で points_per_side ** 2 個）
+            points_per_batch (int): マスクデコーダに一度に与えるポイント数
+                大きいほどデコーダの呼び出し回数が減るが、メモリ使用量が増える
+            pred_iou_thresh (float): 予測IoUのしきい値（これ未満の候補は捨てる）
+            stability_score_thresh (float): 安定度スコアのしきい値（これ未満の候補は捨てる）
+            stability_score_offset (float): 安定度スコア算出時にしきい値を上下させる幅（ロジット）
+            box_nms_thresh (float): NMSで重複とみなすバウンディングボックスのIoU
+            min_mask_area (int): 候補の最小面積（元画像のピクセル数、これ未満の候補は捨てる）
+            max_proposals (int): 返す候補数の上限（0以下の場合は制限しない）
+            upsample_batch_size (int): 元画像サイズへのアップサンプリングを一度に行う数
+        """
+        self._predictor = predictor
+        self._points_per_batch = max(points_per_batch, 1)
+        self._pred_iou_thresh = pred_iou_thresh
+        self._stability_score_thresh = stability_score_thresh
+        self._stability_score_offset = stability_score_offset
+        self._box_nms_thresh = box_nms_thresh
+        self._min_mask_area = min_mask_area
+        self._max_proposals = max_proposals
+        self._upsample_batch_size = upsample_batch_size
+
+        # 正規化座標（0〜1）の格子点 (N, 2)
+        self._point_grid = build_point_grid(points_per_side)
+
+    @torch.no_grad()
+    def propose(
+        self,
+        embedding: ImageEmbedding,
+    ) -> list:
+        """マスク候補の生成
+
+        Args:
+            embedding (ImageEmbedding): 画像埋め込み
+
+        Returns:
+            list: マスク候補（MaskProposal）のリスト（予測IoUの高い順）
+        """
+        img_h, img_w = embedding.original_size
+        input_h, input_w = embedding.input_size
+        points = self._point_grid * np.array([[img_w, img_h]], np.float32)
+
+        # 低解像度ロジット (256x256) のうち画像に対応する範囲と、元画像への倍率
+        low_res_h = math.ceil(input_h / 4)
+        low_res_w = math.ceil(input_w / 4)
+        scale = torch.tensor(
+            [img_w / low_res_w, img_h / low_res_h] * 2,
+            dtype=torch.float32,
+        )
+
+        kept_logits = []
+        kept_ious = []
+        kept_stability = []
+        kept_boxes = []
+        kept_points = []
+        for start in range(0, len(points), self._points_per_batch):
+            batch_points = points[start:start + self._points_per_batch]
+
+            # 各ポイントを単独の前景プロンプトとして複数マスク出力でデコードする
+            low_res_masks, iou_predictions = self._predictor.decode_low_res(
+                embedding,
+                point_coords=batch_points[:, None, :],
+                point_labels=np.ones((len(batch_points), 1), np.int32),
+                multimask_output=True,
+            )
+            num_masks = low_res_masks.shape[1]
+            logits = low_res_masks.flatten(0, 1)
+            ious = iou_predictions.flatten()
+            batch_points = torch.as_tensor(
+                batch_points, device=ious.device).repeat_interleave(num_masks, dim=0)
+
+            # 予測IoUで選別
+            keep = ious > self._pred_iou_thresh
+            logits, ious, batch_points = logits[keep], ious[keep], batch_points[keep]
+
+            # 安定度で選別（パディング部分を除いた範囲で算出する）
+            stability = calculate_stability_score(
+                logits[:, :low_res_h, :low_res_w],
+                self._predictor.mask_threshold,
+                self._stability_score_offset,
+            )
+            keep = stability >= self._stability_score_thresh
+            logits, ious, stability = logits[keep], ious[keep], stability[keep]
+            batch_points = batch_points[keep]
+
+            boxes = batched_mask_to_box(
+                logits[:, :low_res_h, :low_res_w] > self._predictor.mask_threshold)
+
+            kept_logits.append(logits)
+            kept_ious.append(ious)
+            kept_stability.append(stability)
+            kept_boxes.append(boxes.float().cpu() * scale)
+            kept_points.append(batch_points)
+
+        if sum(len(x) for x in kept_ious) == 0:
+            return []
+
+        logits = torch.cat(kept_logits, dim=0)
+        ious = torch.cat(kept_ious, dim=0)
+        stability = torch.cat(kept_stability, dim=0)
+        boxes = torch.cat(kept_boxes, dim=0)
+        batch_points = torch.cat(kept_points, dim=0)
+
+        # バウンディングボックスのNMSで重複を除く（結果は予測IoUの高い順）
+        keep = nms(boxes, ious.cpu(), self._box_nms_thresh)
+        if self._max_proposals > 0 and self._min_mask_area <= 0:
+            keep = keep[:self._max_proposals]
+        keep = keep.to(logits.device)
+
+        masks = self._predictor.upsample_masks(
+            embedding,
+            logits[keep][:, None, :, :],
+            batch_size=self._upsample_batch_size,
+        )[:, 0]
+        ious = ious[keep].cpu().numpy()
+        stability = stability[keep].cpu().numpy()
+        batch_points = batch_points[keep].cpu().numpy()
+
+        proposals = []
+        for mask, iou, stab, point in zip(masks, ious, stability, batch_points):
+            area = int(mask.sum())
+            if area <= 0 or area < self._min_mask_area:
+                continue
+            ys, xs = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+            x0, y0, x1, y1 = xs[0], ys[0], xs[-1] + 1, ys[-1] + 1
+            proposals.append(MaskProposal(
+                mask=mask,
+                predicted_iou=float(iou),
+                stability_score=float(stab),
+                bbox=(int(x0), int(y0), int(x1 - x0), int(y1 - y0)),
+                area=area,
+                point=(float(point[0]), float(point[1])),
+            ))
+            if self._max_proposals > 0 and len(proposals) >= self._max_proposals:
+                break
+        return proposals
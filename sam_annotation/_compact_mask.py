@@ -0,0 +1,95 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass
+class CompactMask:
+    """マスクのコンパクト表現クラス
+
+    元画像サイズのマスクの代わりに、マスクのバウンディングボックスとその範囲で切り出したマスクを保持する
+    元画像サイズのマスクが必要な場合はto_full（またはnp.asarray）で展開する
+    """
+
+    # バウンディングボックス (x0, y0, x1, y1)（XYXY形式、x1・y1は範囲に含まない）
+    bbox: tuple = (0, 0, 0, 0)
+
+    # バウンディングボックスの範囲のマスク (y1 - y0, x1 - x0)（bool型）
+    mask: np.ndarray = None
+
+    # 元画像のサイズ (H, W)
+    image_size: tuple = None
+
+    @property
+    def shape(self) -> tuple:
+        """展開後のマスクのサイズ (H, W)"""
+        return tuple(self.image_size)
+
+    @property
+    def area(self) -> int:
+        """マスクの面積（ピクセル数）"""
+        return int(self.mask.sum()) if self.mask is not None else 0
+
+    @property
+    def nbytes(self) -> int:
+        """切り出したマスクのバイト数"""
+        return self.mask.nbytes if self.mask is not None else 0
+
+    def to_full(self) -> np.ndarray:
+        """元画像サイズのマスクに展開
+
+        Returns:
+            np.ndarray: マスク (H, W)（bool型）
+        """
+        full = np.zeros(self.shape, bool)
+        self.paste(full)
+        return full
+
+    def paste(
+        self,
+        dst: np.ndarray,
+    ) -> np.ndarray:
+        """元画像サイズの配列にマスクを書き込む
+
+        バウンディングボックスの範囲だけを書き換えるので、範囲外は呼び出し側でクリアしておくこと
+        表示用のマスク配列を使い回して、クリックごとに元画像サイズの配列を確保しないためのもの
+
+        Args:
+            dst (np.ndarray): 書き込み先 (H, W)
+
+        Returns:
+            np.ndarray: 書き込み先
+        """
+        assert tuple(dst.shape[:2]) == self.shape
+        x0, y0, x1, y1 = self.bbox
+        if x1 > x0 and y1 > y0:
+            dst[y0:y1, x0:x1] = self.mask
+        return dst
+
+    def translate(
+        self,
+        dx: int,
+        dy: int,
+        image_size: tuple,
+    ) -> "CompactMask":
+        """別の画像の座標に移したマスク（切り出した画像上のマスクを元画像に戻す場合など）
+
+        Args:
+            dx (int): X方向の移動量
+            dy (int): Y方向の移動量
+            image_size (tuple): 移動先の画像のサイズ (H, W)
+
+        Returns:
+            CompactMask: 移したマスク
+        """
+        x0, y0, x1, y1 = self.bbox
+        return CompactMask(
+            bbox=(x0 + dx, y0 + dy, x1 + dx, y1 + dy),
+            mask=self.mask,
+            image_size=tuple(image_size),
+        )
+
+    def __array__(self, dtype=None, copy=None):
+        """np.asarrayで元画像サイズのマスクに展開する（既存の呼び出し側との互換用）"""
+        full = self.to_full()
+        return full if dtype is None else full.astype(dtype)
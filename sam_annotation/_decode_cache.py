@@ -0,0 +1,160 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def make_decode_key(
+    embedding_key: str,
+    prompt: dict,
+    multimask_output: bool,
+    compact: bool = False,
+) -> str:
+    """マスクデコード結果のキャッシュキー生成
+
+    ポイントは座標とラベルの組で並べ替えて正規化する
+    （マスクデコーダはポイントの順序に依存しないので、同じポイントの集合なら同じ結果になる）
+
+    Args:
+        embedding_key (str): 画像埋め込みのキャッシュキー
+        prompt (dict): プロンプト（point_coords, point_labels, box）
+        multimask_output (bool): 複数マスク出力フラグ
+        compact (bool): コンパクト表現フラグ
+
+    Returns:
+        str: キャッシュキー
+    """
+    h = hashlib.sha1()
+    h.update(f"{embedding_key}:{int(multimask_output)}:{int(compact)}".encode())
+
+    if prompt["point_coords"] is not None:
+        coords = np.asarray(prompt["point_coords"], np.float64).reshape(-1, 2)
+        labels = np.asarray(prompt["point_labels"], np.float64).reshape(-1, 1)
+        points = np.round(np.concatenate([coords, labels], axis=1), 3)
+        points = points[np.lexsort(points.T[::-1])]
+        h.update(b"points:")
+        h.update(np.ascontiguousarray(points).tobytes())
+
+    if prompt["box"] is not None:
+        box = np.round(np.asarray(prompt["box"], np.float64).reshape(4), 3)
+        h.update(b"box:")
+        h.update(box.tobytes())
+
+    return h.hexdigest()
+
+
+class DecodeResultCache:
+    """マスクデコード結果のキャッシュクラス
+
+    同じ画像埋め込みとプロンプトでの再推論（同じ位置の再クリック、アンドゥ・リドゥ）で
+    マスクデコーダを実行しないためのもの
+    エントリ数または合計バイト数が上限を超えたら最も古く参照されたものから破棄する（LRU）
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 32,
+        max_bytes: int = 256 << 20,
+    ):
+        """コンストラクタ
+
+        Args:
+            max_entries (int): 保持するエントリ数の上限（0の場合はキャッシュしない）
+            max_bytes (int): 保持する結果の合計サイズ上限（バイト）
+        """
+        self._lock = threading.RLock()
+
+        # エントリ数上限
+        self._max_entries = max_entries
+
+        # 合計サイズ上限
+        self._max_bytes = max_bytes
+
+        # キーと (結果, バイト数) の対応マップ（参照が古い順）
+        self._key_to_result = OrderedDict()
+
+        # 合計サイズ
+        self._total_bytes = 0
+
+        # ヒット数・ミス数
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def stats(self) -> dict:
+        """キャッシュの統計情報（エントリ数、合計バイト数、ヒット数、ミス数）"""
+        with self._lock:
+            return {
+                "entries": len(self._key_to_result),
+                "bytes": self._total_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+            }
+
+    @staticmethod
+    def _nbytes(result: tuple) -> int:
+        """結果のバイト数"""
+        nbytes = 0
+        for value in result:
+            if isinstance(value, np.ndarray):
+                nbytes += value.nbytes
+            elif isinstance(value, list):
+                nbytes += sum(getattr(x, "nbytes", 0) for x in value)
+        return nbytes
+
+    def get(
+        self,
+        key: str,
+    ) -> tuple:
+        """キャッシュから結果を取得
+
+        Returns:
+            tuple: (マスク, スコア, 低解像度ロジット)（キャッシュに無いときはNone）
+        """
+        with self._lock:
+            entry = self._key_to_result.get(key, None)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            self._key_to_result.move_to_end(key)
+            return entry[0]
+
+    def put(
+        self,
+        key: str,
+        result: tuple,
+    ):
+        """結果をキャッシュに追加
+
+        Args:
+            key (str): キャッシュキー
+            result (tuple): (マスク, スコア, 低解像度ロジット)
+        """
+        nbytes = self._nbytes(result)
+        with self._lock:
+            # 単体で上限を超えるものは保持しない
+            if self._max_entries <= 0 or nbytes > self._max_bytes:
+                return
+
+            self._remove(key)
+            self._key_to_result[key] = (result, nbytes)
+            self._total_bytes += nbytes
+
+            while (len(self._key_to_result) > self._max_entries
+                   or self._total_bytes > self._max_bytes):
+                self._remove(next(iter(self._key_to_result)))
+
+    def _remove(self, key: str):
+        """指定キーの結果を破棄"""
+        with self._lock:
+            entry = self._key_to_result.pop(key, None)
+            if entry is not None:
+                self._total_bytes -= entry[1]
+
+    def clear(self):
+        """全ての結果を破棄"""
+        with self._lock:
+            self._key_to_result.clear()
+            self._total_bytes = 0
@@ -0,0 +1,392 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from . import _utils
+from ._logger import Logger
+
+
+@dataclass
+class ImageEmbedding:
+    """画像埋め込み情報クラス
+
+    SamPredictorが画像エンコード後に保持する情報（特徴量と変換メタデータ）をまとめたもの
+    """
+
+    # 画像エンコーダの出力特徴量 (1, C, H, W)
+    features: torch.Tensor = None
+
+    # 元画像のサイズ (H, W)
+    original_size: tuple = None
+
+    # リサイズ後の入力画像サイズ (H, W)
+    input_size: tuple = None
+
+    # キャッシュキー
+    key: str = ""
+
+    @property
+    def nbytes(self) -> int:
+        """特徴量のバイト数"""
+        if self.features is None:
+            return 0
+        return self.features.element_size() * self.features.nelement()
+
+
+# 前処理の版（前処理の実装が変わって特徴量が変わる場合に更新する）
+# "cv2-reduced": ファイル情報のキーの画像埋め込みは常に縮小デコードした画像から作る
+_PREPROCESS_VERSION = "cv2-reduced"
+
+
+def _model_hash(
+    model_type: str,
+    checkpoint: str,
+    input_size: int,
+    precision: str,
+):
+    """モデルの条件を入れたハッシュオブジェクト"""
+    # チェックポイントはファイル名とサイズで識別する
+    h = hashlib.sha1()
+    h.update(f"{model_type}:{_utils.checkpoint_tag(checkpoint)}:{precision}".encode())
+    h.update(f"{input_size}:{_PREPROCESS_VERSION}".encode())
+    return h
+
+
+def make_embedding_key(
+    img: np.ndarray,
+    img_format: str,
+    model_type: str,
+    checkpoint: str,
+    input_size: int,
+    precision: str = "fp32",
+) -> str:
+    """画像埋め込みのキャッシュキー生成
+
+    画像の内容とモデルの条件からハッシュ値を算出する
+
+    Args:
+        img (np.ndarray): 画像
+        img_format (str): 画像フォーマット（'RGB' or 'BGR'）
+        model_type (str): モデルタイプ（"vit_h", "vit_l", or "vit_b"）
+        checkpoint (str): モデルの重みパラメータファイルへのパス
+        input_size (int): 画像エンコーダの入力サイズ（長辺）
+        precision (str): 推論精度（精度ごとに特徴量が異なるので区別する）
+
+    Returns:
+        str: キャッシュキー
+    """
+    h = _model_hash(model_type, checkpoint, input_size, precision)
+    h.update(f"{img_format}:{img.shape}:{img.dtype}".encode())
+    h.update(np.ascontiguousarray(img).data)
+    return h.hexdigest()
+
+
+def make_file_embedding_key(
+    img_path: str,
+    model_type: str,
+    checkpoint: str,
+    input_size: int,
+    precision: str = "fp32",
+) -> str:
+    """画像ファイルの画像埋め込みのキャッシュキー生成
+
+    画素値の代わりにファイルのパス・サイズ・更新日時を使うので、
+    画像を読み込まずにキャッシュを探せる（大きな画像の全画素のハッシュ計算も不要になる）
+
+    Args:
+        img_path (str): 画像ファイルパス
+        model_type (str): モデルタイプ（"vit_h", "vit_l", or "vit_b"）
+        checkpoint (str): モデルの重みパラメータファイルへのパス
+        input_size (int): 画像エンコーダの入力サイズ（長辺）
+        precision (str): 推論精度
+
+    Returns:
+        str: キャッシュキー
+    """
+    img_path_ = Path(img_path).absolute()
+    stat = img_path_.stat()
+
+    h = _model_hash(model_type, checkpoint, input_size, precision)
+    h.update(f"file:{img_path_}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+class DiskEmbeddingCache:
+    """画像埋め込みのディスクキャッシュクラス
+
+    キャッシュディレクトリの合計サイズが上限を超えたら最も古く参照されたものから削除する（LRU）
+    キャッシュディレクトリは複数のプロセスで共有できる
+    他のプロセスが保存したキャッシュも参照し、サイズ上限は保存のたびにディレクトリを走査し直して
+    ディレクトリ全体に対して適用する（参照順はファイルの更新時刻で共有する）
+    """
+
+    # キャッシュファイルの拡張子
+    _EXT = ".pt"
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_bytes: int = 1 << 30,
+    ):
+        """コンストラクタ
+
+        Args:
+            cache_dir (str): キャッシュディレクトリ
+            max_bytes (int): キャッシュの合計サイズ上限（バイト）
+        """
+        self._lock = threading.RLock()
+
+        # キャッシュディレクトリ
+        self._cache_dir = Path(cache_dir)
+
+        # 合計サイズ上限
+        self._max_bytes = max_bytes
+
+        # キーとファイルサイズの対応マップ（参照が古い順）
+        self._key_to_size = OrderedDict()
+
+        # 合計サイズ
+        self._total_bytes = 0
+
+        self._initialize()
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes
+
+    def _initialize(self):
+        """初期化"""
+        with self._lock:
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+            self._scan()
+            self._evict()
+
+    def _scan(self):
+        """キャッシュディレクトリを走査してキーとファイルサイズの対応マップを作り直す
+
+        既存のキャッシュファイルを最終参照時刻の古い順に登録する
+        （他のプロセスが保存・参照したファイルも含め、走査中に削除されたファイルは登録しない）
+        """
+        with self._lock:
+            stats = []
+            for file in self._cache_dir.glob(f"*{self._EXT}"):
+                try:
+                    stats.append((file, file.stat()))
+                except OSError:
+                    continue
+            stats.sort(key=lambda x: x[1].st_mtime)
+
+            self._key_to_size.clear()
+            self._total_bytes = 0
+            for file, stat in stats:
+                self._key_to_size[file.stem] = stat.st_size
+                self._total_bytes += stat.st_size
+
+    def _path(self, key: str) -> Path:
+        return self._cache_dir / f"{key}{self._EXT}"
+
+    def get(
+        self,
+        key: str,
+        device: str,
+    ) -> ImageEmbedding:
+        """キャッシュから画像埋め込みを取得
+
+        Args:
+            key (str): キャッシュキー
+            device (str): 特徴量の配置先デバイス
+
+        Returns:
+            ImageEmbedding: 画像埋め込み（キャッシュに無いときはNone）
+        """
+        with self._lock:
+            path = self._path(key)
+            if key not in self._key_to_size:
+                # 他のプロセスが保存したキャッシュファイルがあれば登録する
+                try:
+                    size = path.stat().st_size
+                except OSError:
+                    return None
+                self._key_to_size[key] = size
+                self._total_bytes += size
+
+            try:
+                data = torch.load(path, map_location=device)
+            except OSError:
+                # キャッシュディレクトリを共有する他のプロセスが削除した場合はキャッシュミスとして扱う
+                self._total_bytes -= self._key_to_size.pop(key, 0)
+                return None
+            except Exception as e:
+                # 壊れたキャッシュファイルは削除する
+                Logger.warn(f"Failed to load embedding cache. {path=}, {e=}")
+                self._remove(key)
+                return None
+
+            # 参照時刻を更新してLRUの末尾に移動
+            try:
+                os.utime(path)
+            except OSError:
+                # 読み込み後に削除された場合も読み込んだ特徴量はそのまま使う
+                pass
+            self._key_to_size.move_to_end(key)
+
+            return ImageEmbedding(
+                features=data["features"],
+                original_size=tuple(data["original_size"]),
+                input_size=tuple(data["input_size"]),
+                key=key,
+            )
+
+    def put(
+        self,
+        embedding: ImageEmbedding,
+    ):
+        """画像埋め込みをキャッシュに保存
+
+        Args:
+            embedding (ImageEmbedding): 画像埋め込み
+        """
+        with self._lock:
+            key = embedding.key
+            data = {
+                "features": embedding.features.detach().cpu(),
+                "original_size": tuple(embedding.original_size),
+                "input_size": tuple(embedding.input_size),
+            }
+
+            path = self._path(key)
+            try:
+                _utils.atomic_save(path, lambda tmp_path: torch.save(data, tmp_path))
+            except OSError as e:
+                Logger.warn(f"Failed to save embedding cache. {path=}, {e=}")
+                return
+
+            # 他のプロセスが保存・削除した分も含めてディレクトリ全体のサイズで上限を判定する
+            self._scan()
+            if key in self._key_to_size:
+                self._key_to_size.move_to_end(key)
+
+            self._evict()
+
+    def _remove(self, key: str):
+        """キャッシュファイルの削除"""
+        with self._lock:
+            self._total_bytes -= self._key_to_size.pop(key, 0)
+            try:
+                self._path(key).unlink()
+            except OSError:
+                # 他のプロセスが削除済み、または読み込み中で削除できない場合はそのままにする
+                pass
+
+    def _evict(self):
+        """上限サイズを超えた分を古い順に削除"""
+        with self._lock:
+            while self._key_to_size and self._total_bytes > self._max_bytes:
+                key = next(iter(self._key_to_size))
+                self._remove(key)
+
+
+class MemoryEmbeddingCache:
+    """画像埋め込みのメモリキャッシュクラス
+
+    エントリ数または合計バイト数が上限を超えたら最も古く参照されたものから破棄する（LRU）
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 256 << 20,
+        max_entries: int = 8,
+    ):
+        """コンストラクタ
+
+        Args:
+            max_bytes (int): 特徴量の合計サイズ上限（バイト）
+            max_entries (int): 保持するエントリ数の上限
+        """
+        self._lock = threading.RLock()
+
+        # 合計サイズ上限
+        self._max_bytes = max_bytes
+
+        # エントリ数上限
+        self._max_entries = max_entries
+
+        # キーと画像埋め込みの対応マップ（参照が古い順）
+        self._key_to_embedding = OrderedDict()
+
+        # 合計サイズ
+        self._total_bytes = 0
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes
+
+    def __len__(self):
+        with self._lock:
+            return len(self._key_to_embedding)
+
+    def __contains__(self, key: str):
+        with self._lock:
+            return key in self._key_to_embedding
+
+    def get(
+        self,
+        key: str,
+    ) -> ImageEmbedding:
+        """キャッシュから画像埋め込みを取得
+
+        Args:
+            key (str): キャッシュキー
+
+        Returns:
+            ImageEmbedding: 画像埋め込み（キャッシュに無いときはNone）
+        """
+        with self._lock:
+            embedding = self._key_to_embedding.get(key, None)
+            if embedding is not None:
+                self._key_to_embedding.move_to_end(key)
+            return embedding
+
+    def put(
+        self,
+        embedding: ImageEmbedding,
+    ):
+        """画像埋め込みをキャッシュに追加
+
+        Args:
+            embedding (ImageEmbedding): 画像埋め込み
+        """
+        with self._lock:
+            # 単体で上限を超えるものは保持しない
+            if embedding.nbytes > self._max_bytes or self._max_entries <= 0:
+                return
+
+            self.remove(embedding.key)
+            self._key_to_embedding[embedding.key] = embedding
+            self._total_bytes += embedding.nbytes
+
+            while (len(self._key_to_embedding) > self._max_entries
+                   or self._total_bytes > self._max_bytes):
+                key = next(iter(self._key_to_embedding))
+                self.remove(key)
+
+    def remove(self, key: str):
+        """指定キーの画像埋め込みを破棄"""
+        with self._lock:
+            embedding = self._key_to_embedding.pop(key, None)
+            if embedding is not None:
+                self._total_bytes -= embedding.nbytes
+
+    def clear(self):
+        """全ての画像埋め込みを破棄"""
+        with self._lock:
+            self._key_to_embedding.clear()
+            self._total_bytes = 0
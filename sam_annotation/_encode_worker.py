@@ -0,0 +1,269 @@
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from ._logger import Logger
+
+
+class EncodeCancelledError(RuntimeError):
+    """画像エンコードの中断例外"""
+    pass
+
+
+class EncodeWorker:
+    """画像エンコードのワーカークラス
+
+    1つのワーカースレッドで画像エンコードのジョブを順に実行する
+    対話ジョブは最新の1件だけを保持し（latest-wins）、未実行のまま置き換えられたものは破棄する
+    対話タスク（ROIモードのタイルなど、推論要求に付随するエンコード）は置き換えずに登録順に実行し、結果をFutureで返す
+    対話タスクは実行中の対話ジョブにも割り込み、中断された対話ジョブはタスクの完了後に最初から実行し直す
+    バックグラウンドジョブ（先読みなど）は対話ジョブと対話タスクが無いときだけ実行する
+
+    ジョブは job(cancel_fn) の形式の関数で、cancel_fn()がTrueを返したら
+    EncodeCancelledErrorを送出して中断してよい
+    """
+
+    def __init__(self):
+        """コンストラクタ"""
+        self._lock = threading.RLock()
+
+        # ジョブ追加通知
+        self._cond = threading.Condition(self._lock)
+
+        # 未実行の対話ジョブ（最新の1件のみ）
+        self._interactive_job = None
+
+        # 未実行の対話タスクと結果のFutureのキュー
+        self._tasks = deque()
+
+        # 未実行のバックグラウンドジョブのキュー（先頭ほど優先度が高い）
+        self._background_jobs = deque()
+
+        # バックグラウンドジョブの登録世代（登録し直されたら古いジョブは再実行しない）
+        self._background_generation = 0
+
+        # 実行中のジョブがあるか
+        self._busy = False
+
+        # 統計情報
+        self._stats = {
+            # 登録された対話ジョブ数
+            "submitted": 0,
+            # 実行前に新しい対話ジョブで置き換えられて破棄された数
+            "dropped": 0,
+            # 実行中に中断された数
+            "cancelled": 0,
+            # 対話タスクの割り込みで中断され、再登録された対話ジョブ数
+            "preempted": 0,
+            # 完了したバックグラウンドジョブ数
+            "background_done": 0,
+        }
+
+        # ワーカースレッド
+        self._alive = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def stats(self) -> dict:
+        with self._lock:
+            return self._stats.copy()
+
+    @property
+    def has_pending_interactive(self) -> bool:
+        """未実行の対話ジョブがあるか"""
+        with self._lock:
+            return self._interactive_job is not None
+
+    def submit(
+        self,
+        job,
+    ):
+        """対話ジョブの登録
+
+        未実行の対話ジョブがあれば破棄して置き換える
+        実行中のジョブには中断を要求する
+
+        Args:
+            job (callable): ジョブ関数 job(cancel_fn)
+        """
+        with self._cond:
+            if self._interactive_job is not None:
+                self._stats["dropped"] += 1
+            self._interactive_job = job
+            self._stats["submitted"] += 1
+            self._cond.notify()
+
+    def submit_task(
+        self,
+        job,
+    ) -> Future:
+        """対話タスクの登録
+
+        対話ジョブとバックグラウンドジョブより優先し、実行中のジョブには中断を要求する
+        中断された対話ジョブは、新しい対話ジョブで置き換えられていなければタスクの完了後に実行し直す
+        タスク自身の中断条件はジョブ関数側で判定すること（渡されるcancel_fnはワーカー停止時のみTrueになる）
+
+        Args:
+            job (callable): ジョブ関数 job(cancel_fn)
+
+        Returns:
+            Future: ジョブ関数の戻り値（中断された場合はEncodeCancelledError）
+        """
+        future = Future()
+        with self._cond:
+            if not self._alive:
+                future.set_exception(EncodeCancelledError())
+                return future
+            self._tasks.append((job, future))
+            self._cond.notify()
+        return future
+
+    def schedule_background(
+        self,
+        jobs: list,
+    ):
+        """バックグラウンドジョブの登録
+
+        未実行のバックグラウンドジョブは破棄して、指定のジョブリストで置き換える
+
+        Args:
+            jobs (list): ジョブ関数のリスト（先頭ほど優先度が高い）
+        """
+        with self._cond:
+            self._background_jobs.clear()
+            self._background_jobs.extend(jobs)
+            self._background_generation += 1
+            self._cond.notify()
+
+    def wait_idle(
+        self,
+        timeout: float = None,
+    ) -> bool:
+        """全てのジョブが終わるまで待機
+
+        Args:
+            timeout (float): タイムアウト（秒）
+
+        Returns:
+            bool: タイムアウトせずに全てのジョブが終わったか
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: (not self._busy
+                         and self._interactive_job is None
+                         and not self._tasks
+                         and not self._background_jobs),
+                timeout=timeout,
+            )
+
+    def stop(
+        self,
+        wait: bool = False,
+    ):
+        """ワーカースレッドの停止
+
+        未実行のジョブは破棄し、実行中のジョブには中断を要求する
+
+        Args:
+            wait (bool): ワーカースレッドの終了を待つか（ワーカースレッド自身からの呼び出しでは待たない）
+        """
+        with self._cond:
+            self._alive = False
+            self._interactive_job = None
+            self._background_jobs.clear()
+            while self._tasks:
+                _, future = self._tasks.popleft()
+                future.set_exception(EncodeCancelledError())
+            self._cond.notify_all()
+
+        if wait and not self.is_worker_thread():
+            self._thread.join()
+
+    def is_worker_thread(self) -> bool:
+        """呼び出し元がワーカースレッドか"""
+        return threading.current_thread() is self._thread
+
+    def _has_pending_foreground(self) -> bool:
+        """未実行の対話ジョブか対話タスクがあるか、停止が要求されたか（実行中のジョブの中断判定）"""
+        with self._lock:
+            return (not self._alive
+                    or self._interactive_job is not None
+                    or len(self._tasks) > 0)
+
+    def _run(self):
+        """ワーカースレッド関数"""
+        while True:
+            with self._cond:
+                while (self._alive
+                       and self._interactive_job is None
+                       and not self._tasks
+                       and not self._background_jobs):
+                    self._cond.wait()
+                if not self._alive:
+                    return
+
+                # 推論を待たせている対話タスク、対話ジョブ、バックグラウンドジョブの順に優先する
+                future = None
+                if self._tasks:
+                    job, future = self._tasks.popleft()
+                    is_background = False
+                elif self._interactive_job is not None:
+                    job = self._interactive_job
+                    self._interactive_job = None
+                    is_background = False
+                else:
+                    job = self._background_jobs.popleft()
+                    is_background = True
+                generation = self._background_generation
+                self._busy = True
+
+            if future is not None:
+                self._run_task(job, future)
+                continue
+
+            try:
+                # 新しい対話ジョブか対話タスクが登録されたら実行中のジョブは中断する
+                job(self._has_pending_foreground)
+                with self._cond:
+                    if is_background:
+                        self._stats["background_done"] += 1
+            except EncodeCancelledError:
+                with self._cond:
+                    if not is_background and self._alive and self._interactive_job is None:
+                        # 対話タスクに割り込まれた対話ジョブはタスクの後で実行し直す
+                        self._interactive_job = job
+                        self._stats["preempted"] += 1
+                        continue
+                    self._stats["cancelled"] += 1
+                    if (is_background
+                            and self._alive
+                            and generation == self._background_generation):
+                        # 中断されたバックグラウンドジョブは後で再実行する
+                        self._background_jobs.appendleft(job)
+            except Exception as e:
+                Logger.warn(f"Failed to run encode job. {e=}")
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _run_task(
+        self,
+        job,
+        future: Future,
+    ):
+        """対話タスクの実行"""
+        try:
+            if future.set_running_or_notify_cancel():
+                future.set_result(job(lambda: not self._alive))
+        except EncodeCancelledError as e:
+            with self._cond:
+                self._stats["cancelled"] += 1
+            future.set_exception(e)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
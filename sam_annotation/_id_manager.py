@@ -5,6 +5,8 @@ class IDManager:
     def __init__(self):
         self._thread = threading.RLock()
         self._ids = []
+        # 登録済みIDの集合（存在判定を O(1) にするため）
+        self._id_set = set()
         self._id = 1
         
     @property
@@ -15,34 +17,33 @@ class IDManager:
         """ID生成"""
         with self._thread:
             # 未存在のIDを探索
-            while self._id in self._ids:
+            while self._id in self._id_set:
                 self._id += 1
             self.push_id(self._id)
             return self._id
 
     def add_id(self, id_: int):
         """指定IDを末尾に追加"""
-        with self._thread:
-            if id_ in self._ids:
-                raise ValueError
-            self._ids.append(id_)
+        self.push_id(id_)
 
     def remove_id(self, id_: int):
-        """末尾のIDを削除"""
+        """指定IDを削除"""
         with self._thread:
+            self._id_set.remove(id_)
             self._ids.remove(id_)
        
     def push_id(self, id_: int):
         """指定IDを末尾に追加"""
         with self._thread:
-            if id_ in self._ids:
+            if id_ in self._id_set:
                 raise ValueError
             self._ids.append(id_)
+            self._id_set.add(id_)
 
     def pop_id(self):
         """末尾のIDを削除"""
         with self._thread:
-            del self._ids[-1]
+            self._id_set.discard(self._ids.pop())
 
 
     # TODO 適切なデータ構造を検討（スタック、FIFO、ツリーなどが考えられる）
\ No newline at end of file
@@ -0,0 +1,199 @@
+import warnings
+from pathlib import Path
+
+import numpy as np
+import torch
+from segment_anything.modeling import Sam
+from segment_anything.utils.transforms import ResizeLongestSide
+
+from . import _utils
+from ._logger import Logger
+from ._embedding_cache import ImageEmbedding
+
+
+class OnnxMaskDecoder:
+    """ONNX Runtimeで実行するプロンプトエンコーダ・マスクデコーダクラス
+
+    SAMのプロンプトエンコーダとマスクデコーダを一度だけONNXにエクスポートし、
+    以降はonnxruntime（CPU）で推論する
+    小さなデコーダをPyTorchのeager実行で動かす際のディスパッチのオーバーヘッドを避けるためのもの
+    元画像サイズへのアップサンプリングはモデルに含めず、低解像度のロジットとスコアだけを出力する
+    （大きな画像で全マスクを元画像サイズに拡大しないように、呼び出し側で必要なマスクだけ拡大する）
+    """
+
+    # エクスポート時のONNXのopsetバージョン
+    _OPSET_VERSION = 17
+
+    def __init__(
+        self,
+        sam: Sam,
+        checkpoint: str,
+        model_dir: str,
+    ):
+        """コンストラクタ
+
+        Args:
+            sam (Sam): Samインスタンス
+            checkpoint (str): モデルの重みパラメータファイルへのパス（エクスポート先のファイル名に使う）
+            model_dir (str): エクスポートしたONNXモデルの保存先ディレクトリ
+        """
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise RuntimeError(
+                "onnxruntime is required for the ONNX decoder backend.") from e
+
+        self._transform = ResizeLongestSide(sam.image_encoder.img_size)
+
+        # マスク入力は使わないので固定の入力を作っておく
+        mask_input_size = [4 * x for x in sam.prompt_encoder.image_embedding_size]
+        self._mask_input = np.zeros((1, 1, *mask_input_size), np.float32)
+        self._has_mask_input = np.zeros((1,), np.float32)
+
+        path = self._model_path(checkpoint, model_dir)
+        if not path.exists():
+            self._export(sam, path)
+
+        self._session = onnxruntime.InferenceSession(
+            str(path),
+            providers=["CPUExecutionProvider"],
+        )
+
+        # 直前の画像埋め込みのnumpy変換結果（同じ画像へのクリックごとに変換しないため）
+        self._last_embedding: ImageEmbedding = None
+        self._last_features: np.ndarray = None
+
+    @staticmethod
+    def _model_path(
+        checkpoint: str,
+        model_dir: str,
+    ) -> Path:
+        """ONNXモデルの保存先パス（以前の元画像サイズまで出力するモデルとは別のファイル）"""
+        return Path(model_dir) / f"{_utils.checkpoint_tag(checkpoint)}_decoder_low_res.onnx"
+
+    @classmethod
+    def _export(
+        cls,
+        sam: Sam,
+        path: Path,
+    ):
+        """プロンプトエンコーダとマスクデコーダのONNXエクスポート
+
+        単一マスク出力と複数マスク出力の両方を使えるように全てのマスクを出力するモデルにする
+        出力は低解像度のロジットとスコアのみ（SamOnnxModelのアップサンプリングと入力orig_im_sizeを除く）
+        """
+        from segment_anything.utils.onnx import SamOnnxModel
+
+        class _LowResOnnxModel(SamOnnxModel):
+            """元画像サイズへのアップサンプリングを除いたSamOnnxModel"""
+
+            def forward(self, image_embeddings, point_coords, point_labels, mask_input, has_mask_input):
+                sparse_embedding = self._embed_points(point_coords, point_labels)
+                dense_embedding = self._embed_masks(mask_input, has_mask_input)
+                masks, scores = self.model.mask_decoder.predict_masks(
+                    image_embeddings=image_embeddings,
+                    image_pe=self.model.prompt_encoder.get_dense_pe(),
+                    sparse_prompt_embeddings=sparse_embedding,
+                    dense_prompt_embeddings=dense_embedding,
+                )
+                return masks, scores
+
+        onnx_model = _LowResOnnxModel(sam, return_single_mask=False)
+
+        embed_dim = sam.prompt_encoder.embed_dim
+        embed_size = sam.prompt_encoder.image_embedding_size
+        mask_input_size = [4 * x for x in embed_size]
+        dummy_inputs = {
+            "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float),
+            "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float),
+            "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float),
+            "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float),
+            "has_mask_input": torch.tensor([1], dtype=torch.float),
+        }
+
+        def _write(tmp_path):
+            with warnings.catch_warnings():
+                warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
+                warnings.filterwarnings("ignore", category=UserWarning)
+                with open(tmp_path, "wb") as fp:
+                    torch.onnx.export(
+                        onnx_model,
+                        tuple(dummy_inputs.values()),
+                        fp,
+                        export_params=True,
+                        verbose=False,
+                        opset_version=cls._OPSET_VERSION,
+                        do_constant_folding=True,
+                        input_names=list(dummy_inputs.keys()),
+                        output_names=["low_res_masks", "iou_predictions"],
+                        dynamic_axes={
+                            "point_coords": {1: "num_points"},
+                            "point_labels": {1: "num_points"},
+                        },
+                    )
+
+        _utils.atomic_save(path, _write)
+        Logger.info(f"Export ONNX decoder. {path=}")
+
+    def _features(
+        self,
+        embedding: ImageEmbedding,
+    ) -> np.ndarray:
+        """画像埋め込みのnumpy配列"""
+        if embedding is not self._last_embedding:
+            self._last_features = embedding.features.detach().float().cpu().numpy()
+            self._last_embedding = embedding
+        return self._last_features
+
+    def decode_low_res(
+        self,
+        embedding: ImageEmbedding,
+        point_coords: np.ndarray = None,
+        point_labels: np.ndarray = None,
+        box: np.ndarray = None,
+        multimask_output: bool = False,
+    ) -> tuple:
+        """単一プロンプトのマスクデコード（元画像サイズへのアップサンプリングなし）
+
+        Args:
+            embedding (ImageEmbedding): 画像埋め込み
+            point_coords (np.ndarray): ポイントの座標 (N, 2)
+            point_labels (np.ndarray): ポイントのラベル (N,)
+            box (np.ndarray): ボックス (4,)（XYXY形式）
+            multimask_output (bool): 複数マスク出力フラグ
+
+        Returns:
+            tuple: 低解像度ロジット (C, 256, 256)、スコア (C,)
+        """
+        coords = []
+        labels = []
+        if point_coords is not None:
+            coords.append(np.asarray(point_coords, np.float32).reshape(-1, 2))
+            labels.append(np.asarray(point_labels, np.float32).reshape(-1))
+        if box is not None:
+            # ボックスは左上（ラベル2）と右下（ラベル3）のポイントとして与える
+            coords.append(np.asarray(box, np.float32).reshape(2, 2))
+            labels.append(np.array([2, 3], np.float32))
+        else:
+            # ボックスが無いときはパディング用のポイント（ラベル-1）を加える
+            coords.append(np.zeros((1, 2), np.float32))
+            labels.append(np.array([-1], np.float32))
+
+        coords = np.concatenate(coords, axis=0)
+        labels = np.concatenate(labels, axis=0)
+        coords = self._transform.apply_coords(coords, embedding.original_size)
+
+        logits, scores = self._session.run(
+            None,
+            {
+                "image_embeddings": self._features(embedding),
+                "point_coords": coords[None, :, :].astype(np.float32),
+                "point_labels": labels[None, :],
+                "mask_input": self._mask_input,
+                "has_mask_input": self._has_mask_input,
+            },
+        )
+
+        # 先頭が単一マスク出力、残りが複数マスク出力
+        idx = slice(1, None) if multimask_output else slice(0, 1)
+        return logits[0, idx], scores[0, idx]
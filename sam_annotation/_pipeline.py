@@ -0,0 +1,234 @@
+import queue
+import threading
+import time
+
+# ステージ間でデータ終端を伝えるための番兵
+_END = object()
+
+
+class PipelineStage:
+    """パイプラインのステージクラス
+
+    入力キューから取り出したデータを処理関数に渡し、結果を出力キューに入れる
+    複数のワーカースレッドで並列に処理できる（出力の順序は保証しない）
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn,
+        num_workers: int = 1,
+        batch_size: int = 1,
+    ):
+        """コンストラクタ
+
+        Args:
+            name (str): ステージ名
+            fn (callable): 処理関数
+                batch_size == 1 の場合は fn(item) -> result
+                batch_size > 1 の場合は fn(items: list) -> list
+                結果がNoneの場合は次のステージに渡さない
+            num_workers (int): ワーカースレッド数
+            batch_size (int): 一度に処理する最大のデータ数
+        """
+        self._lock = threading.RLock()
+
+        self.name = name
+        self._fn = fn
+        self._num_workers = max(num_workers, 1)
+        self._batch_size = max(batch_size, 1)
+
+        # 入出力キュー（Pipelineで設定する）
+        self._in_queue: queue.Queue = None
+        self._out_queue: queue.Queue = None
+
+        # 処理中だったワーカーの合計時間（秒）
+        self._busy_sec = 0.0
+
+        # 処理したデータ数
+        self._num_items = 0
+
+        # 終了していないワーカー数
+        self._num_alive = 0
+
+        # 処理中に発生した例外
+        self.error: Exception = None
+
+        self._threads = []
+
+    @property
+    def num_workers(self) -> int:
+        return self._num_workers
+
+    @property
+    def busy_sec(self) -> float:
+        with self._lock:
+            return self._busy_sec
+
+    @property
+    def num_items(self) -> int:
+        with self._lock:
+            return self._num_items
+
+    def start(
+        self,
+        in_queue: queue.Queue,
+        out_queue: queue.Queue,
+    ):
+        """ワーカースレッドの開始"""
+        self._in_queue = in_queue
+        self._out_queue = out_queue
+        self._num_alive = self._num_workers
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                name=f"{self.name}_{i}",
+                daemon=True,
+            )
+            for i in range(self._num_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def join(self):
+        """ワーカースレッドの終了待ち"""
+        for thread in self._threads:
+            thread.join()
+
+    def _get_batch(self) -> tuple:
+        """入力キューからデータを取り出す
+
+        Returns:
+            tuple: データのリスト、終端に達したか
+        """
+        item = self._in_queue.get()
+        if item is _END:
+            return [], True
+
+        items = [item]
+        while len(items) < self._batch_size:
+            try:
+                item = self._in_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _END:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def _run(self):
+        """ワーカースレッド関数"""
+        while True:
+            items, end = self._get_batch()
+
+            # 例外発生後は上流が詰まらないように読み捨てる
+            if items and self.error is None:
+                t0 = time.perf_counter()
+                try:
+                    if self._batch_size > 1:
+                        results = self._fn(items)
+                    else:
+                        results = [self._fn(items[0])]
+                except Exception as e:
+                    self.error = e
+                    results = []
+                sec = time.perf_counter() - t0
+
+                with self._lock:
+                    self._busy_sec += sec
+                    self._num_items += len(items)
+
+                for result in results:
+                    if result is not None and self._out_queue is not None:
+                        self._out_queue.put(result)
+
+            if end:
+                # 他のワーカーにも終端を伝え、最後のワーカーが次のステージに伝える
+                self._in_queue.put(_END)
+                with self._lock:
+                    self._num_alive -= 1
+                    is_last = self._num_alive == 0
+                if is_last and self._out_queue is not None:
+                    self._out_queue.put(_END)
+                return
+
+
+class Pipeline:
+    """ステージを有界キューでつないだパイプラインクラス
+
+    各ステージは別スレッドで動くので、CPU処理とモデル推論を重ねて実行できる
+    """
+
+    def __init__(
+        self,
+        stages: list,
+        queue_size: int = 4,
+    ):
+        """コンストラクタ
+
+        Args:
+            stages (list): ステージ（PipelineStage）のリスト
+            queue_size (int): ステージ間のキューの最大サイズ
+        """
+        self._stages = stages
+        self._queue_size = queue_size
+
+        # 実行時間（秒）
+        self._wall_sec = 0.0
+
+    def run(
+        self,
+        items,
+    ):
+        """パイプラインの実行
+
+        全てのデータが最後のステージまで処理されるまでブロックする
+
+        Args:
+            items (iterable): 最初のステージに入力するデータ
+        """
+        queues = [queue.Queue(maxsize=self._queue_size) for _ in self._stages]
+        for idx, stage in enumerate(self._stages):
+            out_queue = queues[idx + 1] if idx + 1 < len(queues) else None
+            stage.start(queues[idx], out_queue)
+
+        t0 = time.perf_counter()
+        try:
+            for item in items:
+                if any(stage.error is not None for stage in self._stages):
+                    break
+                queues[0].put(item)
+        finally:
+            queues[0].put(_END)
+            for stage in self._stages:
+                stage.join()
+            self._wall_sec = time.perf_counter() - t0
+
+        for stage in self._stages:
+            if stage.error is not None:
+                raise RuntimeError(
+                    f"Pipeline stage '{stage.name}' failed.") from stage.error
+
+    def utilization(self) -> dict:
+        """ステージごとの稼働率
+
+        Returns:
+            dict: ステージ名と稼働率（ワーカーが処理中だった時間 / (実行時間 * ワーカー数)）の対応
+        """
+        result = {}
+        for stage in self._stages:
+            capacity = self._wall_sec * stage.num_workers
+            result[stage.name] = stage.busy_sec / capacity if capacity > 0 else 0.0
+        return result
+
+    def report(self) -> str:
+        """ステージごとの処理統計の文字列"""
+        lines = [f"pipeline: wall={self._wall_sec:.2f}s"]
+        utilization = self.utilization()
+        for stage in self._stages:
+            lines.append(
+                f"  {stage.name}: workers={stage.num_workers}, "
+                f"items={stage.num_items}, busy={stage.busy_sec:.2f}s, "
+                f"utilization={utilization[stage.name] * 100:.1f}%"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,221 @@
+import hashlib
+from pathlib import Path
+
+import cv2
+import numpy as np
+from pycocotools import mask as mask_tools
+
+from . import _utils
+
+
+def proposal_index_path(
+    index_dir: str,
+    img_path: str,
+) -> Path:
+    """画像ファイルに対応するマスク候補インデックスのファイルパス
+
+    画像ファイルのパス・サイズ・更新日時からファイル名を決めるので、画像が変わると古いインデックスは使われない
+
+    Args:
+        index_dir (str): インデックスの保存先ディレクトリ
+        img_path (str): 画像ファイルパス
+
+    Returns:
+        Path: インデックスのファイルパス
+    """
+    img_path_ = Path(img_path).absolute()
+    stat = img_path_.stat()
+    h = hashlib.sha1(f"{img_path_}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return Path(index_dir) / f"{img_path_.stem}_{h.hexdigest()[:16]}.npz"
+
+
+class ProposalIndex:
+    """画像ごとのマスク候補インデックスクラス
+
+    マスク候補をCOCOのRLE形式で保持し、縮小した画素ごとの候補番号マップ（ラベルマップ）で
+    クリック位置の候補をO(1)で引けるようにする
+    候補が重なる画素には面積が最も小さい候補を割り当てる
+    """
+
+    def __init__(
+        self,
+        rle_counts: list,
+        scores: np.ndarray,
+        bboxes: np.ndarray,
+        label_map: np.ndarray,
+        image_size: tuple,
+    ):
+        """コンストラクタ
+
+        Args:
+            rle_counts (list): 各候補のRLEのcounts（bytes）のリスト
+            scores (np.ndarray): 各候補の予測IoU (N,)
+            bboxes (np.ndarray): 各候補のバウンディングボックス (N, 4)（XYWH形式）
+            label_map (np.ndarray): 縮小したラベルマップ (h, w)（0: 候補なし、i + 1: i番目の候補）
+            image_size (tuple): 元画像のサイズ (H, W)
+        """
+        self._rle_counts = list(rle_counts)
+        self._scores = np.asarray(scores, np.float32)
+        self._bboxes = np.asarray(bboxes, np.int32).reshape(-1, 4)
+        self._label_map = label_map
+        self._image_size = tuple(int(x) for x in image_size)
+
+        # 直前に展開したマスク（同じ候補へのクリックで展開し直さないため）
+        self._last_idx = -1
+        self._last_mask: np.ndarray = None
+
+    def __len__(self):
+        return len(self._rle_counts)
+
+    @property
+    def image_size(self) -> tuple:
+        return self._image_size
+
+    @property
+    def scores(self) -> np.ndarray:
+        return self._scores
+
+    @property
+    def bboxes(self) -> np.ndarray:
+        return self._bboxes
+
+    @classmethod
+    def build(
+        cls,
+        proposals: list,
+        image_size: tuple,
+        index_long_side: int = 1024,
+    ) -> "ProposalIndex":
+        """マスク候補からインデックスを作成
+
+        Args:
+            proposals (list): マスク候補（MaskProposal）のリスト
+            image_size (tuple): 元画像のサイズ (H, W)
+            index_long_side (int): ラベルマップの長辺（元画像より大きい場合は元画像のサイズ）
+
+        Returns:
+            ProposalIndex: インデックス
+        """
+        img_h, img_w = image_size
+        scale = min(index_long_side / max(img_h, img_w), 1.0)
+        map_w = max(int(round(img_w * scale)), 1)
+        map_h = max(int(round(img_h * scale)), 1)
+        if len(proposals) >= np.iinfo(np.uint16).max:
+            raise ValueError(f"Too many proposals. {len(proposals)=}")
+
+        rle_counts = []
+        label_map = np.zeros((map_h, map_w), np.uint16)
+
+        # 面積の大きい順に書き込み、重なる画素は小さい候補で上書きする
+        order = sorted(range(len(proposals)), key=lambda i: -proposals[i].area)
+        for proposal in proposals:
+            rle = mask_tools.encode(np.asfortranarray(proposal.mask.astype(np.uint8)))
+            rle_counts.append(rle["counts"])
+        for idx in order:
+            small = cv2.resize(
+                proposals[idx].mask.astype(np.uint8),
+                (map_w, map_h),
+                interpolation=cv2.INTER_NEAREST,
+            )
+            label_map[small > 0] = idx + 1
+
+        return cls(
+            rle_counts=rle_counts,
+            scores=np.array([p.predicted_iou for p in proposals], np.float32),
+            bboxes=np.array([p.bbox for p in proposals], np.int32),
+            label_map=label_map,
+            image_size=(img_h, img_w),
+        )
+
+    def save(
+        self,
+        path: str,
+    ):
+        """インデックスの保存
+
+        RLEのcountsは可変長のbytes配列として保存するので、読み込み時にpickleを使わない
+        """
+        def _write(tmp_path):
+            with open(tmp_path, "wb") as fp:
+                np.savez_compressed(
+                    fp,
+                    rle_counts=np.array(self._rle_counts, dtype=bytes),
+                    scores=self._scores,
+                    bboxes=self._bboxes,
+                    label_map=self._label_map,
+                    image_size=np.array(self._image_size, np.int64),
+                )
+
+        _utils.atomic_save(path, _write)
+
+    @classmethod
+    def load(
+        cls,
+        path: str,
+    ) -> "ProposalIndex":
+        """インデックスの読み込み
+
+        Returns:
+            ProposalIndex: インデックス（ファイルが無い場合はNone）
+        """
+        if not Path(path).exists():
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                rle_counts=[bytes(x) for x in data["rle_counts"]],
+                scores=data["scores"],
+                bboxes=data["bboxes"],
+                label_map=data["label_map"],
+                image_size=tuple(data["image_size"]),
+            )
+
+    def lookup(
+        self,
+        x: int,
+        y: int,
+        min_score: float = 0.0,
+    ) -> int:
+        """クリック位置のマスク候補の番号
+
+        Args:
+            x (int): X座標（元画像）
+            y (int): Y座標（元画像）
+            min_score (float): 採用する候補の予測IoUの下限
+
+        Returns:
+            int: マスク候補の番号（該当する候補が無い場合は-1）
+        """
+        img_h, img_w = self._image_size
+        if not (0 <= x < img_w and 0 <= y < img_h):
+            return -1
+
+        map_h, map_w = self._label_map.shape
+        label = int(self._label_map[y * map_h // img_h, x * map_w // img_w])
+        if label == 0:
+            return -1
+        idx = label - 1
+        if self._scores[idx] < min_score:
+            return -1
+
+        # ラベルマップは縮小しているので、境界付近では元の解像度のマスクで確かめる
+        if not self.mask(idx)[y, x]:
+            return -1
+        return idx
+
+    def mask(
+        self,
+        idx: int,
+    ) -> np.ndarray:
+        """マスク候補のマスク
+
+        Args:
+            idx (int): マスク候補の番号
+
+        Returns:
+            np.ndarray: マスク (H, W)（bool型）
+        """
+        if idx != self._last_idx:
+            rle = {"size": list(self._image_size), "counts": self._rle_counts[idx]}
+            self._last_mask = mask_tools.decode(rle).astype(bool)
+            self._last_idx = idx
+        return self._last_mask
@@ -0,0 +1,163 @@
+import json
+import os
+from pathlib import Path
+
+from . import _utils
+
+
+class ResultJournal:
+    """画像単位の処理結果のジャーナルクラス
+
+    1画像の処理が終わるごとに結果を1行のJSONとして追記する
+    中断後に再実行したときは、ジャーナルにある画像をスキップできる
+    先頭行には入力と処理条件（アノテーションファイルのハッシュ値やシャードの分割など）を記録したヘッダを書き、
+    ヘッダが一致しないジャーナル（別の入力や条件で作られたもの）は使わない
+    全画像を処理し終えたら末尾に完了の記録を書き、処理途中のジャーナルと区別できるようにする
+    """
+
+    def __init__(
+        self,
+        path: str,
+        header: dict,
+    ):
+        """コンストラクタ
+
+        Args:
+            path (str): ジャーナルファイルパス
+            header (dict): ジャーナルのヘッダ（同じ条件の実行で作られたジャーナルか判定する情報）
+        """
+        self._path = Path(path)
+        self._header = header
+        self._fp = None
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def is_valid(self) -> bool:
+        """ジャーナルのヘッダが一致するか（ファイルが無い場合はFalse）"""
+        if not self._path.exists():
+            return False
+        with open(self._path, "rb") as fp:
+            record = self._parse_line(fp.readline())
+        return record is not None and record.get("header", None) == self._header
+
+    def load_image_ids(self) -> set:
+        """処理済みの画像IDの読み込み
+
+        ヘッダが一致しないジャーナルは削除して、全画像を未処理として扱う
+        書き込み途中で中断された末尾の行は切り詰める
+
+        Returns:
+            set: 処理済みの画像IDの集合
+        """
+        img_ids = set()
+        if not self._path.exists():
+            return img_ids
+        if not self.is_valid():
+            print(f"Discard stale journal. {str(self._path)=}")
+            self.discard()
+            return img_ids
+
+        valid_size = 0
+        with open(self._path, "rb") as fp:
+            for line in fp:
+                record = self._parse_line(line)
+                if record is None:
+                    break
+                if "image_id" in record:
+                    img_ids.add(record["image_id"])
+                valid_size += len(line)
+
+        if valid_size != self._path.stat().st_size:
+            with open(self._path, "r+b") as fp:
+                fp.truncate(valid_size)
+
+        return img_ids
+
+    def iter_records(self):
+        """ジャーナルの記録を1行ずつ読み出す（ヘッダが一致しない場合は何も返さない）
+
+        Yields:
+            tuple: 画像ID、アノテーション結果リスト
+        """
+        if not self.is_valid():
+            return
+
+        with open(self._path, "rb") as fp:
+            for line in fp:
+                record = self._parse_line(line)
+                if record is None:
+                    break
+                if "image_id" not in record:
+                    continue
+                yield record["image_id"], record["annotations"]
+
+    def is_complete(self) -> bool:
+        """全画像を処理し終えたジャーナルか（末尾の行が完了の記録か）"""
+        if not self.is_valid():
+            return False
+        with open(self._path, "rb") as fp:
+            # 末尾の1行だけ読む
+            fp.seek(max(self._path.stat().st_size - 64, 0))
+            lines = fp.read().splitlines(keepends=True)
+        record = self._parse_line(lines[-1]) if lines else None
+        return record is not None and record.get("complete", False)
+
+    @staticmethod
+    def _parse_line(line: bytes) -> dict:
+        """1行分の記録の解析（書き込み途中の行はNone）"""
+        if not line.endswith(b"\n"):
+            return None
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            return None
+
+    def discard(self):
+        """ジャーナルの削除"""
+        if self._path.exists():
+            self._path.unlink()
+
+    def open(self):
+        """追記用に開く（新しいジャーナルにはヘッダを書く）"""
+        _utils.make_parent_dir(self._path)
+        self._fp = open(self._path, "a", encoding="utf8")
+        if self._fp.tell() == 0:
+            self._write_line({"header": self._header})
+
+    def _write_line(
+        self,
+        record: dict,
+    ):
+        """1行分の記録を追記"""
+        self._fp.write(json.dumps(record) + "\n")
+        # 強制終了されても書き込み済みの行は残るようにする
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def append(
+        self,
+        img_id: int,
+        annos: list,
+    ):
+        """1画像分の結果を追記
+
+        Args:
+            img_id (int): 画像ID
+            annos (list): アノテーション結果（id, segmentation, iscrowd）のリスト
+        """
+        self._write_line({
+            "image_id": img_id,
+            "annotations": annos,
+        })
+
+    def mark_complete(self):
+        """全画像を処理し終えたことを記録"""
+        self._write_line({"complete": True})
+
+    def close(self):
+        """ファイルを閉じる"""
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
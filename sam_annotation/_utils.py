@@ -130,3 +130,130 @@ def apply_colored_mask(
         )
 
     return result_img
+
+
+def get_process_memory() -> dict:
+    """プロセスのメモリ使用量の取得
+
+    psutilがあればそれを使い、無ければresourceモジュール（Unix系のみ）で取得する
+    取得できない項目は-1とする
+
+    Returns:
+        dict: 現在の常駐メモリ（rss_bytes）とピーク（peak_rss_bytes）
+    """
+    result = {
+        "rss_bytes": -1,
+        "peak_rss_bytes": -1,
+    }
+
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        result["rss_bytes"] = info.rss
+        # Windowsではピークのワーキングセットが取得できる
+        result["peak_rss_bytes"] = getattr(info, "peak_wset", -1)
+    except ImportError:
+        pass
+
+    if result["peak_rss_bytes"] < 0:
+        try:
+            import resource
+            import sys
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # macOSはバイト、Linuxはキロバイト単位
+            result["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+        except ImportError:
+            pass
+
+    return result
+
+
+def load_image_resized(
+    path: str,
+    long_side: int,
+) -> tuple:
+    """長辺を指定サイズに縮小した画像ファイルの読み込み
+
+    JPEGは縮小デコード（IMREAD_REDUCED_*）で必要な解像度だけ展開し、cv2で指定サイズに縮小する
+    元画像サイズの画素配列を作らないので、大きな画像でもメモリ確保とコピーが少ない
+    元画像が指定サイズより小さい場合は拡大する
+
+    Args:
+        path (str): 画像ファイルパス
+        long_side (int): 縮小後の長辺の長さ
+
+    Returns:
+        tuple: RGB画像、元画像のサイズ (H, W)
+    """
+    # 画像サイズはヘッダのみ読み込んで取得する
+    with PIL.Image.open(path) as pil_img:
+        width, height = pil_img.size
+
+    # 縮小デコード後も長辺が指定サイズ以上になる最大の縮小率を選ぶ
+    # load_imageと向きを合わせるためにEXIFの回転情報は無視する
+    flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+    for factor, reduced_flag in (
+        (8, cv2.IMREAD_REDUCED_COLOR_8),
+        (4, cv2.IMREAD_REDUCED_COLOR_4),
+        (2, cv2.IMREAD_REDUCED_COLOR_2),
+    ):
+        if max(width, height) // factor >= long_side:
+            flags = reduced_flag | cv2.IMREAD_IGNORE_ORIENTATION
+            break
+
+    # 日本語パスでも読めるようにバイト列からデコードする
+    buf = np.fromfile(path, dtype=np.uint8)
+    img = cv2.imdecode(buf, flags)
+    if img is None:
+        raise RuntimeError(f"Failed to decode image. {path=}")
+
+    # SAMのResizeLongestSideと同じ縮小後サイズ
+    scale = long_side / max(width, height)
+    new_w = int(width * scale + 0.5)
+    new_h = int(height * scale + 0.5)
+    if img.shape[:2] != (new_h, new_w):
+        interpolation = cv2.INTER_AREA if img.shape[0] > new_h else cv2.INTER_LINEAR
+        img = cv2.resize(img, (new_w, new_h), interpolation=interpolation)
+
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img, (height, width)
+
+
+def atomic_save(
+    path: str,
+    write_fn,
+):
+    """一時ファイル経由でのファイル保存
+
+    書き込み途中のファイルを他のスレッドやプロセスが読まないように、一時ファイルに書いてから置き換える
+    複数プロセスが同じファイルを同時に保存しても衝突しないように、一時ファイル名にプロセスIDを含める
+
+    Args:
+        path (str): 保存先のファイルパス
+        write_fn (callable): 一時ファイルのパス（Path）を受け取って書き込む関数
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+        raise
+
+
+def checkpoint_tag(
+    checkpoint: str,
+) -> str:
+    """チェックポイントの識別文字列（ファイル名の拡張子を除いた部分とファイルサイズ）
+
+    変換済みモデルのファイル名やキャッシュキーに使い、チェックポイントが変わったら別のものになるようにする
+    ファイルが無い場合のサイズは-1とする
+    """
+    checkpoint = Path(checkpoint)
+    checkpoint_size = checkpoint.stat().st_size if checkpoint.exists() else -1
+    return f"{checkpoint.stem}_{checkpoint_size}"
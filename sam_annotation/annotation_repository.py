@@ -23,7 +23,10 @@ class _CategoryInfo:
     subcategory: str = ""
 
     def as_dict(self) -> dict:
-        return self.__dict__.copy()
+        """COCO形式の辞書に変換（上位カテゴリはsupercategoryキーにする）"""
+        data = self.__dict__.copy()
+        data["supercategory"] = data.pop("subcategory")
+        return data
 
 
 @dataclass
@@ -40,7 +43,10 @@ class _ImageInfo:
     # _date_captured: str = "YYYY/MM/DD"
 
     def as_dict(self) -> dict:
-        return self.__dict__.copy()
+        """COCO形式の辞書に変換（ファイル名はfile_nameキーにする）"""
+        data = self.__dict__.copy()
+        data["file_name"] = data.pop("filename")
+        return data
 
 
 @dataclass
@@ -48,7 +54,7 @@ class _AnnotationInfo:
     """アノテーション情報クラス"""
     id = -1
     image_id = -1
-    catetory_id = -1
+    category_id = -1
     segmentation = None
     area = 0.0
     bbox = [0.0] * 4
@@ -138,51 +144,90 @@ class AnnotationRepository:
                 # 画像IDと画像情報の対応付け
                 self._img_path_to_id[img_path] = img_id
                 self._img_id_to_path[img_id] = img_path
-                self._img_id_to_info[img_path] = info
+                self._img_id_to_info[img_id] = info
 
         else:
-            coco = pycocotools.coco.COCO(coco_file)
-
-            # アノテーション情報
-            for anno_id, ann in coco.anns.items():
-                assert anno_id == ann['id']
-                self._anno_id_manager.append_id(anno_id)
+            coco = self._load_coco(coco_file)
 
-                anno_info = _AnnotationInfo()
-                anno_info.id = ann["id"]
-                anno_info.image_id = ann["image_id"]
-                anno_info.catetory_id = ann["category_id"]
-                anno_info.segmentation = ann["segmentation"]
-                anno_info.iscrowd = ann["iscrowd"]
-                anno_info.bbox = ann["bbox"]
-                anno_info.area = ann["area"]
-                self._anno_id_to_info[anno_id] = anno_info
+            # 画像ファイル名と画像パスの対応（画像情報にはファイル名のみ保存している）
+            name_to_path = {}
+            for img_path in _utils.find_image_files(img_dir=img_root_dir, recursive=recursive):
+                name_to_path.setdefault(Path(img_path).name, img_path)
 
             # 画像情報
             for img_id, img in coco.imgs.items():
                 assert img_id == img['id']
-                self._img_id_manager.append_id(img_id)
+                self._img_id_manager.add_id(img_id)
 
                 img_info = _ImageInfo()
                 img_info.id = img["id"]
-                img_info.filename = img["filename"]
+                img_info.filename = img["file_name"]
                 img_info.width = img["width"]
                 img_info.height = img["height"]
-                self._anno_id_to_info[img_id] = img_info
+                self._img_id_to_info[img_id] = img_info
+
+                img_path = name_to_path.get(
+                    img_info.filename, str(Path(img_root_dir) / img_info.filename))
+                self._img_path_to_id[img_path] = img_id
+                self._img_id_to_path[img_id] = img_path
 
             # カテゴリ情報
             for cat_id, cat in coco.cats.items():
                 assert cat_id == cat['id']
-                self._cat_id_manager.append_id(cat_id)
+                self._cat_id_manager.add_id(cat_id)
 
                 cat_info = _CategoryInfo()
                 cat_info.id = cat["id"]
                 cat_info.name = cat["name"]
-                cat_info.subcategory = cat["supercategory"]
-                self._cat_id_to_info[anno_id] = cat_info
+                cat_info.subcategory = cat.get("supercategory", "")
+                self._cat_id_to_info[cat_id] = cat_info
 
-            # TODO: COCOファイルで初期化できるようにする
-            raise NotImplementedError
+            # アノテーション情報
+            for anno_id, ann in coco.anns.items():
+                assert anno_id == ann['id']
+                self._anno_id_manager.add_id(anno_id)
+
+                anno_info = _AnnotationInfo()
+                anno_info.id = ann["id"]
+                anno_info.image_id = ann["image_id"]
+                anno_info.category_id = ann["category_id"]
+                anno_info.segmentation = ann["segmentation"]
+                anno_info.iscrowd = ann["iscrowd"]
+                anno_info.bbox = ann["bbox"]
+                anno_info.area = ann["area"]
+                if "score" in ann:
+                    anno_info.score = ann["score"]
+                if "isbox" in ann:
+                    anno_info.isbox = ann["isbox"]
+                self._anno_id_to_info[anno_id] = anno_info
+                self._img_id_to_anno_list.setdefault(anno_info.image_id, []).append(anno_id)
+
+    @staticmethod
+    def _load_coco(
+        coco_file: str,
+    ) -> pycocotools.coco.COCO:
+        """COCO形式ファイルの読み込み
+
+        以前の保存形式のキー（catetory_id, filename, subcategory）はCOCO形式のキーに読み替える
+        （pycocotoolsのインデックス作成はcategory_idが無いと失敗するため、読み替えてから作成する）
+        """
+        with open(coco_file, "r") as f:
+            dataset = json.load(f)
+
+        legacy_keys = [
+            ("annotations", "catetory_id", "category_id"),
+            ("images", "filename", "file_name"),
+            ("categories", "subcategory", "supercategory"),
+        ]
+        for section, legacy_key, key in legacy_keys:
+            for item in dataset.get(section, []):
+                if legacy_key in item and key not in item:
+                    item[key] = item.pop(legacy_key)
+
+        coco = pycocotools.coco.COCO()
+        coco.dataset = dataset
+        coco.createIndex()
+        return coco
 
     def save(self, filepath):
         """アノテーション情報の保存"""
@@ -196,17 +241,15 @@ class AnnotationRepository:
         with self._lock:
             images = []
             for _, info in self._img_id_to_info.items():
-                images.append(info.to_dict())
+                images.append(info.as_dict())
 
             categories = []
             for _, info in self._cat_id_to_info.items():
-                categories.append(info.to_dict())
+                categories.append(info.as_dict())
 
             annotations = []
             for _, info in self._anno_id_to_info.items():
-                annotations.append(info.to_dict())
-
-            categories = self._create_category_info_list()
+                annotations.append(info.as_dict())
 
             # COCO形式のアノテーションファイルを作成
             coco_data = {
@@ -233,13 +276,85 @@ class AnnotationRepository:
             img_id =  self._img_id_manager.ids[self._img_idx]
             return self._img_id_to_path[img_id]
 
+    def get_neighbor_image_paths(
+        self,
+        num_next: int,
+        num_prev: int = 0,
+    ) -> list:
+        """現在の画像の前後にある画像パスのリスト取得
+
+        現在の画像インデックスは変更しない
+        次の画像と前の画像を近い順に交互に並べる（同じ距離なら次の画像を優先）
+
+        Args:
+            num_next (int): 取得する次の画像の数
+            num_prev (int): 取得する前の画像の数
+
+        Returns:
+            list: 画像パスのリスト
+        """
+        with self._lock:
+            ids = self._img_id_manager.ids
+            offsets = []
+            for i in range(1, max(num_next, num_prev) + 1):
+                if i <= num_next:
+                    offsets.append(i)
+                if i <= num_prev:
+                    offsets.append(-i)
+
+            img_paths = []
+            for offset in offsets:
+                idx = self._img_idx + offset
+                if 0 <= idx < len(ids):
+                    img_paths.append(self._img_id_to_path[ids[idx]])
+            return img_paths
+
+    def add_category(
+        self,
+        name: str,
+        subcategory: str = "",
+    ) -> int:
+        """カテゴリ情報の追加
+
+        同じ名前のカテゴリが登録済みの場合はそのIDを返す
+
+        Args:
+            name (str): カテゴリ名
+            subcategory (str): 上位カテゴリ名
+
+        Returns:
+            int: カテゴリID
+        """
+        with self._lock:
+            for cat_id, info in self._cat_id_to_info.items():
+                if info.name == name:
+                    return cat_id
+
+            cat_info = _CategoryInfo()
+            cat_info.id = self._cat_id_manager.generate_id()
+            cat_info.name = name
+            cat_info.subcategory = subcategory
+            self._cat_id_to_info[cat_info.id] = cat_info
+            return cat_info.id
+
     def add_annotation(
         self,
         img_path: str,
         category_id: int,
         mask: np.ndarray,
-    ):
-        """アノテーション情報の追加"""
+        score: float = None,
+    ) -> int:
+        """アノテーション情報の追加
+
+        Args:
+            img_path (str): 画像パス
+            category_id (int): カテゴリID
+            mask (np.ndarray): セグメンテーションマスク（bool型）
+            score (float): 自動生成したマスクの信頼度（Noneの場合は記録しない）
+
+        Returns:
+            int: アノテーションID
+        """
         with self._lock:
             # アノテーションID生成
             anno_id = self._anno_id_manager.generate_id()
@@ -258,13 +373,15 @@ class AnnotationRepository:
 
             # アノテーション情報を作成
             anno_info = _AnnotationInfo()
-            anno_id.id = anno_id
+            anno_info.id = anno_id
             anno_info.segmentation = rle
             anno_info.area = area
             anno_info.iscrowd = 0
             anno_info.image_id = img_id
             anno_info.bbox = bbox
-            anno_info.catetory_id = category_id
+            anno_info.category_id = category_id
+            if score is not None:
+                anno_info.score = float(score)
 
             use_rle = False
             if use_rle:
@@ -295,10 +412,12 @@ class AnnotationRepository:
                         segmentation.append(contour)
 
                 # ポリゴンデータをセグメンテーション情報として設定
-                anno_info['segmentation'] = segmentation
-                anno_info['isbox'] = False
+                anno_info.segmentation = segmentation
+                anno_info.isbox = False
 
             self._anno_id_to_info[anno_id] = anno_info
+            self._img_id_to_anno_list.setdefault(img_id, []).append(anno_id)
+            return anno_id
 
     def remove_annotation(
         self,
@@ -307,4 +426,7 @@ class AnnotationRepository:
         """アノテーション情報の削除"""
         with self._lock:
             self._anno_id_manager.remove_id(annotation_id)
-            del self._anno_id_to_info[annotation_id]
+            anno_info = self._anno_id_to_info.pop(annotation_id)
+            anno_list = self._img_id_to_anno_list.get(anno_info.image_id, [])
+            if annotation_id in anno_list:
+                anno_list.remove(annotation_id)
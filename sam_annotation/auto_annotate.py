@@ -0,0 +1,421 @@
+import argparse
+import hashlib
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import torch
+from pycocotools import mask as mask_tools
+
+# NOTE: リポジトリルートから `python -m sam_annotation.auto_annotate` で実行する
+import sam_annotation._utils as _utils
+from sam_annotation._auto_proposal import AutoMaskProposer
+from sam_annotation._pipeline import Pipeline, PipelineStage
+from sam_annotation._proposal_index import ProposalIndex, proposal_index_path
+from sam_annotation._result_journal import ResultJournal
+from sam_annotation.annotation_repository import AnnotationRepository
+from sam_annotation.sam_predictor_wrapper import SamPredictorWrapper
+
+# SAMのチェックポイントを配置しているディレクトリへのパス
+_SAM_CHECKPOINT_DIR = "./weights"
+
+# SAMの各モデルタイプに対応するチェックポイント
+_SAM_CHECKPOINT_MAP = {
+    "vit_h": f"{_SAM_CHECKPOINT_DIR}/sam_vit_h_4b8939.pth",
+    "vit_l": f"{_SAM_CHECKPOINT_DIR}/sam_vit_l_0b3195.pth",
+    "vit_b": f"{_SAM_CHECKPOINT_DIR}/sam_vit_b_01ec64.pth",
+}
+
+
+@dataclass
+class CommandLineArguments:
+    """コマンドライン引数パラメータ"""
+
+    # 画像ディレクトリパス
+    img_dir: str = ""
+
+    # サブディレクトリの画像も対象にするフラグ
+    recursive: bool = False
+
+    # SAMのバックボーンモデルの種類
+    sam_model_type: str = "vit_h"  # vit_h, vit_l, vit_b のいずれか
+
+    # SAMモデルのチェックポイントパス
+    sam_checkpoint: str = ""
+
+    # 画像埋め込みのディスクキャッシュ先
+    embedding_cache_dir: str = ""
+
+    # 出力ファイルパス（COCO形式）
+    output_file: str = "auto_annotations.json"
+
+    # 処理済み画像の結果を追記するジャーナルファイルパス（空の場合は出力ファイルパスから決める）
+    journal_file: str = ""
+
+    # 既存のジャーナルを破棄して最初から処理するフラグ
+    discard_journal: bool = False
+
+    # 自動生成したアノテーションに付けるカテゴリ名
+    category_name: str = "object"
+
+    # 格子の一辺あたりのポイント数
+    points_per_side: int = 32
+
+    # マスクデコーダに一度に与えるポイント数
+    points_per_batch: int = 64
+
+    # 予測IoUのしきい値
+    pred_iou_thresh: float = 0.88
+
+    # 安定度スコアのしきい値
+    stability_score_thresh: float = 0.95
+
+    # NMSで重複とみなすバウンディングボックスのIoU
+    box_nms_thresh: float = 0.7
+
+    # マスク候補の最小面積（ピクセル数）
+    min_mask_area: int = 0
+
+    # 画像あたりのマスク候補数の上限（0以下の場合は制限しない）
+    max_proposals: int = 0
+
+    # マスク候補インデックスの保存先ディレクトリ（空の場合は保存しない）
+    proposal_index_dir: str = ""
+
+    # マスク候補インデックスのラベルマップの長辺
+    index_long_side: int = 1024
+
+    # 画像読み込みのワーカー数
+    num_load_workers: int = 4
+
+    # ステージ間のキューの最大サイズ
+    queue_size: int = 4
+
+    # PyTorchのスレッド数（0以下の場合は変更しない）
+    num_threads: int = 0
+
+    # SAMの推論精度（"fp32", "bf16", or "int8"）
+    precision: str = "fp32"
+
+
+def get_args() -> CommandLineArguments:
+    """コマンドライン引数の取得"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--img_dir",
+        default=r"",
+        type=str,
+    )
+    parser.add_argument(
+        "--recursive",
+        action="store_true",
+        help="サブディレクトリの画像も対象にする",
+    )
+    parser.add_argument(
+        "--sam_model_type",
+        default="vit_h",
+        type=str,
+        choices=["vit_h", "vit_l", "vit_b"]
+    )
+    parser.add_argument(
+        "--sam_checkpoint",
+        default=r"",
+        type=str,
+    )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        default=r"",
+        type=str,
+    )
+    parser.add_argument(
+        "--output_file",
+        default="auto_annotations.json",
+        type=str,
+    )
+    parser.add_argument(
+        "--journal_file",
+        default="",
+        type=str,
+        help="処理済み画像の結果を追記するジャーナルファイル（既定: <output_file>.journal.jsonl）",
+    )
+    parser.add_argument(
+        "--discard_journal",
+        action="store_true",
+        help="既存のジャーナルを破棄して最初から処理する",
+    )
+    parser.add_argument(
+        "--category_name",
+        default="object",
+        type=str,
+        help="自動生成したアノテーションに付けるカテゴリ名",
+    )
+    parser.add_argument(
+        "--points_per_side",
+        default=32,
+        type=int,
+        help="格子の一辺あたりのポイント数（画像全体で points_per_side ** 2 個）",
+    )
+    parser.add_argument(
+        "--points_per_batch",
+        default=64,
+        type=int,
+        help="マスクデコーダに一度に与えるポイント数（大きいほど高速だがメモリを使う）",
+    )
+    parser.add_argument(
+        "--pred_iou_thresh",
+        default=0.88,
+        type=float,
+    )
+    parser.add_argument(
+        "--stability_score_thresh",
+        default=0.95,
+        type=float,
+    )
+    parser.add_argument(
+        "--box_nms_thresh",
+        default=0.7,
+        type=float,
+    )
+    parser.add_argument(
+        "--min_mask_area",
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "--max_proposals",
+        default=0,
+        type=int,
+        help="画像あたりのマスク候補数の上限（0以下の場合は制限しない）",
+    )
+    parser.add_argument(
+        "--proposal_index_dir",
+        default="",
+        type=str,
+        help="マスク候補インデックスの保存先（MainAppの--proposal_index_dirに指定するとクリックが候補の参照になる）",
+    )
+    parser.add_argument(
+        "--index_long_side",
+        default=1024,
+        type=int,
+        help="マスク候補インデックスのラベルマップの長辺",
+    )
+    parser.add_argument(
+        "--num_load_workers",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--queue_size",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--num_threads",
+        default=0,
+        type=int,
+        help="PyTorchのスレッド数（0以下の場合は変更しない）",
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        type=str,
+        choices=["fp32", "bf16", "int8"],
+        help="推論精度（bf16: 自動混合精度、int8: 画像エンコーダの動的量子化（CPUのみ））",
+    )
+
+    args = parser.parse_args()
+    return CommandLineArguments(**args.__dict__)
+
+
+def _journal_header(
+    args: CommandLineArguments,
+    img_paths: list,
+) -> dict:
+    """ジャーナルのヘッダ（画像リストとマスク候補の生成条件が同じ実行の結果だけを使うため）
+
+    ジャーナルの画像IDは画像リスト内のインデックスなので、画像リストのハッシュ値も記録する
+    """
+    return {
+        "image_paths_hash": hashlib.sha1("\n".join(img_paths).encode()).hexdigest(),
+        "model": f"{args.sam_model_type}:{Path(args.sam_checkpoint).name}:{args.precision}",
+        "category_name": args.category_name,
+        "points_per_side": args.points_per_side,
+        "pred_iou_thresh": args.pred_iou_thresh,
+        "stability_score_thresh": args.stability_score_thresh,
+        "box_nms_thresh": args.box_nms_thresh,
+        "min_mask_area": args.min_mask_area,
+        "max_proposals": args.max_proposals,
+    }
+
+
+def _encode_proposal(proposal) -> dict:
+    """マスク候補をジャーナルに記録する形式（RLE）に変換"""
+    rle = mask_tools.encode(np.asfortranarray(proposal.mask.astype(np.uint8)))
+    return {
+        "size": rle["size"],
+        "counts": rle["counts"].decode("ascii"),
+        "score": float(proposal.predicted_iou),
+    }
+
+
+def _restore_journal(
+    journal: ResultJournal,
+    repository: AnnotationRepository,
+    img_paths: list,
+    category_id: int,
+) -> set:
+    """ジャーナルに記録済みの結果をアノテーションとして登録し直す
+
+    Returns:
+        set: 処理済みの画像インデックスの集合
+    """
+    done_indices = journal.load_image_ids()
+    for img_idx, records in journal.iter_records():
+        for record in records:
+            mask = mask_tools.decode({
+                "size": record["size"],
+                "counts": record["counts"].encode("ascii"),
+            })
+            repository.add_annotation(
+                img_paths[img_idx],
+                category_id,
+                mask.astype(bool),
+                score=record["score"],
+            )
+    return done_indices
+
+
+def main():
+    """メイン処理"""
+    # コマンドライン引数を取得
+    args = get_args()
+    # モデルのチェックポイントが空の時は自動設定
+    if args.sam_checkpoint is None or args.sam_checkpoint == "":
+        args.sam_checkpoint = _SAM_CHECKPOINT_MAP[args.sam_model_type]
+
+    if not Path(args.img_dir).is_dir():
+        # 画像ディレクトリが存在しない
+        raise RuntimeError(f"Not found image directory. {args.img_dir=}")
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    # 画像ディレクトリ内の画像ファイルを登録
+    repository = AnnotationRepository()
+    repository.initialize(
+        img_root_dir=args.img_dir,
+        recursive=args.recursive,
+        coco_file=None,
+    )
+    category_id = repository.add_category(args.category_name)
+    img_paths = repository.image_paths
+    print(f"{len(img_paths)=}")
+    if len(img_paths) == 0:
+        return
+
+    # 処理結果のジャーナル（中断しても処理済みの画像の結果を失わないように画像ごとに追記する）
+    journal_file = args.journal_file
+    if journal_file is None or journal_file == "":
+        journal_file = args.output_file + ".journal.jsonl"
+    journal = ResultJournal(journal_file, _journal_header(args, img_paths))
+    if args.discard_journal:
+        journal.discard()
+
+    # ジャーナルにある画像は結果を登録し直してスキップする
+    done_indices = _restore_journal(journal, repository, img_paths, category_id)
+    if done_indices:
+        print(f"Resume from journal. {len(done_indices)=}, {journal_file=}")
+    targets = [
+        (img_idx, img_path) for img_idx, img_path in enumerate(img_paths)
+        if img_idx not in done_indices
+    ]
+
+    # SAMモデルのインスタンス生成
+    predictor = SamPredictorWrapper(
+        model_type=args.sam_model_type,
+        checkpoint=args.sam_checkpoint,
+        device='cuda:0',
+        cache_dir=args.embedding_cache_dir,
+        precision=args.precision,
+    )
+    proposer = AutoMaskProposer(
+        predictor,
+        points_per_side=args.points_per_side,
+        points_per_batch=args.points_per_batch,
+        pred_iou_thresh=args.pred_iou_thresh,
+        stability_score_thresh=args.stability_score_thresh,
+        box_nms_thresh=args.box_nms_thresh,
+        min_mask_area=args.min_mask_area,
+        max_proposals=args.max_proposals,
+    )
+
+    def load_image(target):
+        """画像読み込みステージ"""
+        img_idx, img_path = target
+        return (img_idx, img_path), _utils.load_image(img_path)
+
+    def encode_image(item):
+        """画像エンコードステージ"""
+        target, img = item
+        embedding = predictor.set_images([img], img_format="RGB", batch_size=1)[0]
+        return target, embedding
+
+    def propose_masks(item):
+        """マスク候補生成ステージ"""
+        target, embedding = item
+        proposals = proposer.propose(embedding)
+        print(f"img_path={target[1]!r}, {len(proposals)=}")
+        return target, proposals
+
+    def save_index(item):
+        """マスク候補インデックス保存ステージ"""
+        (_, img_path), proposals = item
+        img_info = _utils.load_image_info(img_path)
+        index = ProposalIndex.build(
+            proposals,
+            image_size=(img_info["height"], img_info["width"]),
+            index_long_side=args.index_long_side,
+        )
+        index.save(proposal_index_path(args.proposal_index_dir, img_path))
+        return item
+
+    def add_annotations(item):
+        """アノテーション登録ステージ（画像ごとに逐次登録し、ジャーナルに追記する）"""
+        (img_idx, img_path), proposals = item
+        for proposal in proposals:
+            repository.add_annotation(
+                img_path,
+                category_id,
+                proposal.mask,
+                score=proposal.predicted_iou,
+            )
+        journal.append(img_idx, [_encode_proposal(proposal) for proposal in proposals])
+
+    stages = [
+        PipelineStage("load", load_image, num_workers=args.num_load_workers),
+        PipelineStage("encode", encode_image),
+        PipelineStage("propose", propose_masks),
+    ]
+    if args.proposal_index_dir is not None and args.proposal_index_dir != "":
+        stages.append(PipelineStage("index", save_index))
+    stages.append(PipelineStage("annotate", add_annotations))
+    pipeline = Pipeline(stages=stages, queue_size=args.queue_size)
+
+    # 中断（Ctrl-Cなど）された場合もそれまでの結果は保存する
+    # 全画像を処理し終えるまではジャーナルを残し、再実行時に処理済みの画像をスキップする
+    journal.open()
+    try:
+        pipeline.run(targets)
+    finally:
+        journal.close()
+        print(pipeline.report())
+
+        _utils.atomic_save(args.output_file, repository.save)
+        predictor.release()
+
+    # 全画像の結果を出力ファイルに反映したのでジャーナルは不要
+    journal.discard()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,23 @@
 import argparse
+import dataclasses
+import hashlib
 import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 
 import numpy as np
 import cv2
 import pycocotools.coco
+import torch
 
-import _utils
-from sam_predictor_wrapper import SamPredictorWrapper
+# NOTE: リポジトリルートから `python -m sam_annotation.coco_bbox_to_seg` で実行する
+import sam_annotation._utils as _utils
+from sam_annotation._pipeline import Pipeline, PipelineStage
+from sam_annotation._result_journal import ResultJournal
+from sam_annotation.sam_predictor_wrapper import SamPredictorWrapper
 
 # SAMのチェックポイントを配置しているディレクトリへのパス
 _SAM_CHECKPOINT_DIR = "./weights"
@@ -37,6 +46,55 @@ class CommandLineArguments:
     # SAMモデルのチェックポイントパス
     sam_checkpoint: str = ""
 
+    # SAMの推論デバイス（空の場合はGPUがあればワーカーごとにGPUを割り当て、無ければCPU）
+    device: str = ""
+
+    # 画像埋め込みのディスクキャッシュ先
+    embedding_cache_dir: str = ""
+
+    # 出力ファイルパス
+    output_file: str = "output.json"
+
+    # 処理済み画像の結果を追記するジャーナルファイルパス（空の場合は出力ファイルパスから決める）
+    # 複数シャードに分割する場合は、シャードごとに ".shard-i-of-N" を付けたパスになる
+    journal_file: str = ""
+
+    # 既存のジャーナルを破棄して最初から処理するフラグ
+    discard_journal: bool = False
+
+    # 画像読み込みのワーカー数
+    num_load_workers: int = 4
+
+    # ポリゴン変換のワーカー数
+    num_polygon_workers: int = 4
+
+    # 画像エンコーダに一度に入力する画像数
+    encode_batch_size: int = 1
+
+    # ステージ間のキューの最大サイズ
+    queue_size: int = 4
+
+    # このプロセス（マシン）が処理するシャードのインデックス
+    shard_index: int = 0
+
+    # 全体のシャード数
+    num_shards: int = 1
+
+    # シャードを分割して並列処理するワーカープロセス数
+    num_workers: int = 1
+
+    # PyTorchのスレッド数（0以下の場合は変更しない）
+    num_threads: int = 0
+
+    # 各シャードのジャーナルを結合するだけのフラグ
+    merge_only: bool = False
+
+    # 差分変換用のインデックスファイルパス（空の場合は全BBoxを変換する）
+    incremental_index: str = ""
+
+    # SAMの推論精度（"fp32", "bf16", or "int8"）
+    precision: str = "fp32"
+
 
 def get_args() -> CommandLineArguments:
     """コマンドライン引数の取得"""
@@ -62,8 +120,102 @@ def get_args() -> CommandLineArguments:
         default=r"",
         type=str,
     )
+    parser.add_argument(
+        "--device",
+        default="",
+        type=str,
+        help="推論デバイス（例: cuda:0, cpu）。既定ではワーカーごとにGPUを順に割り当て、GPUが無ければCPUを使う",
+    )
+    parser.add_argument(
+        "--embedding_cache_dir",
+        default=r"",
+        type=str,
+    )
+    parser.add_argument(
+        "--output_file",
+        default="output.json",
+        type=str,
+    )
+    parser.add_argument(
+        "--journal_file",
+        default="",
+        type=str,
+        help="処理済み画像の結果を追記するジャーナルファイル（既定: <output_file>.journal.jsonl）。"
+             "複数シャードの場合は <journal_file>.shard-i-of-N になる",
+    )
+    parser.add_argument(
+        "--discard_journal",
+        action="store_true",
+        help="既存のジャーナルを破棄して最初から処理する",
+    )
+    parser.add_argument(
+        "--num_load_workers",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--num_polygon_workers",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--encode_batch_size",
+        default=1,
+        type=int,
+    )
+    parser.add_argument(
+        "--queue_size",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "--shard_index",
+        default=0,
+        type=int,
+        help="このプロセス（マシン）が処理するシャードのインデックス",
+    )
+    parser.add_argument(
+        "--num_shards",
+        default=1,
+        type=int,
+        help="全体のシャード数（複数マシンで分担する場合に指定）",
+    )
+    parser.add_argument(
+        "--num_workers",
+        default=1,
+        type=int,
+        help="シャードを分割して並列処理するワーカープロセス数",
+    )
+    parser.add_argument(
+        "--num_threads",
+        default=0,
+        type=int,
+        help="PyTorchのスレッド数（0以下の場合は変更しない）",
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        type=str,
+        choices=["fp32", "bf16", "int8"],
+        help="推論精度（bf16: 自動混合精度、int8: 画像エンコーダの動的量子化（CPUのみ））",
+    )
+    parser.add_argument(
+        "--merge_only",
+        action="store_true",
+        help="各シャードのジャーナルを結合して出力ファイルを作成するだけ"
+             "（--num_shards、--num_workers、--journal_fileは変換時と同じ値を指定する）",
+    )
+    parser.add_argument(
+        "--incremental_index",
+        default="",
+        type=str,
+        help="差分変換用のインデックスファイル。指定すると前回から変更の無いBBoxは再変換しない",
+    )
     args = parser.parse_args()
-    return CommandLineArguments(**args.__dict__)
+    args = CommandLineArguments(**args.__dict__)
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error(f"Invalid shard index. {args.shard_index=}, {args.num_shards=}")
+    return args
 
 
 def convert_mask_to_polygon(mask):
@@ -85,6 +237,123 @@ def convert_mask_to_polygon(mask):
     return polygon
 
 
+class _SegmentationIndex:
+    """差分変換用のセグメンテーションインデックスクラス
+
+    (画像ファイルのハッシュ, BBox, カテゴリ, モデル) のキーと変換結果のセグメンテーションを対応付ける
+    キーが一致するBBoxは前回の変換結果をそのまま使えるので、SAMを再実行しなくてよい
+    """
+
+    def __init__(
+        self,
+        path: str,
+    ):
+        """コンストラクタ
+
+        Args:
+            path (str): インデックスファイルパス（1行1エントリのJSON Lines形式）
+        """
+        self._path = Path(path)
+        self._key_to_seg = {}
+
+    def __len__(self):
+        return len(self._key_to_seg)
+
+    def load(self):
+        """インデックスの読み込み"""
+        self._key_to_seg = {}
+        if not self._path.exists():
+            return
+        with open(self._path, encoding="utf8") as fp:
+            for line in fp:
+                entry = json.loads(line)
+                self._key_to_seg[entry["key"]] = entry["segmentation"]
+
+    def get(
+        self,
+        key: str,
+    ):
+        """キーに対応するセグメンテーションの取得（無い場合はNone）"""
+        return self._key_to_seg.get(key, None)
+
+    @staticmethod
+    def make_key(
+        file_hash: str,
+        bbox: list,
+        category_id: int,
+        model_id: str,
+    ) -> str:
+        """インデックスのキー生成"""
+        bbox_str = ",".join(f"{v:.3f}" for v in bbox)
+        key_str = f"{file_hash}:{bbox_str}:{category_id}:{model_id}"
+        return hashlib.sha1(key_str.encode()).hexdigest()
+
+    def open_writer(self):
+        """インデックスの書き直し用に一時ファイルを開く"""
+        _utils.make_parent_dir(self._path)
+        return open(str(self._path) + ".tmp", "w", encoding="utf8")
+
+    def commit_writer(self, fp):
+        """書き直したインデックスで置き換える"""
+        fp.close()
+        os.replace(str(self._path) + ".tmp", self._path)
+
+
+def _file_hash(path: str) -> str:
+    """ファイル内容のハッシュ値"""
+    h = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class _StreamingCocoWriter:
+    """COCO形式ファイルの逐次書き込みクラス
+
+    画像やカテゴリなどの情報を先に書き出し、アノテーションは処理が終わったものから追記する
+    """
+
+    def __init__(
+        self,
+        path: str,
+        dataset: dict,
+    ):
+        """コンストラクタ
+
+        Args:
+            path (str): 出力ファイルパス
+            dataset (dict): COCO形式データ（annotations以外を先に書き出す）
+        """
+        _utils.make_parent_dir(path)
+        self._fp = open(path, "w")
+        self._num_annos = 0
+
+        # annotations以外の項目を書き出してannotationsの配列を開く
+        header = {k: v for k, v in dataset.items() if k != "annotations"}
+        header_str = json.dumps(header)
+        self._fp.write(header_str[:-1])
+        if header:
+            self._fp.write(", ")
+        self._fp.write('"annotations": [')
+
+    def write_annotations(
+        self,
+        annos: list,
+    ):
+        """アノテーションの追記"""
+        for anno in annos:
+            if self._num_annos > 0:
+                self._fp.write(", ")
+            json.dump(anno, self._fp)
+            self._num_annos += 1
+
+    def close(self):
+        """annotationsの配列とファイルを閉じる"""
+        self._fp.write("]}")
+        self._fp.close()
+
+
 def main():
     """メイン処理"""
     # コマンドライン引数を取得
@@ -93,6 +362,128 @@ def main():
     if args.sam_checkpoint is None or args.sam_checkpoint == "":
         args.sam_checkpoint = _SAM_CHECKPOINT_MAP[args.sam_model_type]
 
+    if not Path(args.anno_file).exists():
+        # アノテーションファイルが存在しない
+        raise RuntimeError(f"Not found annotation file. {args.anno_file=}")
+
+    if args.merge_only:
+        # 各シャードのジャーナルを結合するだけ
+        _merge_journals(args)
+        return
+
+    if args.num_workers > 1:
+        # シャードをさらにワーカー数で分割して、ワーカーごとにプロセスを起動する
+        _launch_workers(args)
+    else:
+        _run_shard(args)
+
+    if args.num_shards == 1:
+        # 全画像を処理し終えたので最終的なCOCO形式ファイルを組み立てる
+        _merge_journals(args)
+    else:
+        print("Run with --merge_only after all shards have finished.")
+
+
+def _launch_workers(
+    args: CommandLineArguments,
+):
+    """ワーカープロセスの起動
+
+    シャード i をワーカー数 N で分割し、シャード (i * N + k) / (num_shards * N) をワーカー k で処理する
+    PyTorchのスレッド数は指定が無ければCPUコア数をワーカー数で分け合う
+    デバイスの指定が無ければ、ワーカー k にGPUを順に割り当てる（GPUが無ければCPU）
+    """
+    num_workers = args.num_workers
+    if args.num_threads > 0:
+        num_threads = args.num_threads
+    else:
+        num_threads = max((os.cpu_count() or 1) // num_workers, 1)
+
+    worker_args_list = [
+        dataclasses.replace(
+            args,
+            shard_index=args.shard_index * num_workers + k,
+            num_shards=args.num_shards * num_workers,
+            num_workers=1,
+            num_threads=num_threads,
+            device=_default_device(args.device, k),
+        )
+        for k in range(num_workers)
+    ]
+
+    # CUDAを使う場合に備えてspawnで起動する
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context) as executor:
+        futures = [executor.submit(_run_shard, worker_args) for worker_args in worker_args_list]
+        errors = []
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+    if errors:
+        raise RuntimeError(f"{len(errors)} worker(s) failed.") from errors[0]
+
+
+def _default_device(
+    device: str,
+    worker_index: int = 0,
+) -> str:
+    """推論デバイスの決定
+
+    Args:
+        device (str): 指定のデバイス（空でなければそのまま使う）
+        worker_index (int): ワーカーのインデックス（GPUを順に割り当てるため）
+    """
+    if device is not None and device != "":
+        return device
+    if torch.cuda.is_available():
+        return f"cuda:{worker_index % torch.cuda.device_count()}"
+    return "cpu"
+
+
+def _journal_file(
+    args: CommandLineArguments,
+    shard_index: int = None,
+    num_shards: int = None,
+) -> str:
+    """シャードのジャーナルファイルパス
+
+    ジャーナルファイルの指定があればそれを、無ければ出力ファイルパスを元にする
+    複数シャードの場合は、シャードごとに別のファイルになるように ".shard-i-of-N" を付ける
+
+    Args:
+        shard_index (int): シャードのインデックス（Noneの場合はargs.shard_index）
+        num_shards (int): 全体のシャード数（Noneの場合はargs.num_shards）
+    """
+    shard_index = args.shard_index if shard_index is None else shard_index
+    num_shards = args.num_shards if num_shards is None else num_shards
+    shard_suffix = "" if num_shards == 1 else f".shard-{shard_index:04d}-of-{num_shards:04d}"
+    if args.journal_file is not None and args.journal_file != "":
+        return args.journal_file + shard_suffix
+    return args.output_file + shard_suffix + ".journal.jsonl"
+
+
+def _journal_header(
+    anno_file_hash: str,
+    shard_index: int,
+    num_shards: int,
+) -> dict:
+    """ジャーナルのヘッダ（アノテーションファイルとシャードの分割が同じ実行の結果だけを使うため）"""
+    return {
+        "anno_file_hash": anno_file_hash,
+        "shard_index": shard_index,
+        "num_shards": num_shards,
+    }
+
+
+def _run_shard(
+    args: CommandLineArguments,
+):
+    """1シャード分のBBoxをセグメンテーションに変換してジャーナルに記録する"""
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
     # 画像ディレクトリ内の画像ファイルを取得
     img_paths = _utils.find_image_files(args.img_dir, recursive=False)
     img_name_to_path = {Path(p).name: p for p in img_paths}
@@ -101,56 +492,283 @@ def main():
         # 画像ファイル名（親ディレクトリパス部を除く）の重複エラー
         raise RuntimeError("len(img_paths) != len(set(img_filenames))")
 
-    if not Path(args.anno_file).exists():
-        # アノテーションファイルが存在しない
-        raise RuntimeError(f"Not found annotation file. {args.anno_file=}")
-
     # アノテーションファイルの読み込み
     coco = pycocotools.coco.COCO(args.anno_file)
 
+    # 処理結果のジャーナル
+    journal_file = _journal_file(args)
+    journal = ResultJournal(
+        journal_file,
+        _journal_header(_file_hash(args.anno_file), args.shard_index, args.num_shards),
+    )
+    if args.discard_journal:
+        journal.discard()
+
+    # ジャーナルにある画像は処理済みなのでスキップする
+    done_img_ids = journal.load_image_ids()
+    if done_img_ids:
+        print(f"Resume from journal. {len(done_img_ids)=}, {journal_file=}")
+
+    # 画像IDの昇順に並べてシャード数で振り分ける（どのマシンでも同じ分割になる）
+    shard_img_ids = sorted(coco.imgs.keys())[args.shard_index::args.num_shards]
+
+    # BBoxがある未処理の画像のみ処理する
+    # 画像ファイルが見つからないときはここでエラーにする
+    targets = [
+        (img_id, img_name_to_path[coco.imgs[img_id]["file_name"]])
+        for img_id in shard_img_ids
+        if len(coco.imgToAnns[img_id]) > 0 and img_id not in done_img_ids
+    ]
+
+    # 画像ごとにSAMで変換するアノテーションと、前回の結果を使い回すアノテーションに分ける
+    # targets: (画像ID, 画像パス, 変換するアノテーションリスト, 使い回す結果リスト)
+    if args.incremental_index is not None and args.incremental_index != "":
+        targets = _split_incremental_targets(args, coco, targets, journal)
+    else:
+        targets = [
+            (img_id, img_path, coco.imgToAnns[img_id], [])
+            for img_id, img_path in targets
+        ]
+    print(f"shard {args.shard_index}/{args.num_shards}: {len(targets)=}")
+    if len(targets) == 0:
+        # 結合時にこのシャードの処理完了を確認できるように、完了の記録だけのジャーナルも残す
+        journal.open()
+        journal.mark_complete()
+        journal.close()
+        return
+
     # SAMモデルのインスタンス生成
     predictor = SamPredictorWrapper(
         model_type=args.sam_model_type,
         checkpoint=args.sam_checkpoint,
-        device='cuda:0'
+        device=_default_device(args.device),
+        cache_dir=args.embedding_cache_dir,
+        precision=args.precision,
     )
 
-    for img_id, img_info in coco.imgs.items():
-        img_name = img_info["file_name"]
-        # img_path = Path(args.img_dir) / img_filename
-        img_path = img_name_to_path[img_name]
+    def load_image(target):
+        """画像読み込みステージ"""
+        img_id, img_path, annos, reused = target
         print(f"{img_path=}")
+        return (img_id, annos, reused), _utils.load_image(img_path)
+
+    def encode_images(items):
+        """画像エンコードステージ（複数画像をまとめてエンコード）"""
+        embeddings = predictor.set_images(
+            [img for _, img in items],
+            img_format="RGB",
+            batch_size=len(items),
+        )
+        # 画像はここで手放して後段に持ち越さない
+        return [(target, emb) for (target, _), emb in zip(items, embeddings)]
+
+    def decode_masks(item):
+        """マスク推論ステージ（画像内の全BBoxを1回のデコーダ呼び出しで処理）"""
+        (img_id, annos, reused), embedding = item
+
+        # COCOのBBoxはXYWH形式なのでXYXY形式に変換する
+        boxes = np.array([anno["bbox"] for anno in annos], dtype=np.float32)
+        boxes[:, 2:] += boxes[:, :2]
+
+        masks, scores = predictor.predict_boxes(
+            boxes,
+            multimask_output=False,
+            embedding=embedding,
+        )
+        print(f"{img_id=}, {len(boxes)=}, {masks.shape=}")
+        return (img_id, annos, reused), masks[:, 0]
+
+    def convert_polygons(item):
+        """ポリゴン変換ステージ"""
+        (img_id, annos, reused), masks = item
+        results = list(reused)
+        for anno, mask in zip(annos, masks):
+            result = {
+                "id": anno["id"],
+                "segmentation": convert_mask_to_polygon(mask),
+                "iscrowd": 0,
+            }
+            if "_index_key" in anno:
+                result["key"] = anno["_index_key"]
+            results.append(result)
+        return img_id, results
+
+    def write_journal(item):
+        """ジャーナル書き込みステージ"""
+        img_id, results = item
+        journal.append(img_id, results)
+
+    pipeline = Pipeline(
+        stages=[
+            PipelineStage("load", load_image, num_workers=args.num_load_workers),
+            PipelineStage("encode", encode_images, batch_size=args.encode_batch_size),
+            PipelineStage("decode", decode_masks),
+            PipelineStage("polygon", convert_polygons, num_workers=args.num_polygon_workers),
+            PipelineStage("write", write_journal),
+        ],
+        queue_size=args.queue_size,
+    )
 
-        # 画像ファイル読み込み
-        org_img = _utils.load_image(img_path)
-
-        # 画像埋め込み
-        predictor.set_image(org_img, img_format='RGB')
-
-        # BBoxごとに処理
-        annos = coco.imgToAnns[img_id]
-        anno_id_to_seg = {}
-        for anno in annos:
-            anno_id = anno["id"]
-            bbox = anno["bbox"]
-
-            # アノテーションのBBoxをSAMのプロンプトに指定
-            predictor.set_prompt(box=bbox)
-
-            # マスク推論
-            masks = predictor.predict(multimask_output=False)
-            print(f"{bbox=}, {masks.shape}")
-
-            # マスクをポリゴンデータに変換
-            mask = masks[0]
-            polygon = convert_mask_to_polygon(mask)
-            anno_id_to_seg[anno_id] = polygon
-
-            coco.anns[anno_id]["segmentation"] = polygon
-            coco.anns[anno_id]["iscrowd"] = 0
-
-    with open("output.json", "w") as fp:
-        json.dump(coco.dataset, fp)
+    # 中断（Ctrl-Cなど）された場合も処理中の画像は最後まで処理してジャーナルに残す
+    journal.open()
+    try:
+        pipeline.run(targets)
+        journal.mark_complete()
+    finally:
+        journal.close()
+
+        # ステージごとの稼働率
+        print(pipeline.report())
+
+
+def _split_incremental_targets(
+    args: CommandLineArguments,
+    coco: pycocotools.coco.COCO,
+    targets: list,
+    journal: ResultJournal,
+) -> list:
+    """差分変換の対象振り分け
+
+    インデックスにあるBBoxは前回の結果を使い回し、全BBoxが使い回せる画像はここでジャーナルに記録する
+
+    Returns:
+        list: (画像ID, 画像パス, 変換するアノテーションリスト, 使い回す結果リスト) のリスト
+    """
+    index = _SegmentationIndex(args.incremental_index)
+    index.load()
+    model_id = f"{args.sam_model_type}:{Path(args.sam_checkpoint).name}:{args.precision}"
+
+    # 画像ファイルのハッシュ値を並列に算出
+    with ThreadPoolExecutor(max_workers=args.num_load_workers) as executor:
+        file_hashes = list(executor.map(_file_hash, [img_path for _, img_path in targets]))
+
+    new_targets = []
+    num_reused = 0
+    num_changed = 0
+    journal.open()
+    try:
+        for (img_id, img_path), file_hash in zip(targets, file_hashes):
+            annos = []
+            reused = []
+            for anno in coco.imgToAnns[img_id]:
+                key = _SegmentationIndex.make_key(
+                    file_hash, anno["bbox"], anno["category_id"], model_id)
+                seg = index.get(key)
+                if seg is None:
+                    annos.append(dict(anno, _index_key=key))
+                else:
+                    reused.append({
+                        "id": anno["id"],
+                        "segmentation": seg,
+                        "iscrowd": 0,
+                        "key": key,
+                    })
+            num_reused += len(reused)
+            num_changed += len(annos)
+
+            if len(annos) == 0:
+                # 変更の無い画像は画像の読み込みもエンコードも不要
+                journal.append(img_id, reused)
+            else:
+                new_targets.append((img_id, img_path, annos, reused))
+    finally:
+        journal.close()
+
+    print(f"Incremental: {len(index)=}, {num_reused=}, {num_changed=}")
+    return new_targets
+
+
+def _merge_journals(
+    args: CommandLineArguments,
+):
+    """各シャードのジャーナルを結合してCOCO形式ファイルを出力する
+
+    ジャーナルは1行ずつ読みながら書き出すので、変換結果全体をメモリに載せない
+    ジャーナルに無いアノテーション（BBoxの無い画像など）は元のまま最後に書き出す
+    結合に成功したらジャーナルは削除する（次回の実行で古い結果を読み込まないため）
+
+    Raises:
+        RuntimeError: 無いシャードのジャーナル、ヘッダが一致しない
+            （別のアノテーションファイルやシャードの分割で作られた）ジャーナル、
+            または完了の記録が無い（処理途中の）ジャーナルがある場合
+            （変換されていないアノテーションを含む出力ファイルを作らないため）
+    """
+    anno_file_hash = _file_hash(args.anno_file)
+    # ワーカープロセスで分割した場合も含めた全体のシャード数
+    num_shards = args.num_shards * max(args.num_workers, 1)
+    journals = [
+        ResultJournal(
+            _journal_file(args, shard_index=i, num_shards=num_shards),
+            _journal_header(anno_file_hash, i, num_shards),
+        )
+        for i in range(num_shards)
+    ]
+    missing = [str(journal.path) for journal in journals if not journal.path.exists()]
+    stale = [
+        str(journal.path) for journal in journals
+        if journal.path.exists() and not journal.is_valid()
+    ]
+    incomplete = [
+        str(journal.path) for journal in journals
+        if journal.is_valid() and not journal.is_complete()
+    ]
+    if missing or stale or incomplete:
+        raise RuntimeError(
+            f"Incomplete shard journals. {missing=}, {stale=}, {incomplete=}")
+    print(f"Merge journals. {[str(journal.path) for journal in journals]}")
+
+    # 元のアノテーション情報（結合結果はここにセグメンテーションを上書きして書き出す）
+    with open(args.anno_file, encoding="utf8") as fp:
+        dataset = json.load(fp)
+    anno_id_to_anno = {anno["id"]: anno for anno in dataset.get("annotations", [])}
+
+    # 差分変換用のインデックスは今回の結果で書き直す（今回のデータに無いエントリは消える）
+    index = None
+    index_fp = None
+    if args.incremental_index is not None and args.incremental_index != "":
+        index = _SegmentationIndex(args.incremental_index)
+        index_fp = index.open_writer()
+
+    # 書き込み途中のファイルが残らないように一時ファイル経由で出力する
+    tmp_file = args.output_file + ".tmp"
+    writer = _StreamingCocoWriter(tmp_file, dataset)
+    written_anno_ids = set()
+    try:
+        for journal in journals:
+            for img_id, results in journal.iter_records():
+                annos = []
+                for result in results:
+                    anno_id = result["id"]
+                    if anno_id in written_anno_ids or anno_id not in anno_id_to_anno:
+                        continue
+                    anno = dict(anno_id_to_anno[anno_id])
+                    anno["segmentation"] = result["segmentation"]
+                    anno["iscrowd"] = result["iscrowd"]
+                    annos.append(anno)
+                    written_anno_ids.add(anno_id)
+
+                    if index_fp is not None and "key" in result:
+                        index_fp.write(json.dumps({
+                            "key": result["key"],
+                            "segmentation": result["segmentation"],
+                        }) + "\n")
+                writer.write_annotations(annos)
+
+        # 変換対象外のアノテーションはそのまま書き出す
+        writer.write_annotations([
+            anno for anno_id, anno in anno_id_to_anno.items()
+            if anno_id not in written_anno_ids
+        ])
+    finally:
+        writer.close()
+    os.replace(tmp_file, args.output_file)
+
+    if index is not None:
+        index.commit_writer(index_fp)
+
+    # 結果は出力ファイル（とインデックス）に反映したのでジャーナルは不要
+    for journal in journals:
+        journal.discard()
 
 
 if __name__ == '__main__':
@@ -9,6 +9,7 @@ from . import _utils
 from .annotation_repository import AnnotationRepository
 from .key_const import *
 from ._logger import Logger
+from ._proposal_index import ProposalIndex, proposal_index_path
 from .sam_predictor_wrapper import SamPredictorWrapper
 
 # SAMのチェックポイントを配置しているディレクトリへのパス
@@ -95,6 +96,12 @@ class MainApp:
         # SAM推論インスタンス
         self._sam_predictor = None
 
+        # 実行中のSAM推論（concurrent.futures.Future）
+        self._pending_prediction = None
+
+        # 実行中の高精度モデルのSAM推論（concurrent.futures.Future）
+        self._pending_refinement = None
+
         # SAMnのモデルタイプ
         assert args.model_type in _SAM_MODEL_TYPES
         self._model_type = args.model_type
@@ -105,6 +112,39 @@ class MainApp:
         # 処理結果の出力先フォルダパス
         self._output_root_dir = args.output_root_dir
 
+        # 画像埋め込みのキャッシュフォルダパス
+        self._embedding_cache_dir = args.embedding_cache_dir
+
+        # 先読みエンコードする次と前の画像の数
+        self._num_prefetch_next = args.num_prefetch_next
+        self._num_prefetch_prev = args.num_prefetch_prev
+
+        # SAMの推論精度
+        self._precision = args.precision
+
+        # プレビュー後に結果を置き換える高精度モデルのモデルタイプ（空文字の場合は使用しない）
+        assert args.refine_model_type in [""] + _SAM_MODEL_TYPES
+        self._refine_model_type = args.refine_model_type
+
+        # 操作が無いときにモデルを解放するまでの秒数
+        self._idle_timeout_sec = args.idle_timeout_sec
+
+        # ROIモード（高解像度画像の小さな範囲へのクリックは周辺を等倍でエンコードする）の初期状態
+        self._roi_mode = args.roi_mode
+
+        # 事前計算したマスク候補インデックスのディレクトリ（空文字の場合は使用しない）
+        self._proposal_index_dir = args.proposal_index_dir
+
+        # クリック時に採用するマスク候補の予測IoUの下限
+        self._proposal_min_score = args.proposal_min_score
+
+        # 現在の画像のマスク候補インデックス（無い場合はNone）
+        self._proposal_index: ProposalIndex = None
+
+        # マスク推論と画像エンコーダの実行方式
+        self._decoder_backend = args.decoder_backend
+        self._encoder_backend = args.encoder_backend
+
         # 初期化処理
         self._initialize()
 
@@ -122,14 +162,25 @@ class MainApp:
         with self._lock:
 
             # SAM推論インスタンスの生成
+            # ウィンドウと最初の画像をすぐに表示できるようにモデルはバックグラウンドで読み込む
+            # 読み込み中の画像エンコードや推論の要求は読み込み完了まで待機する
             # model_type = SAM_MODEL_TYPES[0]
             model_type = "vit_b"
             model_checkpoint = _SAM_CHECKPOINT_MAP[model_type]
             self._sam_predictor = SamPredictorWrapper(
                 model_type=model_type,
                 checkpoint=model_checkpoint,
-                device='cuda'
+                device='cuda',
+                cache_dir=self._embedding_cache_dir,
+                precision=self._precision,
+                decoder_backend=self._decoder_backend,
+                encoder_backend=self._encoder_backend,
+                load_in_background=True,
+                idle_timeout_sec=self._idle_timeout_sec,
+                refine_model_type=self._refine_model_type,
+                refine_checkpoint=_SAM_CHECKPOINT_MAP.get(self._refine_model_type, None),
             )
+            self._sam_predictor.set_roi_mode(self._roi_mode)
 
             # ウィンドウ生成
             # cv2.WindowFlags
@@ -160,6 +211,10 @@ class MainApp:
     def _deinitialize(self):
         """終了処理"""
         with self._lock:
+            # SAMのモデルとワーカースレッドの解放
+            if self._sam_predictor is not None:
+                self._sam_predictor.release()
+
             # ウィンドウの破棄
             # desroyAllWindowsで破棄済みの可能性を考慮してtryで囲む
             try:
@@ -171,6 +226,9 @@ class MainApp:
         """メイン処理実行"""
         self.alive = True
         while self.alive:
+            # 完了したSAM推論結果の反映
+            self._poll_sam_prediction()
+
             # ウィンドウ更新
             self._update_window()
 
@@ -220,6 +278,9 @@ class MainApp:
             elif key == KEY_E:
                 # エクスポート
                 self._save()
+            elif key in (KEY_r, KEY_R):
+                # ROIモードの切り替え
+                self._toggle_roi_mode()
             else:
                 pass
 
@@ -227,6 +288,13 @@ class MainApp:
         # TODO 実装
         pass
 
+    def _toggle_roi_mode(self):
+        """ROIモードの切り替え"""
+        with self._lock:
+            self._roi_mode = not self._roi_mode
+            self._sam_predictor.set_roi_mode(self._roi_mode)
+            Logger.info(f"{self._roi_mode=}")
+
     def _mouse_callbck(
         self,
         event: int,
@@ -261,8 +329,10 @@ class MainApp:
             elif event == cv2.EVENT_MBUTTONDOWN:
                 pass
             elif event == cv2.EVENT_LBUTTONUP:
-                self._sam_predictor.set_prompt_point(x, y)
-                self._run_sam_prediction()
+                # 事前計算したマスク候補があればそれを使い、無ければSAMで推論する
+                if not self._apply_proposal(x, y):
+                    self._sam_predictor.set_prompt_point(x, y)
+                    self._run_sam_prediction()
             elif event == cv2.EVENT_RBUTTONUP:
                 pass
             elif event == cv2.EVENT_MBUTTONUP:
@@ -328,6 +398,38 @@ class MainApp:
             img_path = self._anno_repository.get_prev_image_path()
             self._update_window_image(img_path)
 
+    def _load_proposal_index(self, img_path) -> ProposalIndex:
+        """マスク候補インデックスの読み込み（無い場合はNone）"""
+        if self._proposal_index_dir is None or self._proposal_index_dir == "":
+            return None
+        path = proposal_index_path(self._proposal_index_dir, img_path)
+        index = ProposalIndex.load(path)
+        Logger.debug(f"Proposal index. {path=}, {len(index) if index is not None else None}")
+        return index
+
+    def _apply_proposal(self, x: int, y: int) -> bool:
+        """クリック位置のマスク候補の反映
+
+        Returns:
+            bool: マスク候補を反映したか（該当する候補が無い場合はFalse）
+        """
+        with self._lock:
+            if self._proposal_index is None:
+                return False
+            idx = self._proposal_index.lookup(x, y, min_score=self._proposal_min_score)
+            if idx < 0:
+                return False
+
+            # 実行中のSAM推論の結果で上書きしない
+            self._pending_prediction = None
+            self._pending_refinement = None
+
+            # 結果のマスクはクリア時に書き換えるので複製する
+            self._segment_mask = self._proposal_index.mask(idx).copy()
+            Logger.debug(f"Proposal hit. {idx=}, {self._proposal_index.scores[idx]=}")
+            self._update_window()
+            return True
+
     def _run_sam_prediction(self):
         """SAM推論の実行"""
         with self._lock:
@@ -339,13 +441,72 @@ class MainApp:
             # )
 
             # SAMセグメンテーション実行
-            masks = self._sam_predictor.predict(
+            # 画像エンコード中でもUIを止めないように非同期で実行し、結果はメインループで反映する
+            # 結果はマスクの範囲だけのコンパクト表現で受け取り、表示用のマスクに書き込む
+            self._pending_prediction = self._sam_predictor.predict_async(
                 multimask_output=False,
+                compact=True,
             )
 
-            Logger.debug(f"{masks.shape=}, {masks.dtype=}")
-            self._segment_mask = masks[0]
-            self._update_window()
+            # 高精度モデルの画像エンコード完了後に同じプロンプトで推論し直し、結果を置き換える
+            self._pending_refinement = self._sam_predictor.predict_refined_async(
+                multimask_output=False,
+                compact=True,
+            )
+
+    def _poll_sam_prediction(self):
+        """完了したSAM推論結果の反映"""
+        with self._lock:
+            # 高精度モデルの結果
+            masks = self._pop_prediction_result("_pending_refinement")
+            if masks is not None:
+                Logger.debug(f"Refined. {masks[0].bbox=}, {masks[0].nbytes=}")
+                # 高精度モデルの結果が先に出たときはプレビュー結果で上書きしない
+                self._pending_prediction = None
+                self._set_segment_mask(masks[0])
+                self._update_window()
+                return
+
+            # プレビュー（または単一モデル）の結果
+            masks = self._pop_prediction_result("_pending_prediction")
+            if masks is not None:
+                Logger.debug(f"{masks[0].bbox=}, {masks[0].nbytes=}")
+                self._set_segment_mask(masks[0])
+                self._update_window()
+
+    def _set_segment_mask(self, mask):
+        """SAM推論結果（CompactMask）を表示用のマスクに反映
+
+        表示用のマスクを使い回して、推論結果ごとに元画像サイズの配列を確保しない
+        """
+        with self._lock:
+            if self._segment_mask.shape != mask.shape:
+                self._segment_mask = mask.to_full()
+                return
+            self._segment_mask[:] = False
+            mask.paste(self._segment_mask)
+
+    def _pop_prediction_result(self, attr_name: str):
+        """完了したSAM推論結果の取り出し
+
+        Args:
+            attr_name (str): 実行中のSAM推論（Future）を保持する属性名
+
+        Returns:
+            np.ndarray: マスク（未完了、失敗、または推論中に画像が切り替わったときはNone）
+        """
+        with self._lock:
+            future = getattr(self, attr_name)
+            if future is None or not future.done():
+                return None
+            setattr(self, attr_name, None)
+
+            try:
+                # 推論中に画像が切り替わったときはNoneになるので結果を捨てる
+                return future.result()
+            except Exception as e:
+                Logger.error(f"SAM prediction failed. {e=}")
+                return None
 
     def _clear_sam_result(self):
         """SAM推論結果のクリア"""
@@ -364,11 +525,36 @@ class MainApp:
 
                 # 入力画像パスが変わったときは読み込み
                 rgb_img = _utils.load_image(self._input_img_path)
+                # 表示側では書き換えないので、書き込み不可にしてSAMと複製せずに共有する
+                rgb_img.setflags(write=False)
                 self._input_img_rgb = rgb_img
                 self._segment_mask = np.zeros(rgb_img.shape[:2], bool)
+                self._proposal_index = self._load_proposal_index(self._input_img_path)
+                if (self._proposal_index is not None
+                        and self._proposal_index.image_size != tuple(rgb_img.shape[:2])):
+                    Logger.warn(f"Proposal index size mismatch. {self._proposal_index.image_size=}")
+                    self._proposal_index = None
 
                 # 読み込んだ画像をSAMにエンコード
-                self._sam_predictor.set_image(rgb_img, img_format="RGB")
+                self._pending_prediction = None
+                self._pending_refinement = None
+                self._sam_predictor.set_image(
+                    rgb_img,
+                    img_format="RGB",
+                    img_path=self._input_img_path,
+                )
+
+                Logger.debug(f"{self._sam_predictor.encode_stats=}")
+                Logger.debug(f"{self._sam_predictor.preprocess_stats=}")
+                Logger.debug(f"{self._sam_predictor.memory_stats()=}")
+
+                # 前後の画像をバックグラウンドで先読みエンコード
+                self._sam_predictor.prefetch(
+                    self._anno_repository.get_neighbor_image_paths(
+                        num_next=self._num_prefetch_next,
+                        num_prev=self._num_prefetch_prev,
+                    )
+                )
 
                 # SAM結果をクリア
                 self._clear_sam_result()
@@ -387,6 +573,29 @@ class MainApp:
             )
             overlay_img_bgr = cv2.cvtColor(overlay_img_rgb, cv2.COLOR_RGB2BGR)
 
+            # モデル読み込み中・画像エンコード中の表示
+            status_text = None
+            if not self._sam_predictor.model_loaded:
+                status_text = "loading model..."
+            elif not self._sam_predictor.embedding_ready:
+                status_text = "encoding..."
+            elif (self._sam_predictor.has_refiner
+                  and not self._sam_predictor.refined_embedding_ready):
+                status_text = "refining..."
+            if self._roi_mode:
+                status_text = "[ROI] " + (status_text or "")
+            if status_text is not None:
+                cv2.putText(
+                    overlay_img_bgr,
+                    text=status_text,
+                    org=(10, 30),
+                    fontFace=cv2.FONT_HERSHEY_SIMPLEX,
+                    fontScale=1.0,
+                    color=(0, 255, 255),
+                    thickness=2,
+                    lineType=cv2.LINE_AA,
+                )
+
             cv2.imshow(
                 self._winname_overlay,
                 overlay_img_bgr
@@ -1,30 +1,203 @@
+import gc
+import math
 import threading
+import time
+import warnings
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial, wraps
+from pathlib import Path
 
 from segment_anything import SamPredictor, sam_model_registry
 from segment_anything.modeling import Sam
+from segment_anything.utils.transforms import ResizeLongestSide
+import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
+
+from . import _utils
+from ._compact_mask import CompactMask
+from ._decode_cache import DecodeResultCache, make_decode_key
+from ._logger import Logger
+from ._encode_worker import EncodeWorker, EncodeCancelledError
+from ._onnx_decoder import OnnxMaskDecoder
+from ._embedding_cache import (
+    ImageEmbedding,
+    DiskEmbeddingCache,
+    MemoryEmbeddingCache,
+    make_embedding_key,
+    make_file_embedding_key,
+)
 
 # TODO: スレッド利用有無の切り替えができるようにする
 
+
+def _uses_model(fn):
+    """モデルを使用するメソッドのデコレータ
+
+    モデルが解放済みであれば読み込み直し、実行中はアイドル時の解放を行わないようにする
+    """
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        self._acquire_model()
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            self._release_model()
+    return wrapper
+
+
+# 推論精度と自動混合精度（autocast）で使うデータ型の対応
+# int8は画像エンコーダの線形層を動的量子化し、それ以外はfp32で推論する
+_PRECISION_DTYPE_MAP = {
+    "fp32": None,
+    "bf16": torch.bfloat16,
+    "int8": None,
+}
+
+# segment_anythingの全モデル共通の画像エンコーダの入力サイズ
+# モデルの読み込み完了前でもキャッシュキーの算出や先読みの縮小ができるように使う
+_SAM_IMAGE_SIZE = 1024
+
 class SamPredictorWrapper:
     """SamPredictorクラスのラッパー"""
 
+    # ROIモードでタイルの位置を揃える間隔（タイルの一辺に対する割合）
+    # 近くへのクリックで同じタイルになり、タイルの画像埋め込みをキャッシュから再利用できる
+    _ROI_GRID_RATIO = 0.25
+
+    # ROIモードで切り出して推論するプロンプトの範囲の上限（タイルの一辺に対する割合）
+    _ROI_MAX_PROMPT_RATIO = 0.5
+
     def __init__(
         self,
         model_type: str,
         checkpoint: str,
         device: str,
+        cache_dir: str = None,
+        cache_max_bytes: int = 1 << 30,
+        memory_cache_max_bytes: int = 256 << 20,
+        memory_cache_max_entries: int = 8,
+        precision: str = "fp32",
+        model_cache_dir: str = None,
+        decoder_backend: str = "torch",
+        encoder_backend: str = "eager",
+        load_in_background: bool = False,
+        idle_timeout_sec: float = 0,
+        refine_model_type: str = None,
+        refine_checkpoint: str = None,
+        roi_tile_size: int = 1024,
+        decode_cache_max_entries: int = 32,
+        decode_cache_max_bytes: int = 256 << 20,
     ):
         """コンストラクタ
 
         Args:
             model_type (str): モデルタイプ（"vit_h", "vit_l", or "vit_b"）
             checkpoint (str): モデルの重みパラメータファイルへのパス
+            cache_dir (str): 画像埋め込みのディスクキャッシュディレクトリ
+                Noneの場合、ディスクキャッシュは使用しない
+            cache_max_bytes (int): ディスクキャッシュの合計サイズ上限（バイト）
+            memory_cache_max_bytes (int): メモリキャッシュの合計サイズ上限（バイト）
+            memory_cache_max_entries (int): メモリキャッシュのエントリ数上限
+                0の場合、メモリキャッシュは使用しない
+            precision (str): 推論精度（"fp32", "bf16", or "int8"）
+                "bf16"の場合、画像エンコーダとマスクデコーダをbfloat16の自動混合精度で実行する
+                "int8"の場合、画像エンコーダの線形層をINT8に動的量子化する（CPUのみ）
+            model_cache_dir (str): 変換済みモデル（量子化した画像エンコーダ、ONNXデコーダ）の保存先ディレクトリ
+                Noneの場合、チェックポイントと同じディレクトリに保存する
+            decoder_backend (str): プロンプトエンコーダ・マスクデコーダの実行方式（"torch" or "onnx"）
+                "onnx"の場合、単一プロンプトの推論をonnxruntime（CPU）で実行する
+            encoder_backend (str): 画像エンコーダの実行方式（"eager" or "torchscript"）
+                "torchscript"の場合、1024x1024入力でトレースした画像エンコーダを使う
+                トレース結果は変換済みモデルとして保存し、次回以降の起動ではトレースしない
+                トレースした画像エンコーダは実行中の中断に対応しない
+            load_in_background (bool): モデルをバックグラウンドで読み込むフラグ
+                Trueの場合、コンストラクタはすぐに戻り、読み込み完了までの要求は待機状態になる
+            idle_timeout_sec (float): 要求が無い状態がこの秒数続いたらモデルと画像埋め込みを解放する
+                解放後の要求ではモデルを読み込み直す（0以下の場合、自動では解放しない）
+            refine_model_type (str): 結果を置き換える高精度モデルのモデルタイプ（Noneの場合は使用しない）
+                指定した場合、このモデルの結果をプレビューとして先に返し、
+                高精度モデルの画像エンコードはプレビュー用の画像エンコード後にバックグラウンドで行う
+            refine_checkpoint (str): 高精度モデルの重みパラメータファイルへのパス
+            roi_tile_size (int): ROIモードで切り出すタイルの一辺（ピクセル）
+                画像エンコーダの入力サイズと同じ場合、タイルは縮小せずに等倍でエンコードされる
+            decode_cache_max_entries (int): マスクデコード結果のキャッシュのエントリ数上限
+                0の場合、デコード結果はキャッシュしない
+            decode_cache_max_bytes (int): マスクデコード結果のキャッシュの合計サイズ上限（バイト）
         """
+        if precision not in _PRECISION_DTYPE_MAP:
+            raise ValueError(f"Unsupported precision. {precision=}")
+        if decoder_backend not in ("torch", "onnx"):
+            raise ValueError(f"Unsupported decoder backend. {decoder_backend=}")
+        if encoder_backend not in ("eager", "torchscript"):
+            raise ValueError(f"Unsupported encoder backend. {encoder_backend=}")
+        if encoder_backend == "torchscript" and precision == "bf16":
+            # トレース結果には自動混合精度が反映されないため
+            raise ValueError("TorchScript encoder does not support bf16 precision.")
+
         self._lock = threading.RLock()
 
-        self._thread_set_image = None
+        # 画像エンコーダの排他制御オブジェクト
+        self._encode_lock = threading.Lock()
+
+        # スレッドごとのエンコード中断判定関数
+        self._thread_local = threading.local()
+
+        # 画像エンコード要求の通し番号（最新の要求だけをSamPredictorに反映する）
+        self._image_request_id = 0
+
+        # 最新の要求画像の埋め込みがSamPredictorに反映済みのときセットされるイベント
+        self._embedding_ready = threading.Event()
+
+        # 反映済みの画像埋め込み
+        self._embedding: ImageEmbedding = None
+
+        # ROIモード（小さな範囲へのプロンプトは周辺を切り出して等倍でエンコードする）
+        self._roi_enabled = False
+        self._roi_tile_size = roi_tile_size
+
+        # マスク推論の実行スレッド（UIスレッドをブロックしないため）
+        # スレッド名は解放時に推論スレッド自身からの呼び出しを判定するためインスタンスごとに変える
+        self._decoder_thread_prefix = f"sam_decoder_{id(self):x}"
+        self._decode_executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix=self._decoder_thread_prefix,
+        )
+
+        # 画像エンコーダの入力テンソル（画像ごとに確保し直さないように使い回す）
+        self._input_buffer: torch.Tensor = None
+
+        # 前処理の統計情報
+        self._preprocess_stats = {
+            # 前処理した画像数
+            "images": 0,
+            # 縮小デコードで読み込んだ画像数
+            "reduced_decodes": 0,
+            # 書き込み不可の画像を複製せずに共有した数とバイト数
+            "copies_avoided": 0,
+            "copy_bytes_avoided": 0,
+            # 複製した数とバイト数
+            "copies": 0,
+            "copy_bytes": 0,
+            # 段階ごとの合計処理時間（秒）
+            "decode_sec": 0.0,
+            "resize_sec": 0.0,
+            "normalize_sec": 0.0,
+        }
+
+        # 画像エンコードの統計情報
+        self._encode_stats = {
+            # 画像エンコーダの実行回数
+            "encoder_passes": 0,
+            # 完了したが新しい要求に置き換えられて使われなかった画像エンコーダの実行回数
+            "redundant_passes": 0,
+            # ROIモードで切り出したタイルで推論した回数
+            "roi_predictions": 0,
+            # マスクがタイルの辺に接したため画像全体で推論し直した回数
+            "roi_fallbacks": 0,
+        }
 
         # Samインスタンス
         self._sam: Sam = None
@@ -35,6 +208,20 @@ class SamPredictorWrapper:
         # Sam埋め込みを算出する画像
         self._img = None
 
+        # 画像埋め込みのメモリキャッシュ（前後の画像への移動時に再エンコードしないため）
+        self._memory_cache = MemoryEmbeddingCache(
+            max_bytes=memory_cache_max_bytes,
+            max_entries=memory_cache_max_entries,
+        )
+
+        # 画像埋め込みのディスクキャッシュ
+        self._disk_cache = None
+        if cache_dir is not None and cache_dir != "":
+            self._disk_cache = DiskEmbeddingCache(
+                cache_dir=cache_dir,
+                max_bytes=cache_max_bytes,
+            )
+
         # Samに与えるプロンプト
         self._prompt = {
             "point_coords": None,
@@ -42,161 +229,2373 @@ class SamPredictorWrapper:
             "box": None,
         }
 
+        # 複数物体のプロンプト（物体IDと {"prompt": プロンプト, "version": 更新番号} の対応マップ）
+        self._objects = {}
+
+        # 物体IDの通し番号
+        self._next_object_id = 1
+
+        # 物体のプロンプトの更新番号（変更された物体だけをデコードし直すため）
+        self._object_version = 0
+
+        # 物体ごとの推論結果（物体IDと (結果のタグ, (マスク, スコア)) の対応マップ）
+        # タグは (画像埋め込みのキー, 更新番号, 複数マスク出力フラグ, コンパクト表現フラグ)
+        self._object_results = {}
+
+        # 単一プロンプトのマスクデコード結果のキャッシュ（同じプロンプトの再推論やアンドゥ・リドゥで再デコードしないため）
+        # 画像埋め込みが変わったら破棄する
+        self._decode_cache = DecodeResultCache(
+            max_entries=decode_cache_max_entries,
+            max_bytes=decode_cache_max_bytes,
+        )
+
         self._model_type = model_type
         self._checkpoint = checkpoint
+        self._precision = precision
+        self._model_cache_dir = model_cache_dir
+        self._decoder_backend = decoder_backend
+        self._encoder_backend = encoder_backend
+
+        # 画像エンコーダの入力サイズ（トレース後のモジュールからは取得できないため保持する）
+        self._image_size: int = _SAM_IMAGE_SIZE
+
+        # ONNX Runtimeのデコーダ（decoder_backendが"onnx"のときのみ）
+        self._onnx_decoder = None
+
+        # 推論精度の確認に使うfp32の画像エンコーダ（INT8のみ。最初の確認時に作り、解放まで使い回す）
+        self._fp32_image_encoder = None
+
         self._device = device if torch.cuda.is_available() else 'cpu'
+        if precision == "int8" and self._device != "cpu":
+            # 動的量子化の演算はCPUのみ対応
+            Logger.info(f"INT8 precision runs on CPU. {device=}")
+            self._device = "cpu"
 
-        self._initialize(
-            model_type,
-            checkpoint,
-        )
+        # モデルの読み込み完了時にセットされるイベント
+        self._model_loaded = threading.Event()
+
+        # モデルの読み込み中に発生した例外
+        self._load_error: Exception = None
+
+        # モデルの読み込みの段階ごとの処理時間（秒）
+        self._load_stats = {}
+
+        # モデルを解放済みか
+        self._unloaded = False
+
+        # モデルを使用中の処理数（使用中は解放しない）
+        self._model_users = 0
+
+        # モデル使用状況の変化通知
+        self._model_cond = threading.Condition(self._lock)
+
+        # 最後にモデルを使用した時刻（time.monotonic）
+        self._last_used = time.monotonic()
+
+        # 現在の画像（解放後の要求で画像埋め込みを算出し直すため）
+        self._current_image: tuple = None
+
+        # 解放により現在の画像の画像埋め込みを算出し直す必要があるか
+        self._needs_reencode = False
+
+        # 終了済みか
+        self._closed = threading.Event()
+
+        # 画像エンコード前に待機する関数 gate(cancel_fn)（高精度モデルでプレビューの完了を待つため）
+        self._encode_gate = None
+
+        # 画像エンコードのワーカー（対話要求と先読みを1スレッドで処理する）
+        # 読み込み中に登録されたジョブは読み込み完了まで待機する
+        self._encode_worker = EncodeWorker()
+
+        # 結果を置き換える高精度モデル
+        self._refiner: SamPredictorWrapper = None
+
+        # 現在の画像が高精度モデルでも推論できるか（set_image_embeddingで設定した画像は対象外）
+        self._refine_enabled = False
+
+        if refine_model_type is not None and refine_model_type != "":
+            self._refiner = SamPredictorWrapper(
+                model_type=refine_model_type,
+                checkpoint=refine_checkpoint,
+                device=device,
+                cache_dir=cache_dir,
+                cache_max_bytes=cache_max_bytes,
+                memory_cache_max_bytes=memory_cache_max_bytes,
+                memory_cache_max_entries=memory_cache_max_entries,
+                precision=precision,
+                model_cache_dir=model_cache_dir,
+                decoder_backend=decoder_backend,
+                encoder_backend=encoder_backend,
+                load_in_background=load_in_background,
+                roi_tile_size=roi_tile_size,
+                decode_cache_max_entries=decode_cache_max_entries,
+                decode_cache_max_bytes=decode_cache_max_bytes,
+            )
+            # プレビュー用の画像エンコードを優先する
+            self._refiner._encode_gate = self._wait_preview_embedding
+
+        if load_in_background:
+            self._load_thread = threading.Thread(
+                target=self._load_model,
+                name="sam_loader",
+                daemon=True,
+            )
+            self._load_thread.start()
+        else:
+            self._load_model()
+            if self._load_error is not None:
+                raise self._load_error
+
+        # アイドル時の自動解放
+        # 監視スレッドは弱参照でインスタンスを参照する（インスタンスの破棄を妨げないため）
+        self._idle_timeout_sec = idle_timeout_sec
+        if idle_timeout_sec > 0:
+            self._idle_thread = threading.Thread(
+                target=SamPredictorWrapper._idle_monitor,
+                args=(
+                    weakref.ref(self),
+                    self._closed,
+                    min(max(idle_timeout_sec / 4, 0.1), 10.0),
+                ),
+                name="sam_idle_monitor",
+                daemon=True,
+            )
+            self._idle_thread.start()
 
     def __del__(
         self
     ):
         """デストラクタ"""
-        with self._lock:
-            # TODO: GPUメモリキャッシュの明示的な解放処理を入れる
+        try:
+            self.release()
+        except Exception:
             pass
 
+    def release(self):
+        """全リソースの解放
+
+        実行中の画像エンコードを中断し、未実行の推論を取り消してから、
+        ワーカースレッドの終了を待ってモデルと画像埋め込みを解放する
+        ワーカースレッドや推論スレッドからの呼び出しでは自身の終了は待てないので、
+        モデルは実行中の処理がモデルの使用を終えた時点で解放する
+        解放後のインスタンスは使用できない
+        """
+        if getattr(self, "_closed", None) is None or self._closed.is_set():
+            return
+        self._closed.set()
+
+        # ジョブはロックを取るので、ロックを持たずに終了を待つ
+        current_thread = threading.current_thread()
+        if getattr(self, "_encode_worker", None) is not None:
+            self._encode_worker.stop(wait=True)
+        if getattr(self, "_decode_executor", None) is not None:
+            in_decoder = current_thread.name.startswith(self._decoder_thread_prefix)
+            self._decode_executor.shutdown(wait=not in_decoder, cancel_futures=True)
+        load_thread = getattr(self, "_load_thread", None)
+        if load_thread is not None and load_thread is not current_thread:
+            # 読み込み中のモデルも解放するため読み込みの完了を待つ
+            load_thread.join()
+        if self._refiner is not None:
+            self._refiner.release()
+
+        # 呼び出し元のスレッドがモデルを使用中の場合は待たない（使用終了時に解放される）
+        in_worker = (
+            self._encode_worker.is_worker_thread()
+            or current_thread.name.startswith(self._decoder_thread_prefix)
+        )
+        self.unload(wait=not in_worker)
+
+    def unload(
+        self,
+        wait: bool = True,
+    ) -> bool:
+        """モデルと画像埋め込みの解放
+
+        解放後に画像エンコードや推論を要求すると、モデルを読み込み直して処理する
+        現在の画像は次の推論要求時にエンコードし直す（ディスクキャッシュがあればそれを使う）
+
+        Args:
+            wait (bool): モデルを使用中の処理の完了を待つか
+                Falseの場合、使用中であれば解放しない
+
+        Returns:
+            bool: 解放したか
+        """
+        with self._model_cond:
+            if wait:
+                self._model_cond.wait_for(lambda: self._model_users == 0)
+            if self._model_users > 0 or self._unloaded or not self._model_loaded.is_set():
+                return False
+
+            memory_before = self.memory_stats()
+
+            self._sam = None
+            self._predictor = None
+            self._onnx_decoder = None
+            self._fp32_image_encoder = None
+            self._input_buffer = None
+            self._memory_cache.clear()
+            self._decode_cache.clear()
+
+            # 現在の画像はエンコードし直せるので画像埋め込みも解放する
+            # （set_image_embeddingで設定した画像埋め込みは呼び出し側の所有物なので残す）
+            if self._current_image is not None:
+                self._embedding = None
+                self._embedding_ready.clear()
+                self._needs_reencode = True
+
+            self._unloaded = True
+            self._model_loaded.clear()
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        Logger.info(f"SAM model unloaded. {memory_before=}, {self.memory_stats()=}")
+
+        if self._refiner is not None:
+            self._refiner.unload(wait=wait)
+        return True
+
+    def _acquire_model(self):
+        """モデル使用開始（解放済みであれば読み込み直す）"""
+        with self._model_cond:
+            self._model_users += 1
+            self._last_used = time.monotonic()
+            need_load = self._unloaded
+            if need_load:
+                # 他のスレッドは読み込み完了イベントで待機させる
+                self._unloaded = False
+                self._load_error = None
+
+        try:
+            if need_load:
+                Logger.info("Reload SAM model.")
+                self._load_model()
+            self._wait_model_loaded()
+        except Exception:
+            self._release_model()
+            raise
+
+    def _release_model(self):
+        """モデル使用終了（解放済みのインスタンスでは最後の使用終了時にモデルを解放する）"""
+        with self._model_cond:
+            self._model_users -= 1
+            self._last_used = time.monotonic()
+            self._model_cond.notify_all()
+            unload = self._closed.is_set() and self._model_users == 0
+        if unload:
+            self.unload(wait=False)
+
+    @staticmethod
+    def _idle_monitor(
+        self_ref: weakref.ref,
+        closed: threading.Event,
+        interval: float,
+    ):
+        """アイドル時の自動解放の監視スレッド関数
+
+        インスタンスは確認のたびに弱参照から取り出し、破棄されていれば終了する
+
+        Args:
+            self_ref (weakref.ref): インスタンスの弱参照
+            closed (threading.Event): インスタンスの終了イベント
+            interval (float): 確認間隔（秒）
+        """
+        while not closed.wait(interval):
+            self = self_ref()
+            if self is None:
+                return
+            self._unload_if_idle()
+            del self
+
+    def _unload_if_idle(self):
+        """アイドル時間が経過していればモデルを解放"""
+        with self._lock:
+            idle_sec = time.monotonic() - self._last_used
+            if (idle_sec < self._idle_timeout_sec
+                    or self._unloaded
+                    or self._model_users > 0):
+                return
+
+        # 先読みなどのジョブが残っているときは解放しない
+        if not self._encode_worker.wait_idle(timeout=0):
+            return
+
+        Logger.info(f"Unload idle SAM model. {idle_sec=:.1f}")
+        self.unload(wait=False)
+
+    def _resume_image(self):
+        """解放により失われた現在の画像の画像埋め込みを算出し直す"""
+        with self._lock:
+            if not self._needs_reencode or self._current_image is None:
+                return
+            self._needs_reencode = False
+            img, img_format, img_path = self._current_image
+            self._submit_image(img, img_format, img_path)
+
+    def memory_stats(self) -> dict:
+        """メモリ使用量
+
+        - rss_bytes, peak_rss_bytes: プロセスの常駐メモリの現在値とピーク（取得できない場合は-1）
+        - cuda_allocated_bytes, cuda_peak_allocated_bytes: CUDAメモリの現在値とピーク
+        - model_bytes: モデルの重みパラメータのバイト数（解放済みの場合は0）
+        - memory_cache_bytes: 画像埋め込みのメモリキャッシュのバイト数
+        - decode_cache_bytes: マスクデコード結果のキャッシュのバイト数
+        """
+        stats = _utils.get_process_memory()
+
+        if torch.cuda.is_available():
+            stats["cuda_allocated_bytes"] = torch.cuda.memory_allocated()
+            stats["cuda_peak_allocated_bytes"] = torch.cuda.max_memory_allocated()
+
+        with self._lock:
+            sam = self._sam
+        model_bytes = 0
+        if sam is not None:
+            for tensor in list(sam.parameters()) + list(sam.buffers()):
+                model_bytes += tensor.element_size() * tensor.nelement()
+        stats["model_bytes"] = model_bytes
+        stats["memory_cache_bytes"] = self._memory_cache.total_bytes
+        stats["decode_cache_bytes"] = self._decode_cache.stats["bytes"]
+        return stats
+
     @property
     def prompt(self):
         with self._lock:
             return self._prompt
 
-    def _initialize(
-        self,
-        model_type: str,
-        checkpoint: str
-    ):
-        """初期化"""
+    @property
+    def precision(self) -> str:
+        return self._precision
+
+    @property
+    def has_refiner(self) -> bool:
+        """高精度モデルを使用するか"""
+        return self._refiner is not None
+
+    @property
+    def refined_embedding_ready(self) -> bool:
+        """最新の要求画像の高精度モデルの埋め込みが推論に使える状態か"""
         with self._lock:
-            assert model_type in ("vit_h", "vit_l", "vit_b")
-            build_sam = sam_model_registry[model_type]
-            self._sam = build_sam(checkpoint)
-            self._sam.to(self._device)
-            self._predictor = SamPredictor(sam_model=self._sam)
+            return (self._refiner is not None
+                    and self._refine_enabled
+                    and self._refiner.embedding_ready)
 
-    def set_image(
+    @property
+    def roi_enabled(self) -> bool:
+        """ROIモードが有効か"""
+        with self._lock:
+            return self._roi_enabled
+
+    def set_roi_mode(
         self,
-        img: np.ndarray,
-        img_format: str,
+        enabled: bool,
     ):
-        """画像エンコード
+        """ROIモードの切り替え
+
+        有効にすると、プロンプトが画像の一部に収まるときは周辺のタイルを切り出して元の解像度でエンコードし、
+        タイル上で推論したマスクを元画像の座標に貼り戻す
+        画像全体を縮小してエンコードすると潰れてしまう高解像度画像の小さな物体向け
+        タイルの画像埋め込みは通常の画像埋め込みと同じくキャッシュされる
 
         Args:
-            img (np.ndarray): 画像
-            img_format (str): 画像フォーマット（'RGB' or 'BGR'）
+            enabled (bool): ROIモードを有効にするか
         """
-        # with self._lock:
-        #     self._predictor.set_image(img, image_format=img_format)
-        #     # TODO: マルチスレッド化
         with self._lock:
-            self._thread_set_image = threading.Thread(
-                target=self._set_image_thread,
-                args=(img.copy(), img_format)
-            )
-            self._thread_set_image.start()
+            self._roi_enabled = enabled
+            if self._refiner is not None:
+                self._refiner.set_roi_mode(enabled)
 
-    def _set_image_thread(self, img, img_format):
-        """画像埋め込みのスレッド関数"""
+    @property
+    def model_loaded(self) -> bool:
+        """モデルの読み込みが完了したか（失敗した場合も含む）"""
+        return self._model_loaded.is_set()
+
+    @property
+    def load_stats(self) -> dict:
+        """モデルの読み込みの段階ごとの処理時間（秒）
+
+        - read_sec: チェックポイントファイルの読み込み（mmap対応時はマッピングのみ）
+        - deserialize_sec: モデル構築と重みパラメータの復元
+        - to_device_sec: デバイスへの転送
+        - convert_sec: 量子化・トレース・ONNXエクスポートなどの変換（変換済みモデルの読み込みを含む）
+        - first_forward_sec: 最初の画像エンコーダの実行（最初のエンコード後に記録される）
+
+        解放後に読み込み直した場合は、読み込み直したときの値になる
+        """
         with self._lock:
-            self._predictor.set_image(img, image_format=img_format)
-            # TODO: マルチスレッド化
+            return self._load_stats.copy()
 
-    def set_prompt_point(
+    def wait_model_loaded(
         self,
-        x: int,
-        y: int,
-        label: int = 1
-    ):
-        """プロンプトに与えるポイントの指定
+        timeout: float = None,
+    ) -> bool:
+        """モデルの読み込み完了まで待機
 
         Args:
-            x (int): X座標
-            y (int): Y座標
-            label (int): ポイントの前景・背景ラベル（1: 前景、0: 背景）
+            timeout (float): タイムアウト（秒）
+
+        Returns:
+            bool: タイムアウトせずに読み込みが完了したか
         """
-        with self._lock:
-            self._prompt["point_coords"] = np.array([[x, y]])
-            self._prompt["point_labels"] = np.array([label])
-            
-    def set_prompt_points(
+        return self._model_loaded.wait(timeout)
+
+    def _wait_model_loaded(self):
+        """モデルの読み込み完了まで待機（失敗していれば例外を送出）"""
+        self._model_loaded.wait()
+        if self._load_error is not None:
+            raise RuntimeError("Failed to load SAM model.") from self._load_error
+
+    @property
+    def embedding_ready(self) -> bool:
+        """最新の要求画像の埋め込みが推論に使える状態か"""
+        return self._embedding_ready.is_set()
+
+    def wait_embedding_ready(
         self,
-        point_coords: np.ndarray,
-        point_labels: np.ndarray = None,
-    ):
-        """プロンプトに与えるポイントリストの指定
+        timeout: float = None,
+    ) -> bool:
+        """最新の要求画像の埋め込みが反映されるまで待機
 
         Args:
-            point_coords (np.ndarray): ポイントの座標リスト
-            point_labels (np.ndarray): ポイントの前景・背景ラベルリスト（1: 前景、0: 背景）
-                Noneの場合、ポイントはすべて前景扱いとする
+            timeout (float): タイムアウト（秒）
+
+        Returns:
+            bool: タイムアウトせずに反映されたか
+        """
+        return self._embedding_ready.wait(timeout)
+
+    @property
+    def preprocess_stats(self) -> dict:
+        """前処理の統計情報
+
+        - images: 前処理した画像数
+        - reduced_decodes: ファイルから縮小デコードで読み込んだ画像数（先読みとファイルパス指定のset_image）
+        - copies_avoided, copy_bytes_avoided: 書き込み不可の画像を複製せずにワーカーと共有した数とバイト数
+        - copies, copy_bytes: set_imageで複製した数とバイト数
+        - decode_sec, resize_sec, normalize_sec: 段階ごとの合計処理時間（秒）
         """
         with self._lock:
-            # 前景・背景ラベルの指定がないときは前景扱いとする
-            if point_labels is None:
-                point_labels = np.ones((len(point_coords),), np.int32)
+            return self._preprocess_stats.copy()
 
-            self._prompt["point_coords"] = point_coords
-            self._prompt["point_labels"] = point_labels
+    def _add_preprocess_stats(self, **kwargs):
+        """前処理の統計情報の加算"""
+        with self._lock:
+            for name, value in kwargs.items():
+                self._preprocess_stats[name] += value
 
-    def set_prompt_box(
-        self,
-        box: np.ndarray  # [x0, y0, x1, y1]形式 ([x0, y0, w, h] ではない)
-    ):
-        """プロンプトに与えるボックスの指定
+    @property
+    def encode_stats(self) -> dict:
+        """画像エンコードの統計情報
 
-        Args:
-            box (np.ndarray): ボックス（XYXY形式で指定。XYWH形式ではない）
+        - submitted: 対話的な画像エンコード要求数
+        - dropped: 実行前に新しい要求で置き換えられて破棄された数
+        - cancelled: 実行中に中断された数（先読みを含む）
+        - preempted: ROIモードのタイルのエンコードに割り込まれ、タイルの後でやり直した数
+        - background_done: 完了した先読み数
+        - encoder_passes: 画像エンコーダの実行回数
+        - redundant_passes: 完了したが新しい要求に置き換えられて使われなかった実行回数
+        - roi_predictions: ROIモードで切り出したタイルで推論した回数
+        - roi_fallbacks: マスクがタイルの辺に接したため画像全体で推論し直した回数
         """
         with self._lock:
-            self._prompt["box"] = box
+            stats = self._encode_worker.stats
+            stats.update(self._encode_stats)
+            return stats
 
-    def set_prompt(
+    def _count_encoder_pass(self):
+        """画像エンコーダの実行回数の加算（ワーカー、一括エンコード、高精度モデルの各スレッドから呼ばれる）"""
+        with self._lock:
+            self._encode_stats["encoder_passes"] += 1
+
+    @property
+    def decode_cache_stats(self) -> dict:
+        """マスクデコード結果のキャッシュの統計情報
+
+        - entries, bytes: 保持しているエントリ数とバイト数
+        - hits, misses: キャッシュのヒット数とミス数
+        """
+        return self._decode_cache.stats
+
+    def _load_model(self):
+        """モデルの読み込み（バックグラウンド読み込み時は読み込みスレッドから呼ばれる）"""
+        try:
+            self._initialize(
+                self._model_type,
+                self._checkpoint,
+            )
+            Logger.info(f"SAM model loaded. {self.load_stats=}")
+        except Exception as e:
+            self._load_error = e
+            Logger.error(f"Failed to load SAM model. {e=}")
+        finally:
+            self._model_loaded.set()
+
+    def _initialize(
         self,
-        point_coords: np.ndarray = None,
-        point_labels: np.ndarray = None,
-        box: np.ndarray = None,
+        model_type: str,
+        checkpoint: str
     ):
-        """プロンプト指定
+        """初期化
 
-        Args:
-            point_coords (np.ndarray): ポイントの座標リスト
-            point_labels (np.ndarray): ポイントの前景・背景ラベルリスト（1: 前景、0: 背景）
-            box (np.ndarray): ボックス（XYXY形式で指定。XYWH形式ではない）
+        読み込み中もUIスレッドからの要求を受け付けられるように、ロックは最後の設定時のみ取る
+        モデルを参照する処理は読み込み完了イベントで待機するので、ここで設定した値は完了まで参照されない
         """
+        assert model_type in ("vit_h", "vit_l", "vit_b")
+        load_stats = {}
+
+        # チェックポイントの読み込み
+        t0 = time.perf_counter()
+        state_dict, mmap = self._read_checkpoint(checkpoint)
+        load_stats["read_sec"] = time.perf_counter() - t0
+
+        # モデル構築と重みパラメータの復元
+        t0 = time.perf_counter()
+        build_sam = sam_model_registry[model_type]
+        sam = build_sam(None)
+        try:
+            # mmapで読み込んだ場合は複製せずにそのまま使う
+            sam.load_state_dict(state_dict, assign=mmap)
+        except TypeError:
+            # assign引数に未対応のバージョン
+            sam.load_state_dict(state_dict)
+        sam.eval()
+        del state_dict
+        load_stats["deserialize_sec"] = time.perf_counter() - t0
+        self._sam = sam
+
+        t0 = time.perf_counter()
+        if self._precision == "int8":
+            self._sam.image_encoder = self._load_quantized_image_encoder()
+        convert_sec = time.perf_counter() - t0
+
+        # デバイスへの転送
+        t0 = time.perf_counter()
+        self._sam.to(self._device)
+        load_stats["to_device_sec"] = time.perf_counter() - t0
+
+        self._predictor = SamPredictor(sam_model=self._sam)
+        self._image_size = self._sam.image_encoder.img_size
+
+        t0 = time.perf_counter()
+        if self._decoder_backend == "onnx":
+            self._onnx_decoder = OnnxMaskDecoder(
+                sam=self._sam,
+                checkpoint=self._checkpoint,
+                model_dir=str(self._model_dir()),
+            )
+
+        if self._encoder_backend == "torchscript":
+            self._sam.image_encoder = self._load_traced_image_encoder()
+        else:
+            # 実行中のエンコードを新しい要求で中断できるようにブロックごとに判定を入れる
+            for block in self._sam.image_encoder.blocks:
+                block.register_forward_pre_hook(self._encoder_block_hook)
+        load_stats["convert_sec"] = convert_sec + time.perf_counter() - t0
+
+        # 読み込み直した場合は前回の読み込みの統計（最初の画像エンコーダの実行時間を含む）を置き換える
         with self._lock:
-            if point_coords is not None:
-                self.set_prompt_points(point_coords, point_labels)
-            if point_labels is not None:
-                self.set_prompt_box(box)
+            self._load_stats = load_stats
 
-    def predict(
-        self,
-        multimask_output: bool = False,
-    ) -> np.ndarray:
-        """推論実行
+    @staticmethod
+    def _read_checkpoint(
+        checkpoint: str,
+    ) -> tuple:
+        """チェックポイントの読み込み
 
-        Args:
-            multimask_output (bool): 複数マスク出力フラグ
-                Trueの場合、3種類のマスクが出力される
+        対応しているtorchのバージョンではmmapで読み込み、重みパラメータを必要になるまでメモリに展開しない
 
         Returns:
-            np.ndarray: 単一または複数のマスク
+            tuple: 重みパラメータのstate_dict、mmapで読み込んだか
         """
-        with self._lock:
-            if self._thread_set_image is None:
-                return None
-            
-            masks, scores, logits = self._predictor.predict(
-                **self._prompt,
-                # point_coords=None,
-                # point_labels=None,
-                # box=None,
-                mask_input=None,
-                multimask_output=multimask_output,
-                return_logits=False,
+        try:
+            state_dict = torch.load(
+                checkpoint,
+                map_location="cpu",
+                mmap=True,
+                weights_only=True,
+            )
+            return state_dict, True
+        except (TypeError, RuntimeError) as e:
+            # mmap未対応のバージョン、または旧形式のチェックポイント
+            Logger.debug(f"Load checkpoint without mmap. {e=}")
+
+        with open(checkpoint, "rb") as fp:
+            state_dict = torch.load(fp, map_location="cpu")
+        return state_dict, False
+
+    def _model_dir(self) -> Path:
+        """変換済みモデルの保存先ディレクトリ"""
+        if self._model_cache_dir:
+            return Path(self._model_cache_dir)
+        return Path(self._checkpoint).parent
+
+    def _quantized_image_encoder_path(self) -> Path:
+        """量子化した画像エンコーダの保存先パス
+
+        チェックポイントやtorchのバージョンが変わったら別ファイルになるようにする
+        """
+        torch_version = torch.__version__.replace("+", "_")
+        return self._model_dir() / (
+            f"{_utils.checkpoint_tag(self._checkpoint)}_image_encoder_int8_torch{torch_version}.pt")
+
+    def _load_quantized_image_encoder(self) -> torch.nn.Module:
+        """INT8に動的量子化した画像エンコーダの読み込み
+
+        保存済みであればそれを読み込み、無ければ量子化して保存する
+        """
+        path = self._quantized_image_encoder_path()
+        if path.exists():
+            try:
+                # 量子化モジュールはstate_dictだけでは復元できないのでモジュールごと保存している
+                encoder = torch.load(path, map_location="cpu", weights_only=False)
+                Logger.info(f"Load quantized image encoder. {path=}")
+                return encoder
+            except Exception as e:
+                Logger.warn(f"Failed to load quantized image encoder. {path=}, {e=}")
+
+        encoder = torch.ao.quantization.quantize_dynamic(
+            self._sam.image_encoder.cpu(),
+            {torch.nn.Linear},
+            dtype=torch.qint8,
+        )
+
+        try:
+            _utils.atomic_save(path, lambda tmp_path: torch.save(encoder, tmp_path))
+            Logger.info(f"Save quantized image encoder. {path=}")
+        except OSError as e:
+            Logger.warn(f"Failed to save quantized image encoder. {path=}, {e=}")
+        return encoder
+
+    def _traced_image_encoder_path(self) -> Path:
+        """トレースした画像エンコーダの保存先パス
+
+        トレース結果はデバイスと推論精度に依存するので、それぞれ別ファイルにする
+        """
+        torch_version = torch.__version__.replace("+", "_")
+        device_type = str(self._device).split(":")[0]
+        return self._model_dir() / (
+            f"{_utils.checkpoint_tag(self._checkpoint)}_image_encoder_{self._precision}"
+            f"_{device_type}_torch{torch_version}.ts")
+
+    @torch.no_grad()
+    def _load_traced_image_encoder(self) -> torch.nn.Module:
+        """TorchScriptでトレースした画像エンコーダの読み込み
+
+        保存済みであればそれを読み込み、無ければ固定サイズの入力でトレースして保存する
+        """
+        path = self._traced_image_encoder_path()
+        if path.exists():
+            try:
+                encoder = torch.jit.load(str(path), map_location=self._device)
+                Logger.info(f"Load traced image encoder. {path=}")
+                return encoder
+            except Exception as e:
+                Logger.warn(f"Failed to load traced image encoder. {path=}, {e=}")
+
+        encoder = self._sam.image_encoder.eval()
+        dummy_input = torch.zeros(
+            (1, 3, self._image_size, self._image_size),
+            dtype=torch.float32,
+            device=self._device,
+        )
+        encoder = torch.jit.trace(encoder, dummy_input)
+        encoder = torch.jit.freeze(encoder)
+
+        try:
+            _utils.atomic_save(path, lambda tmp_path: torch.jit.save(encoder, str(tmp_path)))
+            Logger.info(f"Save traced image encoder. {path=}")
+        except (OSError, RuntimeError) as e:
+            Logger.warn(f"Failed to save traced image encoder. {path=}, {e=}")
+        return encoder
+
+    def _run_image_encoder(
+        self,
+        input_img_torch: torch.Tensor,
+        image_encoder: torch.nn.Module = None,
+    ) -> torch.Tensor:
+        """画像エンコーダの実行
+
+        トレースした画像エンコーダはバッチサイズ1で固定なので1枚ずつ実行する
+        """
+        if image_encoder is None:
+            image_encoder = self._sam.image_encoder
+
+        t0 = time.perf_counter()
+        if self._encoder_backend != "torchscript" or len(input_img_torch) == 1:
+            features = image_encoder(input_img_torch)
+        else:
+            features = torch.cat(
+                [image_encoder(input_img_torch[i:i + 1]) for i in range(len(input_img_torch))],
+                dim=0,
             )
 
-            return masks
+        with self._lock:
+            if "first_forward_sec" not in self._load_stats:
+                self._load_stats["first_forward_sec"] = time.perf_counter() - t0
+                Logger.info(f"First image encoder forward. {self._load_stats=}")
+        return features
+
+    def _autocast(
+        self,
+        precision: str = None,
+    ):
+        """推論精度に応じた自動混合精度のコンテキスト
+
+        Args:
+            precision (str): 推論精度（Noneの場合はコンストラクタで指定した精度）
+        """
+        if precision is None:
+            precision = self._precision
+        dtype = _PRECISION_DTYPE_MAP[precision]
+        device_type = "cuda" if str(self._device).startswith("cuda") else "cpu"
+        return torch.autocast(
+            device_type=device_type,
+            dtype=dtype if dtype is not None else torch.float32,
+            enabled=dtype is not None,
+        )
+
+    def _encoder_block_hook(self, module, args):
+        """画像エンコーダのブロック実行前のフック"""
+        cancel_fn = getattr(self._thread_local, "cancel_fn", None)
+        if cancel_fn is not None and cancel_fn():
+            raise EncodeCancelledError()
+
+    def set_image(
+        self,
+        img: np.ndarray,
+        img_format: str,
+        img_path: str = None,
+    ):
+        """画像エンコード
+
+        書き込み不可の画像（img.flags.writeable == False）は複製せずにワーカーと共有する
+        書き込み可能な画像は呼び出し側で変更されても影響しないように複製する
+
+        Args:
+            img (np.ndarray): 画像
+            img_format (str): 画像フォーマット（'RGB' or 'BGR'）
+            img_path (str): 画像の読み込み元ファイルパス
+                指定した場合、画素値のハッシュの代わりにファイル情報をキャッシュキーにする（先読みと共通）
+                画像エンコーダの入力も先読みと同じくファイルから縮小デコードで作るので、
+                どちらでキャッシュされたかによって推論結果が変わらない
+        """
+        if img.flags.writeable:
+            img = img.copy()
+            img.setflags(write=False)
+            self._add_preprocess_stats(copies=1, copy_bytes=img.nbytes)
+        else:
+            self._add_preprocess_stats(copies_avoided=1, copy_bytes_avoided=img.nbytes)
+
+        with self._lock:
+            self._current_image = (img, img_format, img_path)
+            self._needs_reencode = False
+            self._object_results.clear()
+            self._submit_image(img, img_format, img_path)
+
+            # 高精度モデルにも同じ画像を要求する（エンコードはプレビューの完了後に始まる）
+            if self._refiner is not None:
+                self._refiner.set_image(img, img_format, img_path)
+                self._refine_enabled = True
+
+    def _submit_image(
+        self,
+        img: np.ndarray,
+        img_format: str,
+        img_path: str = None,
+    ):
+        """画像エンコードのジョブ登録"""
+        with self._lock:
+            # 未実行の古い要求はワーカー側で破棄される
+            self._image_request_id += 1
+            self._embedding_ready.clear()
+            self._encode_worker.submit(
+                partial(
+                    self._set_image_job,
+                    img,
+                    img_format,
+                    self._image_request_id,
+                    img_path=img_path,
+                )
+            )
+
+    def _wait_preview_embedding(
+        self,
+        cancel_fn,
+    ):
+        """プレビュー用の画像埋め込みの反映まで待機（高精度モデルのワーカースレッドから呼ばれる）"""
+        while not self._embedding_ready.wait(0.05):
+            if cancel_fn():
+                raise EncodeCancelledError()
+
+    def _set_image_job(
+        self,
+        img: np.ndarray,
+        img_format: str,
+        request_id: int,
+        cancel_fn,
+        img_path: str = None,
+    ):
+        """画像エンコードのジョブ関数（ワーカースレッドから呼ばれる）"""
+        if self._encode_gate is not None:
+            self._encode_gate(cancel_fn)
+
+        with self._lock:
+            passes = self._encode_stats["encoder_passes"]
+        try:
+            key = None
+            if img_path is not None:
+                key = self._make_file_key(img_path)
+            embedding = self._get_embedding(
+                img,
+                img_format,
+                cancel_fn=cancel_fn,
+                key=key,
+                img_path=img_path,
+            )
+        except EncodeCancelledError:
+            raise
+        except Exception:
+            with self._lock:
+                if request_id == self._image_request_id:
+                    # 待機中のpredictが戻れるように画像未設定の状態にしておく
+                    if self._predictor is not None:
+                        self._predictor.reset_image()
+                    self._embedding = None
+                    self._embedding_ready.set()
+            raise
+
+        with self._lock:
+            if request_id != self._image_request_id:
+                # 完了までの間に新しい要求があったときは反映しない
+                if self._encode_stats["encoder_passes"] != passes:
+                    self._encode_stats["redundant_passes"] += 1
+                return
+            self._apply_embedding(embedding)
+            self._embedding_ready.set()
+
+    def prefetch(
+        self,
+        img_paths: list,
+    ):
+        """画像の先読みエンコード
+
+        バックグラウンドで画像をエンコードしてキャッシュに保存する
+        対話的な画像エンコードが要求されたときは中断して後で再開する
+
+        Args:
+            img_paths (list): 画像パスのリスト（先頭ほど優先度が高い）
+        """
+        self._encode_worker.schedule_background(
+            [partial(self._prefetch_job, img_path) for img_path in img_paths]
+        )
+
+    def _prefetch_job(
+        self,
+        img_path: str,
+        cancel_fn,
+    ):
+        """先読みエンコードのジョブ関数（ワーカースレッドから呼ばれる）"""
+        # キャッシュにあれば画像の読み込みも不要
+        try:
+            self._get_embedding(
+                None,
+                img_format="RGB",
+                cancel_fn=cancel_fn,
+                key=self._make_file_key(img_path),
+                img_path=img_path,
+            )
+        except EncodeCancelledError:
+            Logger.debug(f"Prefetch cancelled. {img_path=}")
+            raise
+
+    def _make_file_key(
+        self,
+        img_path: str,
+    ) -> str:
+        """画像ファイルのキャッシュキー"""
+        return make_file_embedding_key(
+            img_path,
+            model_type=self._model_type,
+            checkpoint=self._checkpoint,
+            input_size=self._image_size,
+            precision=self._precision,
+        )
+
+    def _lookup_embedding(
+        self,
+        key: str,
+    ) -> ImageEmbedding:
+        """メモリキャッシュ、ディスクキャッシュの順に画像埋め込みを探す（無い場合はNone）"""
+        embedding = self._memory_cache.get(key)
+        if embedding is not None:
+            return embedding
+
+        if self._disk_cache is not None:
+            embedding = self._disk_cache.get(key, device=self._device)
+            if embedding is not None:
+                self._memory_cache.put(embedding)
+        return embedding
+
+    def _get_embedding(
+        self,
+        img: np.ndarray,
+        img_format: str,
+        cancel_fn=None,
+        key: str = None,
+        original_size: tuple = None,
+        img_path: str = None,
+    ) -> ImageEmbedding:
+        """画像埋め込みの取得
+
+        メモリキャッシュ、ディスクキャッシュの順に探し、
+        どちらにも無ければ画像エンコードして両方のキャッシュに保存する
+        キャッシュにあればモデルの読み込み（バックグラウンド読み込み、解放後の読み込み直し）を待たずに返す
+        先読みジョブからも呼ばれるため、SamPredictorの状態には触れない
+
+        Args:
+            img (np.ndarray): 画像
+            img_format (str): 画像フォーマット（'RGB' or 'BGR'）
+            cancel_fn (callable): エンコード中断判定関数（Trueを返すと中断する）
+            key (str): キャッシュキー（Noneの場合は画素値から算出する）
+            original_size (tuple): 元画像のサイズ (H, W)（縮小済みの画像を渡す場合に指定）
+            img_path (str): 画像ファイルパス
+                指定した場合、画像エンコーダの入力はimgではなくファイルから縮小デコードで作る
+                （ファイル情報のキーに対して、対話的な要求と先読みで同じ入力になるようにするため）
+
+        Returns:
+            ImageEmbedding: 画像埋め込み
+        """
+        if key is None:
+            key = make_embedding_key(
+                img,
+                img_format,
+                model_type=self._model_type,
+                checkpoint=self._checkpoint,
+                input_size=self._image_size,
+                precision=self._precision,
+            )
+
+        embedding = self._lookup_embedding(key)
+        if embedding is not None:
+            return embedding
+
+        if img_path is not None:
+            # 画像エンコーダの入力サイズに縮小しながら読み込む
+            t0 = time.perf_counter()
+            img, original_size = _utils.load_image_resized(img_path, self._image_size)
+            img_format = "RGB"
+            self._add_preprocess_stats(
+                decode_sec=time.perf_counter() - t0,
+                reduced_decodes=1,
+            )
+
+        # 画像エンコードが必要なときだけモデルを使用する
+        self._acquire_model()
+        try:
+            with self._encode_lock:
+                # 待機中に別スレッドでエンコード済みになっていればそれを使う
+                embedding = self._memory_cache.get(key)
+                if embedding is not None:
+                    return embedding
+
+                self._thread_local.cancel_fn = cancel_fn
+                try:
+                    embedding = self._compute_embedding(
+                        img, img_format, original_size=original_size)
+                finally:
+                    self._thread_local.cancel_fn = None
+                self._count_encoder_pass()
+        finally:
+            self._release_model()
+        embedding.key = key
+        if self._disk_cache is not None:
+            self._disk_cache.put(embedding)
+
+        self._memory_cache.put(embedding)
+        return embedding
+
+    @torch.no_grad()
+    def _compute_embedding(
+        self,
+        img: np.ndarray,
+        img_format: str,
+        precision: str = None,
+        image_encoder: torch.nn.Module = None,
+        original_size: tuple = None,
+    ) -> ImageEmbedding:
+        """画像エンコード
+
+        SamPredictor.set_imageと同等の処理を行うが、SamPredictorの状態は変更しない
+        呼び出し側で画像エンコーダの排他制御を行うこと（入力テンソルを使い回すため）
+
+        Args:
+            precision (str): 推論精度（Noneの場合はコンストラクタで指定した精度）
+            image_encoder (torch.nn.Module): 画像エンコーダ（Noneの場合はモデルの画像エンコーダ）
+            original_size (tuple): 元画像のサイズ (H, W)（縮小済みの画像を渡す場合に指定）
+        """
+        # トレースした画像エンコーダは途中で中断できないので実行前に判定する
+        cancel_fn = getattr(self._thread_local, "cancel_fn", None)
+        if cancel_fn is not None and cancel_fn():
+            raise EncodeCancelledError()
+
+        if self._input_buffer is None:
+            self._input_buffer = torch.empty(
+                (1, 3, self._image_size, self._image_size),
+                dtype=torch.float32,
+                device=self._device,
+            )
+        input_img_torch, input_size, original_size = self._preprocess(
+            img,
+            img_format,
+            original_size=original_size,
+            out=self._input_buffer,
+        )
+        with self._autocast(precision):
+            features = self._run_image_encoder(input_img_torch, image_encoder)
+        # キャッシュやデコーダの入力はfp32で統一する
+        features = features.float()
+
+        return ImageEmbedding(
+            features=features,
+            original_size=original_size,
+            input_size=input_size,
+        )
+
+    @torch.no_grad()
+    def _preprocess(
+        self,
+        img: np.ndarray,
+        img_format: str,
+        original_size: tuple = None,
+        out: torch.Tensor = None,
+    ) -> tuple:
+        """画像エンコーダの入力テンソル作成
+
+        cv2で長辺を入力サイズに縮小してから色変換と正規化を行い、元画像サイズの中間配列を作らない
+        縮小後の画像は入力テンソルに直接書き込んで正規化する
+
+        Args:
+            img (np.ndarray): 画像（元画像、または長辺を入力サイズに縮小済みの画像）
+            img_format (str): 画像フォーマット（'RGB' or 'BGR'）
+            original_size (tuple): 元画像のサイズ (H, W)（縮小済みの画像を渡す場合に指定）
+            out (torch.Tensor): 入力テンソルの書き込み先 (1, 3, S, S)（Noneの場合は新たに確保する）
+
+        Returns:
+            tuple: 入力テンソル (1, 3, 1024, 1024)、リサイズ後のサイズ、元画像のサイズ
+        """
+        assert img_format in ("RGB", "BGR")
+        if original_size is None:
+            original_size = tuple(img.shape[:2])
+        input_size = ResizeLongestSide.get_preprocess_shape(
+            original_size[0], original_size[1], self._image_size)
+
+        # 長辺を画像エンコーダの入力サイズに合わせてリサイズ
+        t0 = time.perf_counter()
+        if tuple(img.shape[:2]) != tuple(input_size):
+            interpolation = cv2.INTER_AREA if img.shape[0] > input_size[0] else cv2.INTER_LINEAR
+            img = cv2.resize(
+                img, (input_size[1], input_size[0]), interpolation=interpolation)
+
+        # 色変換は縮小後の画像に対して行う
+        if img_format != self._sam.image_format:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        t1 = time.perf_counter()
+
+        # 正規化とパディング（入力テンソルに直接書き込む）
+        if out is None:
+            out = torch.empty(
+                (1, 3, self._image_size, self._image_size),
+                dtype=torch.float32,
+                device=self._device,
+            )
+        h, w = input_size
+        with warnings.catch_warnings():
+            # 書き込み不可の配列の警告（読み込みのみなので問題ない）
+            warnings.filterwarnings("ignore", category=UserWarning)
+            img_torch = torch.from_numpy(np.ascontiguousarray(img))
+        dst = out[0, :, :h, :w]
+        dst.copy_(img_torch.permute(2, 0, 1))
+        dst.sub_(self._sam.pixel_mean).div_(self._sam.pixel_std)
+        out[0, :, h:, :].zero_()
+        out[0, :, :h, w:].zero_()
+        t2 = time.perf_counter()
+
+        self._add_preprocess_stats(
+            images=1,
+            resize_sec=t1 - t0,
+            normalize_sec=t2 - t1,
+        )
+        return out, tuple(input_size), tuple(original_size)
+
+    @_uses_model
+    @torch.no_grad()
+    def set_images(
+        self,
+        imgs: list,
+        img_format: str,
+        batch_size: int = 4,
+    ) -> list:
+        """複数画像の一括エンコード
+
+        キャッシュに無い画像をまとめて画像エンコーダに入力する
+        返した画像埋め込みはset_image_embeddingでプロンプト推論の対象にできる
+        SamPredictorの状態（現在の画像）は変更しない
+
+        Args:
+            imgs (list): 画像（np.ndarray）のリスト
+            img_format (str): 画像フォーマット（'RGB' or 'BGR'）
+            batch_size (int): 画像エンコーダに一度に入力する画像数
+
+        Returns:
+            list: 画像ごとの画像埋め込み（ImageEmbedding）のリスト
+        """
+        embeddings = [None] * len(imgs)
+
+        # キャッシュにあるものはそれを使う
+        missing = []
+        for idx, img in enumerate(imgs):
+            key = make_embedding_key(
+                img,
+                img_format,
+                model_type=self._model_type,
+                checkpoint=self._checkpoint,
+                input_size=self._image_size,
+                precision=self._precision,
+            )
+            embedding = self._lookup_embedding(key)
+            if embedding is None:
+                missing.append((idx, key))
+            else:
+                embeddings[idx] = embedding
+
+        # キャッシュに無いものをバッチ単位でエンコード
+        for start in range(0, len(missing), max(batch_size, 1)):
+            batch = missing[start:start + max(batch_size, 1)]
+            inputs = [self._preprocess(imgs[idx], img_format) for idx, _ in batch]
+
+            with self._encode_lock, self._autocast():
+                features = self._run_image_encoder(
+                    torch.cat([x for x, _, _ in inputs], dim=0))
+                self._count_encoder_pass()
+            features = features.float()
+
+            for i, ((idx, key), (_, input_size, original_size)) in enumerate(zip(batch, inputs)):
+                # バッチ全体のメモリを保持し続けないように画像ごとに複製する
+                embedding = ImageEmbedding(
+                    features=features[i:i + 1].clone(),
+                    original_size=original_size,
+                    input_size=input_size,
+                    key=key,
+                )
+                if self._disk_cache is not None:
+                    self._disk_cache.put(embedding)
+                self._memory_cache.put(embedding)
+                embeddings[idx] = embedding
+
+        return embeddings
+
+    def set_image_embedding(
+        self,
+        embedding: ImageEmbedding,
+    ):
+        """画像埋め込みを現在の画像として設定
+
+        set_imagesで算出した画像埋め込みをプロンプト推論の対象にする
+        画像エンコードは行わないのですぐに推論できる
+
+        Args:
+            embedding (ImageEmbedding): 画像埋め込み
+        """
+        with self._lock:
+            # 実行待ちの画像エンコード要求は無効にする
+            self._image_request_id += 1
+            self._apply_embedding(embedding)
+            self._embedding_ready.set()
+            self._current_image = None
+            self._needs_reencode = False
+            self._object_results.clear()
+
+            # 高精度モデルの画像埋め込みは無いので高精度の推論は行わない
+            self._refine_enabled = False
+
+    def _apply_embedding(
+        self,
+        embedding: ImageEmbedding,
+    ):
+        """画像埋め込みをSamPredictorに設定
+
+        推論は画像埋め込みを直接参照するので、モデルの読み込み中や解放済みのときは
+        SamPredictorへの設定を省略する（ロックを取ったまま読み込み完了を待たないため）
+        """
+        with self._lock:
+            if embedding is not self._embedding:
+                self._decode_cache.clear()
+            self._embedding = embedding
+            if self._predictor is None:
+                return
+            self._predictor.reset_image()
+            self._predictor.features = embedding.features
+            self._predictor.original_size = embedding.original_size
+            self._predictor.input_size = embedding.input_size
+            self._predictor.is_image_set = True
+
+    def set_prompt_point(
+        self,
+        x: int,
+        y: int,
+        label: int = 1
+    ):
+        """プロンプトに与えるポイントの指定
+
+        Args:
+            x (int): X座標
+            y (int): Y座標
+            label (int): ポイントの前景・背景ラベル（1: 前景、0: 背景）
+        """
+        with self._lock:
+            self._prompt["point_coords"] = np.array([[x, y]])
+            self._prompt["point_labels"] = np.array([label])
+            
+    def set_prompt_points(
+        self,
+        point_coords: np.ndarray,
+        point_labels: np.ndarray = None,
+    ):
+        """プロンプトに与えるポイントリストの指定
+
+        Args:
+            point_coords (np.ndarray): ポイントの座標リスト
+            point_labels (np.ndarray): ポイントの前景・背景ラベルリスト（1: 前景、0: 背景）
+                Noneの場合、ポイントはすべて前景扱いとする
+        """
+        with self._lock:
+            # 前景・背景ラベルの指定がないときは前景扱いとする
+            if point_labels is None:
+                point_labels = np.ones((len(point_coords),), np.int32)
+
+            self._prompt["point_coords"] = point_coords
+            self._prompt["point_labels"] = point_labels
+
+    def set_prompt_box(
+        self,
+        box: np.ndarray  # [x0, y0, x1, y1]形式 ([x0, y0, w, h] ではない)
+    ):
+        """プロンプトに与えるボックスの指定
+
+        Args:
+            box (np.ndarray): ボックス（XYXY形式で指定。XYWH形式ではない）
+        """
+        with self._lock:
+            self._prompt["box"] = box
+
+    def set_prompt(
+        self,
+        point_coords: np.ndarray = None,
+        point_labels: np.ndarray = None,
+        box: np.ndarray = None,
+    ):
+        """プロンプト指定
+
+        Args:
+            point_coords (np.ndarray): ポイントの座標リスト
+            point_labels (np.ndarray): ポイントの前景・背景ラベルリスト（1: 前景、0: 背景）
+            box (np.ndarray): ボックス（XYXY形式で指定。XYWH形式ではない）
+        """
+        with self._lock:
+            if point_coords is not None:
+                self.set_prompt_points(point_coords, point_labels)
+            if box is not None:
+                self.set_prompt_box(box)
+
+    @property
+    def object_ids(self) -> list:
+        """複数物体のプロンプトの物体IDリスト"""
+        with self._lock:
+            return list(self._objects.keys())
+
+    def add_object(
+        self,
+        point_coords: np.ndarray = None,
+        point_labels: np.ndarray = None,
+        box: np.ndarray = None,
+    ) -> int:
+        """複数物体のプロンプトに物体を追加
+
+        物体ごとにポイント・ラベル・ボックスを持ち、predict_objectsでまとめて推論する
+
+        Args:
+            point_coords (np.ndarray): ポイントの座標リスト (N, 2)
+            point_labels (np.ndarray): ポイントの前景・背景ラベルリスト（1: 前景、0: 背景）
+                Noneの場合、ポイントはすべて前景扱いとする
+            box (np.ndarray): ボックス（XYXY形式で指定。XYWH形式ではない）
+
+        Returns:
+            int: 物体ID
+        """
+        with self._lock:
+            object_id = self._next_object_id
+            self._next_object_id += 1
+            self.update_object(object_id, point_coords, point_labels, box)
+            return object_id
+
+    def update_object(
+        self,
+        object_id: int,
+        point_coords: np.ndarray = None,
+        point_labels: np.ndarray = None,
+        box: np.ndarray = None,
+    ):
+        """物体のプロンプトの置き換え
+
+        次のpredict_objectsではこの物体だけをデコードし直す
+
+        Args:
+            object_id (int): 物体ID
+            point_coords (np.ndarray): ポイントの座標リスト (N, 2)
+            point_labels (np.ndarray): ポイントの前景・背景ラベルリスト（Noneの場合はすべて前景）
+            box (np.ndarray): ボックス（XYXY形式）
+        """
+        if point_coords is not None:
+            point_coords = np.asarray(point_coords, np.float32).reshape(-1, 2)
+            if point_labels is None:
+                point_labels = np.ones((len(point_coords),), np.int32)
+            point_labels = np.asarray(point_labels, np.int32).reshape(-1)
+        if box is not None:
+            box = np.asarray(box, np.float32).reshape(4)
+
+        with self._lock:
+            self._object_version += 1
+            self._objects[object_id] = {
+                "prompt": {
+                    "point_coords": point_coords,
+                    "point_labels": point_labels,
+                    "box": box,
+                },
+                "version": self._object_version,
+            }
+
+    def add_object_point(
+        self,
+        object_id: int,
+        x: int,
+        y: int,
+        label: int = 1,
+    ):
+        """物体のプロンプトにポイントを追加
+
+        Args:
+            object_id (int): 物体ID
+            x (int): X座標
+            y (int): Y座標
+            label (int): ポイントの前景・背景ラベル（1: 前景、0: 背景）
+        """
+        with self._lock:
+            prompt = self._objects[object_id]["prompt"]
+            point_coords = np.array([[x, y]], np.float32)
+            point_labels = np.array([label], np.int32)
+            if prompt["point_coords"] is not None:
+                point_coords = np.concatenate([prompt["point_coords"], point_coords], axis=0)
+                point_labels = np.concatenate([prompt["point_labels"], point_labels], axis=0)
+            self.update_object(object_id, point_coords, point_labels, prompt["box"])
+
+    def remove_object(
+        self,
+        object_id: int,
+    ):
+        """複数物体のプロンプトから物体を削除"""
+        with self._lock:
+            self._objects.pop(object_id, None)
+            self._object_results.pop(object_id, None)
+
+    def clear_objects(self):
+        """複数物体のプロンプトをすべて削除"""
+        with self._lock:
+            self._objects.clear()
+            self._object_results.clear()
+
+    def predict_objects(
+        self,
+        multimask_output: bool = False,
+        compact: bool = False,
+    ) -> dict:
+        """複数物体の推論実行
+
+        画像埋め込みが反映されるまでブロックする
+
+        Args:
+            multimask_output (bool): 複数マスク出力フラグ
+            compact (bool): マスクをコンパクト表現（CompactMaskのリスト）で返すフラグ
+
+        Returns:
+            dict: 物体IDと (マスク (C, H, W), スコア (C,)) の対応マップ
+                画像が未設定、または推論前に別の画像が設定された場合はNone
+        """
+        return self.predict_objects_async(
+            multimask_output=multimask_output,
+            compact=compact,
+        ).result()
+
+    def predict_objects_async(
+        self,
+        multimask_output: bool = False,
+        compact: bool = False,
+    ) -> Future:
+        """複数物体の非同期の推論実行
+
+        呼び出し時点の全物体のプロンプトで推論を予約して、すぐに戻る
+        前回の推論から変更の無い物体は前回の結果を返し、変更された物体だけをまとめて1回でデコードする
+        （ボックスの有無で分けるので、デコーダの呼び出しは最大2回）
+
+        Args:
+            multimask_output (bool): 複数マスク出力フラグ
+            compact (bool): マスクをコンパクト表現（CompactMaskのリスト）で返すフラグ
+
+        Returns:
+            Future: 物体IDと (マスク, スコア) の対応マップを結果とするFuture
+                ポイントもボックスも無い物体は結果に含まれない
+        """
+        # 解放済みのときは現在の画像をエンコードし直す
+        self._resume_image()
+
+        with self._lock:
+            request_id = self._image_request_id
+            objects = {
+                object_id: (obj["version"], obj["prompt"])
+                for object_id, obj in self._objects.items()
+            }
+
+        if request_id == 0:
+            # 画像が未設定
+            future = Future()
+            future.set_result(None)
+            return future
+
+        return self._decode_executor.submit(
+            self._predict_objects_job,
+            request_id,
+            objects,
+            multimask_output,
+            compact,
+        )
+
+    def _predict_objects_job(
+        self,
+        request_id: int,
+        objects: dict,
+        multimask_output: bool,
+        compact: bool,
+    ) -> dict:
+        """複数物体の推論のジョブ関数（推論スレッドから呼ばれる）
+
+        Args:
+            objects (dict): 物体IDと (更新番号, プロンプト) の対応マップ
+        """
+        embedding = self._wait_embedding(request_id)
+        if embedding is None:
+            return None
+
+        # 前回から変更の無い物体は前回の結果を使う
+        results = {}
+        dirty_prompts = {}
+        with self._lock:
+            for object_id, (version, prompt) in objects.items():
+                tag = (embedding.key, version, multimask_output, compact)
+                cached = self._object_results.get(object_id, None)
+                if cached is not None and cached[0] == tag:
+                    results[object_id] = cached[1]
+                else:
+                    dirty_prompts[object_id] = prompt
+
+        decoded = self._decode_objects(
+            embedding,
+            dirty_prompts,
+            multimask_output=multimask_output,
+            compact=compact,
+        )
+
+        with self._lock:
+            for object_id, (masks, scores, logits) in decoded.items():
+                results[object_id] = (masks, scores)
+                # 推論中に削除された物体の結果は残さない
+                if object_id in self._objects:
+                    tag = (embedding.key, objects[object_id][0], multimask_output, compact)
+                    self._object_results[object_id] = (tag, (masks, scores))
+
+        return {object_id: results[object_id] for object_id in objects if object_id in results}
+
+    def _decode_objects(
+        self,
+        embedding: ImageEmbedding,
+        prompts: dict,
+        multimask_output: bool,
+        compact: bool = False,
+    ) -> dict:
+        """複数物体のマスクデコード
+
+        物体ごとのポイント数はラベル-1（ポイントなし）のパディングで揃え、
+        ボックスの有無でまとめてデコードする（プロンプトエンコーダにはボックスの有無が混在した入力を与えられないため）
+
+        Args:
+            embedding (ImageEmbedding): 画像埋め込み
+            prompts (dict): 物体IDとプロンプトの対応マップ
+            multimask_output (bool): 複数マスク出力フラグ
+            compact (bool): マスクをコンパクト表現（CompactMaskのリスト）で返すフラグ
+
+        Returns:
+            dict: 物体IDと (マスク, スコア (C,), 低解像度ロジット (C, 256, 256)) の対応マップ
+        """
+        groups = {True: [], False: []}
+        for object_id, prompt in prompts.items():
+            if prompt["point_coords"] is None and prompt["box"] is None:
+                continue
+            groups[prompt["box"] is not None].append(object_id)
+
+        results = {}
+        for has_box, object_ids in groups.items():
+            if not object_ids:
+                continue
+
+            num_points = max(
+                len(prompts[object_id]["point_coords"])
+                if prompts[object_id]["point_coords"] is not None else 0
+                for object_id in object_ids
+            )
+            point_coords = None
+            point_labels = None
+            if num_points > 0:
+                point_coords = np.zeros((len(object_ids), num_points, 2), np.float32)
+                point_labels = np.full((len(object_ids), num_points), -1, np.int32)
+                for row, object_id in enumerate(object_ids):
+                    coords = prompts[object_id]["point_coords"]
+                    if coords is None:
+                        continue
+                    point_coords[row, :len(coords)] = coords
+                    point_labels[row, :len(coords)] = prompts[object_id]["point_labels"]
+
+            boxes = None
+            if has_box:
+                boxes = np.stack([prompts[object_id]["box"] for object_id in object_ids])
+
+            low_res_masks, iou_predictions = self.decode_low_res(
+                embedding,
+                point_coords=point_coords,
+                point_labels=point_labels,
+                boxes=boxes,
+                multimask_output=multimask_output,
+            )
+            if compact:
+                masks = self.upsample_masks_compact(embedding, low_res_masks)
+            else:
+                masks = self.upsample_masks(embedding, low_res_masks, batch_size=16)
+
+            scores = iou_predictions.cpu().numpy()
+            logits = low_res_masks.cpu().numpy()
+            for row, object_id in enumerate(object_ids):
+                results[object_id] = (masks[row], scores[row], logits[row])
+        return results
+
+    def predict(
+        self,
+        multimask_output: bool = False,
+        compact: bool = False,
+    ) -> np.ndarray:
+        """推論実行
+
+        画像埋め込みが反映されるまでブロックする
+
+        Args:
+            multimask_output (bool): 複数マスク出力フラグ
+                Trueの場合、3種類のマスクが出力される
+            compact (bool): コンパクト表現で返すフラグ
+                Trueの場合、マスクのバウンディングボックスの範囲だけをアップサンプリングして
+                CompactMaskのリストで返す（元画像サイズのマスクはCompactMask.to_fullで展開する）
+
+        Returns:
+            np.ndarray: 単一または複数のマスク（compactがTrueの場合はCompactMaskのリスト）
+        """
+        return self.predict_async(
+            multimask_output=multimask_output,
+            compact=compact,
+        ).result()
+
+    def predict_async(
+        self,
+        multimask_output: bool = False,
+        prompt: dict = None,
+        compact: bool = False,
+    ) -> Future:
+        """非同期の推論実行
+
+        呼び出し時点の画像とプロンプトで推論を予約して、すぐに戻る
+        画像埋め込みが未反映のときは反映を待ってから推論する
+        推論前に別の画像が設定された場合、結果はNoneになる
+
+        Args:
+            multimask_output (bool): 複数マスク出力フラグ
+                Trueの場合、3種類のマスクが出力される
+            prompt (dict): プロンプト（Noneの場合は現在のプロンプト）
+            compact (bool): コンパクト表現（CompactMaskのリスト）で返すフラグ
+
+        Returns:
+            Future: 単一または複数のマスク（np.ndarray、compactがTrueの場合はCompactMaskのリスト）を結果とするFuture
+        """
+        # 解放済みのときは現在の画像をエンコードし直す
+        self._resume_image()
+
+        with self._lock:
+            request_id = self._image_request_id
+            prompt = self._prompt.copy() if prompt is None else prompt.copy()
+            roi_image = self._current_image if self._roi_enabled else None
+
+        if request_id == 0:
+            # 画像が未設定
+            future = Future()
+            future.set_result(None)
+            return future
+
+        return self._decode_executor.submit(
+            self._predict_job,
+            request_id,
+            prompt,
+            multimask_output,
+            roi_image,
+            compact,
+        )
+
+    def predict_refined_async(
+        self,
+        multimask_output: bool = False,
+        compact: bool = False,
+    ) -> Future:
+        """高精度モデルでの非同期の推論実行
+
+        呼び出し時点の画像とプロンプトで高精度モデルの推論を予約して、すぐに戻る
+        高精度モデルの画像埋め込みが反映されてから推論するので、
+        predict_asyncのプレビュー結果を後から置き換えるのに使う
+
+        Args:
+            multimask_output (bool): 複数マスク出力フラグ
+            compact (bool): コンパクト表現（CompactMaskのリスト）で返すフラグ
+
+        Returns:
+            Future: 単一または複数のマスク（np.ndarray、compactがTrueの場合はCompactMaskのリスト）を結果とするFuture
+                高精度モデルを使用しない場合や、推論前に別の画像が設定された場合、結果はNoneになる
+        """
+        with self._lock:
+            if self._refiner is None or not self._refine_enabled:
+                future = Future()
+                future.set_result(None)
+                return future
+            prompt = self._prompt.copy()
+            return self._refiner.predict_async(
+                multimask_output=multimask_output,
+                prompt=prompt,
+                compact=compact,
+            )
+
+    def predict_boxes(
+        self,
+        boxes: np.ndarray,
+        multimask_output: bool = False,
+        upsample_batch_size: int = 16,
+        embedding: ImageEmbedding = None,
+    ) -> tuple:
+        """複数ボックスの一括推論
+
+        現在の画像の全ボックスを1回のマスクデコーダ呼び出しで推論する
+        画像埋め込みが反映されるまでブロックする
+
+        Args:
+            boxes (np.ndarray): ボックスのリスト (N, 4)（XYXY形式で指定。XYWH形式ではない）
+            multimask_output (bool): 複数マスク出力フラグ
+            upsample_batch_size (int): 元画像サイズへのアップサンプリングを一度に行う数
+                大きな画像でメモリ使用量が膨らまないように分割する
+            embedding (ImageEmbedding): 推論対象の画像埋め込み（set_imagesの戻り値など）
+                Noneの場合は現在の画像を対象にする
+
+        Returns:
+            tuple: マスク (N, C, H, W)、スコア (N, C)
+                画像が未設定、または推論前に別の画像が設定された場合は (None, None)
+        """
+        if embedding is None:
+            self._resume_image()
+            with self._lock:
+                request_id = self._image_request_id
+
+            embedding = self._wait_embedding(request_id)
+            if embedding is None:
+                return None, None
+
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        if len(boxes) == 0:
+            num_masks = 3 if multimask_output else 1
+            return (
+                np.zeros((0, num_masks) + tuple(embedding.original_size), bool),
+                np.zeros((0, num_masks), np.float32),
+            )
+
+        masks, scores, logits = self._decode_batch(
+            embedding,
+            boxes=boxes,
+            multimask_output=multimask_output,
+            upsample_batch_size=upsample_batch_size,
+        )
+        return masks, scores
+
+    def _wait_embedding(
+        self,
+        request_id: int,
+    ) -> ImageEmbedding:
+        """指定要求の画像埋め込みが反映されるまで待機
+
+        Returns:
+            ImageEmbedding: 画像埋め込み（別の画像が設定された場合はNone）
+        """
+        if request_id == 0:
+            return None
+
+        # ワーカー側の反映処理もロックを取るので、ロック外で待機する
+        while True:
+            self._embedding_ready.wait()
+            with self._lock:
+                if request_id != self._image_request_id:
+                    # 別の画像が設定された
+                    return None
+                if self._embedding_ready.is_set():
+                    embedding = self._embedding
+                    break
+
+        if embedding is None:
+            raise RuntimeError("Failed to set image.")
+        return embedding
+
+    def _predict_job(
+        self,
+        request_id: int,
+        prompt: dict,
+        multimask_output: bool,
+        roi_image: tuple = None,
+        compact: bool = False,
+    ) -> np.ndarray:
+        """推論のジョブ関数（推論スレッドから呼ばれる）
+
+        Args:
+            roi_image (tuple): ROIモードで切り出す画像 (img, img_format, img_path)（Noneの場合はROIモードを使わない）
+            compact (bool): コンパクト表現（CompactMaskのリスト）で返すフラグ
+        """
+        if roi_image is not None:
+            roi = self._roi_for_prompt(prompt, roi_image[0].shape[:2])
+            if roi is not None:
+                handled, masks = self._predict_roi_job(
+                    request_id,
+                    roi_image[0],
+                    roi_image[1],
+                    roi,
+                    prompt,
+                    multimask_output,
+                    compact=compact,
+                )
+                if handled:
+                    return masks
+
+        embedding = self._wait_embedding(request_id)
+        if embedding is None:
+            return None
+
+        masks, scores, logits = self._decode(
+            embedding,
+            prompt,
+            multimask_output=multimask_output,
+            compact=compact,
+        )
+        return masks
+
+    def _roi_for_prompt(
+        self,
+        prompt: dict,
+        image_shape: tuple,
+    ) -> tuple:
+        """プロンプトを含むROIモードのタイルの範囲
+
+        タイルはプロンプトの中心に置き、キャッシュを再利用できるように格子に揃える
+
+        Args:
+            prompt (dict): プロンプト
+            image_shape (tuple): 画像サイズ (H, W)
+
+        Returns:
+            tuple: タイルの範囲 (x0, y0, x1, y1)
+                画像全体でも等倍以上でエンコードされる場合や、プロンプトがタイルに収まらない場合はNone
+        """
+        img_h, img_w = image_shape
+        tile_size = self._roi_tile_size
+        if max(img_h, img_w) <= tile_size:
+            return None
+
+        points = []
+        if prompt["point_coords"] is not None:
+            points.append(np.asarray(prompt["point_coords"], np.float32).reshape(-1, 2))
+        if prompt["box"] is not None:
+            points.append(np.asarray(prompt["box"], np.float32).reshape(2, 2))
+        if not points:
+            return None
+        points = np.concatenate(points, axis=0)
+        px0, py0 = points.min(axis=0)
+        px1, py1 = points.max(axis=0)
+
+        # 物体がタイルからはみ出さないように、プロンプトの範囲が大きいときは画像全体で推論する
+        max_extent = tile_size * self._ROI_MAX_PROMPT_RATIO
+        if px1 - px0 > max_extent or py1 - py0 > max_extent:
+            return None
+
+        tile_w = min(tile_size, img_w)
+        tile_h = min(tile_size, img_h)
+        step = max(int(tile_size * self._ROI_GRID_RATIO), 1)
+
+        def _origin(center, tile_len, img_len):
+            origin = int(round((center - tile_len / 2) / step)) * step
+            return min(max(origin, 0), img_len - tile_len)
+
+        x0 = _origin((px0 + px1) / 2, tile_w, img_w)
+        y0 = _origin((py0 + py1) / 2, tile_h, img_h)
+        x1 = x0 + tile_w
+        y1 = y0 + tile_h
+        if px0 < x0 or py0 < y0 or px1 > x1 or py1 > y1:
+            return None
+        return x0, y0, x1, y1
+
+    def _predict_roi_job(
+        self,
+        request_id: int,
+        img: np.ndarray,
+        img_format: str,
+        roi: tuple,
+        prompt: dict,
+        multimask_output: bool,
+        compact: bool = False,
+    ) -> tuple:
+        """ROIモードの推論（推論スレッドから呼ばれる）
+
+        切り出したタイルを画像埋め込みに変換し、タイル上で推論したマスクを元画像の座標に貼り戻す
+        画像全体の画像埋め込みの完了は待たない
+        タイルのエンコードは対話タスクとしてワーカーで実行し、実行中の先読みや画像全体のエンコードは中断させる
+        （中断した画像全体のエンコードはタイルのエンコード後にやり直す）
+        マスクが画像の内側にあるタイルの辺に接する場合は、物体がタイルからはみ出している可能性があるので採用しない
+
+        Returns:
+            tuple: ROIモードで推論したか、元画像サイズのマスク (C, H, W)（compactがTrueの場合はCompactMaskのリスト）
+                推論前に別の画像が設定された場合はマスクがNone
+                推論しなかった場合は (False, None)（呼び出し側で画像全体で推論する）
+        """
+        x0, y0, x1, y1 = roi
+        tile_img = img[y0:y1, x0:x1]
+
+        def _encode_tile(cancel_fn):
+            return self._get_embedding(
+                tile_img,
+                img_format,
+                cancel_fn=lambda: cancel_fn() or request_id != self._image_request_id,
+            )
+
+        # タイルの画像埋め込み（画素値から算出したキーでキャッシュされる）
+        try:
+            embedding = self._encode_worker.submit_task(_encode_tile).result()
+        except EncodeCancelledError:
+            return True, None
+
+        with self._lock:
+            if request_id != self._image_request_id:
+                return True, None
+
+        # プロンプトをタイルの座標に変換
+        offset = np.array([x0, y0], np.float32)
+        tile_prompt = prompt.copy()
+        if prompt["point_coords"] is not None:
+            tile_prompt["point_coords"] = (
+                np.asarray(prompt["point_coords"], np.float32).reshape(-1, 2) - offset)
+        if prompt["box"] is not None:
+            tile_prompt["box"] = (
+                np.asarray(prompt["box"], np.float32).reshape(2, 2) - offset).reshape(4)
+
+        masks, scores, logits = self._decode(
+            embedding,
+            tile_prompt,
+            multimask_output=multimask_output,
+            compact=compact,
+        )
+
+        # 画像の内側にあるタイルの辺（左、上、右、下）
+        img_h, img_w = img.shape[:2]
+        inner_edges = (x0 > 0, y0 > 0, x1 < img_w, y1 < img_h)
+        if any(self._touches_tile_edge(mask, inner_edges) for mask in masks):
+            with self._lock:
+                self._encode_stats["roi_fallbacks"] += 1
+            return False, None
+
+        with self._lock:
+            self._encode_stats["roi_predictions"] += 1
+
+        # 元画像の座標に貼り戻す
+        if compact:
+            return True, [mask.translate(x0, y0, img.shape[:2]) for mask in masks]
+        full_masks = np.zeros((masks.shape[0],) + tuple(img.shape[:2]), bool)
+        full_masks[:, y0:y1, x0:x1] = masks
+        return True, full_masks
+
+    @staticmethod
+    def _touches_tile_edge(
+        mask,
+        edges: tuple,
+    ) -> bool:
+        """タイル上のマスクが指定の辺に接するか
+
+        Args:
+            mask (np.ndarray | CompactMask): タイル上のマスク (h, w)
+            edges (tuple): 判定する辺のフラグ（左、上、右、下）
+
+        Returns:
+            bool: 指定の辺のいずれかに接するか
+        """
+        if isinstance(mask, CompactMask):
+            tile_h, tile_w = mask.shape
+            bx0, by0, bx1, by1 = mask.bbox
+            if bx1 <= bx0 or by1 <= by0:
+                return False
+            region = mask.mask
+            left, top, right, bottom = bx0 == 0, by0 == 0, bx1 == tile_w, by1 == tile_h
+        else:
+            region = mask
+            left = top = right = bottom = True
+
+        left_edge, top_edge, right_edge, bottom_edge = edges
+        return bool(
+            (left_edge and left and region[:, 0].any())
+            or (top_edge and top and region[0, :].any())
+            or (right_edge and right and region[:, -1].any())
+            or (bottom_edge and bottom and region[-1, :].any())
+        )
+
+    def _decode(
+        self,
+        embedding: ImageEmbedding,
+        prompt: dict,
+        multimask_output: bool,
+        compact: bool = False,
+    ) -> tuple:
+        """単一プロンプトのマスクデコード（結果をキャッシュする）
+
+        画像埋め込みのキーとプロンプトが同じ要求は、マスクデコーダを実行せずにキャッシュの結果を返す
+        キャッシュの結果を呼び出し側で変更されないように、マスクは複製して返す
+        （キーの無い画像埋め込みはキャッシュしない）
+
+        Args:
+            compact (bool): マスクをコンパクト表現（CompactMaskのリスト）で返すフラグ
+
+        Returns:
+            tuple: マスク (C, H, W)、スコア (C,)、低解像度ロジット (C, 256, 256)
+        """
+        key = None
+        if embedding.key != "":
+            key = make_decode_key(embedding.key, prompt, multimask_output, compact)
+            result = self._decode_cache.get(key)
+            if result is not None:
+                return self._copy_decode_result(result)
+
+        result = self._decode_uncached(
+            embedding,
+            prompt,
+            multimask_output=multimask_output,
+            compact=compact,
+        )
+        if key is not None:
+            self._decode_cache.put(key, result)
+            return self._copy_decode_result(result)
+        return result
+
+    @staticmethod
+    def _copy_decode_result(
+        result: tuple,
+    ) -> tuple:
+        """キャッシュしたデコード結果の複製
+
+        コンパクト表現のマスクは書き込み不可にして共有する（複製するのはリストだけ）
+        """
+        masks, scores, logits = result
+        if isinstance(masks, list):
+            for mask in masks:
+                mask.mask.setflags(write=False)
+            masks = list(masks)
+        else:
+            masks = masks.copy()
+        return masks, scores.copy(), logits.copy()
+
+    @_uses_model
+    def _decode_uncached(
+        self,
+        embedding: ImageEmbedding,
+        prompt: dict,
+        multimask_output: bool,
+        compact: bool = False,
+    ) -> tuple:
+        """単一プロンプトのマスクデコード
+
+        SamPredictor.predictと同等の処理を、指定の画像埋め込みに対して行う
+
+        Args:
+            compact (bool): マスクをコンパクト表現（CompactMaskのリスト）で返すフラグ
+
+        Returns:
+            tuple: マスク (C, H, W)、スコア (C,)、低解像度ロジット (C, 256, 256)
+        """
+        if self._onnx_decoder is not None:
+            # ONNXモデルは低解像度のロジットまでなので、選んだマスクだけアップサンプリングする
+            logits, scores = self._onnx_decoder.decode_low_res(
+                embedding,
+                point_coords=prompt["point_coords"],
+                point_labels=prompt["point_labels"],
+                box=prompt["box"],
+                multimask_output=multimask_output,
+            )
+            low_res_masks = torch.as_tensor(logits, device=self._device)[None]
+            if compact:
+                masks = self.upsample_masks_compact(embedding, low_res_masks)[0]
+            else:
+                masks = self.upsample_masks(embedding, low_res_masks)[0]
+            return masks, scores, logits
+
+        point_coords = None
+        point_labels = None
+        if prompt["point_coords"] is not None:
+            assert prompt["point_labels"] is not None
+            point_coords = np.asarray(prompt["point_coords"])[None, :, :]
+            point_labels = np.asarray(prompt["point_labels"])[None, :]
+
+        boxes = None
+        if prompt["box"] is not None:
+            boxes = np.asarray(prompt["box"]).reshape(1, 4)
+
+        if compact:
+            low_res_masks, iou_predictions = self.decode_low_res(
+                embedding,
+                point_coords=point_coords,
+                point_labels=point_labels,
+                boxes=boxes,
+                multimask_output=multimask_output,
+            )
+            masks = self.upsample_masks_compact(embedding, low_res_masks)
+            return (
+                masks[0],
+                iou_predictions[0].cpu().numpy(),
+                low_res_masks[0].cpu().numpy(),
+            )
+
+        masks, scores, logits = self._decode_batch(
+            embedding,
+            point_coords=point_coords,
+            point_labels=point_labels,
+            boxes=boxes,
+            multimask_output=multimask_output,
+        )
+        return masks[0], scores[0], logits[0]
+
+    @_uses_model
+    @torch.no_grad()
+    def _decode_batch(
+        self,
+        embedding: ImageEmbedding,
+        point_coords: np.ndarray = None,
+        point_labels: np.ndarray = None,
+        boxes: np.ndarray = None,
+        multimask_output: bool = False,
+        upsample_batch_size: int = None,
+        precision: str = None,
+    ) -> tuple:
+        """複数プロンプトのマスクデコード
+
+        SamPredictor.predict_torchと同等の処理を、指定の画像埋め込みに対して行う
+        SamPredictorの状態は参照しないので、ロック外から呼び出せる
+
+        Args:
+            embedding (ImageEmbedding): 画像埋め込み
+            point_coords (np.ndarray): ポイントの座標 (B, N, 2)
+            point_labels (np.ndarray): ポイントのラベル (B, N)
+            boxes (np.ndarray): ボックス (B, 4)（XYXY形式）
+            multimask_output (bool): 複数マスク出力フラグ
+            upsample_batch_size (int): 一度にアップサンプリングする数（Noneの場合は一括）
+            precision (str): 推論精度（Noneの場合はコンストラクタで指定した精度）
+
+        Returns:
+            tuple: マスク (B, C, H, W)、スコア (B, C)、低解像度ロジット (B, C, 256, 256)
+        """
+        low_res_masks, iou_predictions = self.decode_low_res(
+            embedding,
+            point_coords=point_coords,
+            point_labels=point_labels,
+            boxes=boxes,
+            multimask_output=multimask_output,
+            precision=precision,
+        )
+        masks = self.upsample_masks(
+            embedding,
+            low_res_masks,
+            batch_size=upsample_batch_size,
+        )
+
+        return (
+            masks,
+            iou_predictions.cpu().numpy(),
+            low_res_masks.cpu().numpy(),
+        )
+
+    @_uses_model
+    @torch.no_grad()
+    def decode_low_res(
+        self,
+        embedding: ImageEmbedding,
+        point_coords=None,
+        point_labels=None,
+        boxes=None,
+        multimask_output: bool = False,
+        precision: str = None,
+    ) -> tuple:
+        """複数プロンプトのマスクデコード（元画像サイズへのアップサンプリングなし）
+
+        低解像度のロジットのまま選別してから必要なものだけアップサンプリングする用途向け
+
+        Args:
+            embedding (ImageEmbedding): 画像埋め込み
+            point_coords (np.ndarray | torch.Tensor): ポイントの座標 (B, N, 2)（元画像の座標）
+            point_labels (np.ndarray | torch.Tensor): ポイントのラベル (B, N)
+            boxes (np.ndarray | torch.Tensor): ボックス (B, 4)（XYXY形式）
+            multimask_output (bool): 複数マスク出力フラグ
+            precision (str): 推論精度（Noneの場合はコンストラクタで指定した精度）
+
+        Returns:
+            tuple: 低解像度ロジット (B, C, 256, 256)、スコア (B, C)（いずれもfp32のtorch.Tensor）
+        """
+        transform = self._predictor.transform
+
+        points = None
+        if point_coords is not None:
+            assert point_labels is not None
+            coords_torch = torch.as_tensor(
+                point_coords, dtype=torch.float, device=self._device)
+            coords_torch = transform.apply_coords_torch(
+                coords_torch, embedding.original_size)
+            labels_torch = torch.as_tensor(
+                point_labels, dtype=torch.int, device=self._device)
+            points = (coords_torch, labels_torch)
+
+        boxes_torch = None
+        if boxes is not None:
+            boxes_torch = torch.as_tensor(
+                boxes, dtype=torch.float, device=self._device)
+            boxes_torch = transform.apply_boxes_torch(
+                boxes_torch, embedding.original_size)
+
+        with self._autocast(precision):
+            sparse_embeddings, dense_embeddings = self._sam.prompt_encoder(
+                points=points,
+                boxes=boxes_torch,
+                masks=None,
+            )
+            low_res_masks, iou_predictions = self._sam.mask_decoder(
+                image_embeddings=embedding.features,
+                image_pe=self._sam.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=multimask_output,
+            )
+
+        # 後段の処理はfp32で行う（numpyはbfloat16非対応）
+        return low_res_masks.float(), iou_predictions.float()
+
+    @_uses_model
+    @torch.no_grad()
+    def upsample_masks(
+        self,
+        embedding: ImageEmbedding,
+        low_res_masks: torch.Tensor,
+        batch_size: int = None,
+    ) -> np.ndarray:
+        """低解像度のロジットを元画像サイズにアップサンプリングして2値化
+
+        Args:
+            embedding (ImageEmbedding): 画像埋め込み
+            low_res_masks (torch.Tensor): 低解像度ロジット (B, C, 256, 256)
+            batch_size (int): 一度にアップサンプリングする数（Noneの場合は一括）
+                大きな画像でメモリ使用量が膨らまないように分割する
+
+        Returns:
+            np.ndarray: マスク (B, C, H, W)
+        """
+        num = low_res_masks.shape[0]
+        if num == 0:
+            return np.zeros(
+                tuple(low_res_masks.shape[:2]) + tuple(embedding.original_size), bool)
+
+        step = batch_size if batch_size else num
+        masks = []
+        for i in range(0, num, step):
+            masks_ = self._sam.postprocess_masks(
+                low_res_masks[i:i + step],
+                embedding.input_size,
+                embedding.original_size,
+            )
+            masks.append((masks_ > self._sam.mask_threshold).cpu().numpy())
+        return np.concatenate(masks, axis=0)
+
+    @_uses_model
+    @torch.no_grad()
+    def upsample_masks_compact(
+        self,
+        embedding: ImageEmbedding,
+        low_res_masks: torch.Tensor,
+    ) -> list:
+        """低解像度のロジットをマスクのバウンディングボックスの範囲だけ元画像サイズにアップサンプリング
+
+        postprocess_masksと同じく、画像エンコーダの入力サイズへの拡大と元画像サイズへの拡大を
+        バイリニア補間で行うが、後段の拡大はgrid_sampleでバウンディングボックスの範囲だけ行う
+        大きな画像で元画像サイズのマスクを確保しないためのもの
+
+        Args:
+            embedding (ImageEmbedding): 画像埋め込み
+            low_res_masks (torch.Tensor): 低解像度ロジット (B, C, 256, 256)
+
+        Returns:
+            list: CompactMaskのリスト (B, C)
+        """
+        input_h, input_w = embedding.input_size
+
+        # 画像エンコーダの入力サイズへの拡大は元画像に比べて小さいので一括で行う
+        logits = F.interpolate(
+            low_res_masks.float(),
+            (self._image_size, self._image_size),
+            mode="bilinear",
+            align_corners=False,
+        )
+        logits = logits[..., :input_h, :input_w]
+
+        return [
+            [
+                self._upsample_region(logits[b, c], embedding.original_size)
+                for c in range(logits.shape[1])
+            ]
+            for b in range(logits.shape[0])
+        ]
+
+    def _upsample_region(
+        self,
+        logits: torch.Tensor,
+        original_size: tuple,
+    ) -> CompactMask:
+        """入力サイズのロジット (h, w) を、正の範囲に対応する元画像の範囲だけアップサンプリング"""
+        img_h, img_w = original_size
+        in_h, in_w = logits.shape
+        threshold = self._sam.mask_threshold
+
+        positive = logits > threshold
+        ys = torch.nonzero(positive.any(dim=1)).flatten()
+        xs = torch.nonzero(positive.any(dim=0)).flatten()
+        if len(ys) == 0:
+            return CompactMask(
+                bbox=(0, 0, 0, 0),
+                mask=np.zeros((0, 0), bool),
+                image_size=(img_h, img_w),
+            )
+
+        # バイリニア補間で正になり得るのは正の画素の隣までなので、1画素広げた範囲を元画像の座標に変換する
+        sx = img_w / in_w
+        sy = img_h / in_h
+        x0 = max(int(math.floor((xs[0].item() - 1) * sx)), 0)
+        y0 = max(int(math.floor((ys[0].item() - 1) * sy)), 0)
+        x1 = min(int(math.ceil((xs[-1].item() + 2) * sx)), img_w)
+        y1 = min(int(math.ceil((ys[-1].item() + 2) * sy)), img_h)
+
+        # F.interpolate(align_corners=False) と同じ標本位置を正規化座標で指定する
+        gx = (torch.arange(x0, x1, device=logits.device, dtype=torch.float32) + 0.5) / img_w * 2 - 1
+        gy = (torch.arange(y0, y1, device=logits.device, dtype=torch.float32) + 0.5) / img_h * 2 - 1
+        grid_y, grid_x = torch.meshgrid(gy, gx, indexing="ij")
+        grid = torch.stack([grid_x, grid_y], dim=-1)[None]
+        crop = F.grid_sample(
+            logits[None, None],
+            grid,
+            mode="bilinear",
+            padding_mode="border",
+            align_corners=False,
+        )[0, 0]
+
+        return CompactMask(
+            bbox=(x0, y0, x1, y1),
+            mask=(crop > threshold).cpu().numpy(),
+            image_size=(img_h, img_w),
+        )
+
+    @property
+    def mask_threshold(self) -> float:
+        """マスクの2値化しきい値（ロジット）"""
+        return Sam.mask_threshold
+
+    @_uses_model
+    def check_precision_drift(
+        self,
+        img: np.ndarray,
+        img_format: str,
+        boxes: np.ndarray,
+    ) -> dict:
+        """推論精度によるマスクのずれの確認
+
+        同じ画像とボックスをfp32と指定の推論精度で推論し、マスクのIoUを比較する
+        キャッシュとSamPredictorの状態は変更しない
+        INT8では比較用のfp32の画像エンコーダを最初の呼び出しで作り、モデルの解放まで使い回す
+
+        Args:
+            img (np.ndarray): 画像
+            img_format (str): 画像フォーマット（'RGB' or 'BGR'）
+            boxes (np.ndarray): ボックスのリスト (N, 4)（XYXY形式）
+
+        Returns:
+            dict: 推論精度、ボックス数、IoUの平均・最小値
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+
+        # INT8では画像エンコーダ自体が量子化済みなので、比較用のfp32の画像エンコーダを使う
+        image_encoder_map = {"fp32": None, self._precision: None}
+        if self._precision == "int8":
+            with self._encode_lock:
+                if self._fp32_image_encoder is None:
+                    self._fp32_image_encoder = sam_model_registry[self._model_type](
+                        self._checkpoint).image_encoder.to(self._device)
+                image_encoder_map["fp32"] = self._fp32_image_encoder
+
+        masks_map = {}
+        for precision, image_encoder in image_encoder_map.items():
+            with self._encode_lock:
+                embedding = self._compute_embedding(
+                    img,
+                    img_format,
+                    precision=precision,
+                    image_encoder=image_encoder,
+                )
+            masks, _, _ = self._decode_batch(
+                embedding,
+                boxes=boxes,
+                precision=precision,
+            )
+            masks_map[precision] = masks[:, 0]
+
+        ious = []
+        for mask_ref, mask in zip(masks_map["fp32"], masks_map[self._precision]):
+            union = np.logical_or(mask_ref, mask).sum()
+            inter = np.logical_and(mask_ref, mask).sum()
+            ious.append(inter / union if union > 0 else 1.0)
+
+        return {
+            "precision": self._precision,
+            "num_boxes": len(ious),
+            "mean_iou": float(np.mean(ious)) if ious else 1.0,
+            "min_iou": float(np.min(ious)) if ious else 1.0,
+        }
@@ -11,6 +11,17 @@ class CommandLineArguments:
     model_type: str = ""
     input_img_dir: str = ""
     output_root_dir: str = ""
+    embedding_cache_dir: str = ""
+    num_prefetch_next: int = 0
+    num_prefetch_prev: int = 0
+    precision: str = ""
+    decoder_backend: str = ""
+    encoder_backend: str = ""
+    refine_model_type: str = ""
+    idle_timeout_sec: float = 0
+    roi_mode: bool = False
+    proposal_index_dir: str = ""
+    proposal_min_score: float = 0.0
 
 def get_args() -> CommandLineArguments:
     """コマンドライン引数の取得"""
@@ -46,6 +57,86 @@ def get_args() -> CommandLineArguments:
         type=str,
         # help=""
     )
+
+    parser.add_argument(
+        "--embedding_cache_dir",
+        default=".cache/embeddings",
+        type=str,
+        help="画像埋め込みのディスクキャッシュ先（空文字でキャッシュ無効）",
+    )
+
+    parser.add_argument(
+        "--num_prefetch_next",
+        default=2,
+        type=int,
+        help="バックグラウンドで先読みエンコードする次の画像の数",
+    )
+
+    parser.add_argument(
+        "--num_prefetch_prev",
+        default=1,
+        type=int,
+        help="バックグラウンドで先読みエンコードする前の画像の数",
+    )
+
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        type=str,
+        choices=["fp32", "bf16", "int8"],
+        help="推論精度（bf16: 自動混合精度、int8: 画像エンコーダの動的量子化（CPUのみ））",
+    )
+
+    parser.add_argument(
+        "--decoder_backend",
+        default="torch",
+        type=str,
+        choices=["torch", "onnx"],
+        help="クリック時のマスク推論の実行方式（onnx: onnxruntimeでCPU推論）",
+    )
+
+    parser.add_argument(
+        "--encoder_backend",
+        default="eager",
+        type=str,
+        choices=["eager", "torchscript"],
+        help="画像エンコーダの実行方式（torchscript: トレース済みモデルを保存して次回以降の起動で再利用）",
+    )
+
+    parser.add_argument(
+        "--refine_model_type",
+        default="",
+        type=str,
+        choices=["", "vit_h", "vit_l", "vit_b"],
+        help="プレビュー後に結果を置き換える高精度モデル（空文字で無効。例: vit_h）",
+    )
+
+    parser.add_argument(
+        "--idle_timeout_sec",
+        default=0,
+        type=float,
+        help="操作が無い状態がこの秒数続いたらモデルを解放する（0以下で無効。次の操作時に読み込み直す）",
+    )
+
+    parser.add_argument(
+        "--roi_mode",
+        action="store_true",
+        help="高解像度画像の小さな範囲へのクリックは周辺を等倍でエンコードして推論する（Rキーで切り替え）",
+    )
+
+    parser.add_argument(
+        "--proposal_index_dir",
+        default="",
+        type=str,
+        help="事前計算したマスク候補インデックスのディレクトリ（auto_annotateの出力。空文字で無効）",
+    )
+
+    parser.add_argument(
+        "--proposal_min_score",
+        default=0.0,
+        type=float,
+        help="クリック時に採用するマスク候補の予測IoUの下限（下回る場合はSAMで推論する）",
+    )
     
     # TODO パラメータにログレベル追加
     # parser.add_argument(
@@ -0,0 +1,190 @@
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+np = pytest.importorskip("numpy")
+PIL_Image = pytest.importorskip("PIL.Image")
+pytest.importorskip("cv2")
+pytest.importorskip("torch")
+pytest.importorskip("pycocotools")
+pytest.importorskip("segment_anything")
+
+from sam_annotation import coco_bbox_to_seg  # noqa: E402
+
+
+class _BoxFillPredictor:
+    """BBoxの範囲をそのままマスクにするSAM推論の代わり（SAMのモデルを使わずに実行するため）"""
+
+    # 推論したBBoxの数（全インスタンスの合計）
+    num_boxes = 0
+
+    def __init__(self, **kwargs):
+        pass
+
+    def set_images(self, imgs, img_format, batch_size):
+        return [img.shape[:2] for img in imgs]
+
+    def predict_boxes(self, boxes, multimask_output, embedding):
+        masks = np.zeros((len(boxes), 1) + tuple(embedding), bool)
+        for i, (x0, y0, x1, y1) in enumerate(boxes.astype(int)):
+            masks[i, 0, y0:y1, x0:x1] = True
+        type(self).num_boxes += len(boxes)
+        return masks, np.ones((len(boxes), 1), np.float32)
+
+
+def _write_dataset(path: Path, bboxes: list):
+    """画像1枚につきBBox1つのCOCO形式ファイルを書き出す"""
+    dataset = {
+        "images": [
+            {"id": i + 1, "file_name": f"img{i + 1}.png", "width": 64, "height": 48}
+            for i in range(len(bboxes))
+        ],
+        "annotations": [
+            {
+                "id": i + 1,
+                "image_id": i + 1,
+                "category_id": 1,
+                "bbox": bbox,
+                "area": bbox[2] * bbox[3],
+                "segmentation": [],
+                "iscrowd": 0,
+            }
+            for i, bbox in enumerate(bboxes)
+        ],
+        "categories": [{"id": 1, "name": "object", "supercategory": ""}],
+    }
+    path.write_text(json.dumps(dataset))
+
+
+def _run(monkeypatch, anno_file: Path, img_dir: Path, output_file: Path, index_file: Path):
+    """コマンドラインから実行したときと同じ引数でmainを実行"""
+    monkeypatch.setattr(sys, "argv", [
+        "coco_bbox_to_seg",
+        "--anno_file", str(anno_file),
+        "--img_dir", str(img_dir),
+        "--output_file", str(output_file),
+        "--incremental_index", str(index_file),
+        "--num_load_workers", "1",
+        "--num_polygon_workers", "1",
+    ])
+    coco_bbox_to_seg.main()
+    with open(output_file) as fp:
+        return {anno["id"]: anno for anno in json.load(fp)["annotations"]}
+
+
+def _polygon_bounds(segmentation: list) -> tuple:
+    """ポリゴンの外接矩形 (x0, y0, x1, y1)（x1・y1は範囲に含む）"""
+    points = np.array(segmentation[0]).reshape(-1, 2)
+    return tuple(points.min(axis=0).tolist() + points.max(axis=0).tolist())
+
+
+def test_rerun_reconverts_modified_bbox(tmp_path, monkeypatch):
+    """同じ出力先で再実行したとき、前回のジャーナルではなく変更後のBBoxで変換し直す"""
+    monkeypatch.setattr(coco_bbox_to_seg, "SamPredictorWrapper", _BoxFillPredictor)
+
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    for i in range(2):
+        PIL_Image.new("RGB", (64, 48)).save(img_dir / f"img{i + 1}.png")
+
+    anno_file = tmp_path / "anno.json"
+    output_file = tmp_path / "out" / "output.json"
+    index_file = tmp_path / "out" / "index.jsonl"
+
+    # 1回目: 全BBoxを変換する
+    _write_dataset(anno_file, [[4, 4, 10, 10], [20, 10, 8, 6]])
+    annos = _run(monkeypatch, anno_file, img_dir, output_file, index_file)
+    assert _BoxFillPredictor.num_boxes == 2
+    assert _polygon_bounds(annos[1]["segmentation"]) == (4, 4, 13, 13)
+    assert _polygon_bounds(annos[2]["segmentation"]) == (20, 10, 27, 15)
+
+    # 結合後はジャーナルを残さない
+    assert list(output_file.parent.glob("*.journal.jsonl")) == []
+
+    # 2回目: 1つ目のBBoxだけ変更する
+    _BoxFillPredictor.num_boxes = 0
+    _write_dataset(anno_file, [[30, 20, 12, 8], [20, 10, 8, 6]])
+    annos = _run(monkeypatch, anno_file, img_dir, output_file, index_file)
+
+    # 変更したBBoxだけ変換し直し、変更の無いBBoxはインデックスの結果を使う
+    assert _BoxFillPredictor.num_boxes == 1
+    assert _polygon_bounds(annos[1]["segmentation"]) == (30, 20, 41, 27)
+    assert _polygon_bounds(annos[2]["segmentation"]) == (20, 10, 27, 15)
+    assert list(output_file.parent.glob("*.journal.jsonl")) == []
+
+
+def test_stale_journal_is_ignored(tmp_path, monkeypatch):
+    """別のアノテーションファイルで作られたジャーナルは読み込まずに変換し直す"""
+    monkeypatch.setattr(coco_bbox_to_seg, "SamPredictorWrapper", _BoxFillPredictor)
+
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    PIL_Image.new("RGB", (64, 48)).save(img_dir / "img1.png")
+
+    anno_file = tmp_path / "anno.json"
+    output_file = tmp_path / "output.json"
+    index_file = tmp_path / "index.jsonl"
+    _write_dataset(anno_file, [[4, 4, 10, 10]])
+
+    # 中断された古い実行のジャーナル（ヘッダ無し）
+    journal_file = Path(str(output_file) + ".journal.jsonl")
+    journal_file.write_text(json.dumps({
+        "image_id": 1,
+        "annotations": [{"id": 1, "segmentation": [[0, 0, 1, 0, 1, 1]], "iscrowd": 0}],
+    }) + "\n")
+
+    _BoxFillPredictor.num_boxes = 0
+    annos = _run(monkeypatch, anno_file, img_dir, output_file, index_file)
+    assert _BoxFillPredictor.num_boxes == 1
+    assert _polygon_bounds(annos[1]["segmentation"]) == (4, 4, 13, 13)
+    assert not journal_file.exists()
+
+
+def test_merge_fails_with_missing_shard(tmp_path, monkeypatch):
+    """シャードのジャーナルが揃っていない場合は出力ファイルを作らずにエラーにする"""
+    monkeypatch.setattr(coco_bbox_to_seg, "SamPredictorWrapper", _BoxFillPredictor)
+
+    img_dir = tmp_path / "images"
+    img_dir.mkdir()
+    for i in range(2):
+        PIL_Image.new("RGB", (64, 48)).save(img_dir / f"img{i + 1}.png")
+
+    anno_file = tmp_path / "anno.json"
+    output_file = tmp_path / "output.json"
+    journal_file = tmp_path / "journal.jsonl"
+    _write_dataset(anno_file, [[4, 4, 10, 10], [20, 10, 8, 6]])
+
+    def _argv(*extra):
+        return [
+            "coco_bbox_to_seg",
+            "--anno_file", str(anno_file),
+            "--img_dir", str(img_dir),
+            "--output_file", str(output_file),
+            "--journal_file", str(journal_file),
+            "--num_shards", "2",
+            "--num_load_workers", "1",
+            "--num_polygon_workers", "1",
+        ] + list(extra)
+
+    # シャード0だけ変換する（ジャーナルファイルの指定にシャードの番号が付く）
+    monkeypatch.setattr(sys, "argv", _argv("--shard_index", "0"))
+    coco_bbox_to_seg.main()
+    assert (tmp_path / "journal.jsonl.shard-0000-of-0002").exists()
+
+    monkeypatch.setattr(sys, "argv", _argv("--merge_only"))
+    with pytest.raises(RuntimeError):
+        coco_bbox_to_seg.main()
+    assert not output_file.exists()
+
+    # 残りのシャードを変換すれば結合できる
+    monkeypatch.setattr(sys, "argv", _argv("--shard_index", "1"))
+    coco_bbox_to_seg.main()
+    monkeypatch.setattr(sys, "argv", _argv("--merge_only"))
+    coco_bbox_to_seg.main()
+    with open(output_file) as fp:
+        annos = {anno["id"]: anno for anno in json.load(fp)["annotations"]}
+    assert _polygon_bounds(annos[1]["segmentation"]) == (4, 4, 13, 13)
+    assert _polygon_bounds(annos[2]["segmentation"]) == (20, 10, 27, 15)
+    assert list(tmp_path.glob("journal.jsonl*")) == []